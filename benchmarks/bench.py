@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+""" Benchmarks for the parse -> event -> handler pipeline.
+
+Each benchmark runs one function over a corpus of generated lines and
+reports how many lines per second it gets through, along with the peak
+memory ``tracemalloc`` saw during one pass, per line. The functions keep
+what they produce (parsed lines, events, client state), so that figure is
+what each line costs in allocations. The corpora are made with a fixed
+seed, so the numbers can be compared between runs::
+
+    python benchmarks/bench.py                       # run everything
+    python benchmarks/bench.py parse                 # only names with "parse"
+    python benchmarks/bench.py --save baseline.json  # keep the results
+    python benchmarks/bench.py --compare baseline.json --tolerance 0.15
+
+With ``--compare``, the script exits with status 1 if any benchmark is
+slower than the baseline by more than the tolerance, so it can run in CI.
+
+``baseline.json`` next to this script holds a run of the current tree. The
+numbers depend on the machine, so record a baseline of your own with 
+``--save`` before making changes, and compare against that::
+
+    python benchmarks/bench.py --compare benchmarks/baseline.json
+
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+from ircutils3 import client, ctcp, format, protocol, replay, responses
+
+
+# ------------------------------------------------------------------------------
+# Corpora
+# ------------------------------------------------------------------------------
+
+_words = ("the quick brown fox jumps over lazy dog irc bot channel server "
+          "python network hello world lag split join part quit").split()
+
+
+def _nick(rng):
+    return "%s%d" % (rng.choice(_words), rng.randrange(1000))
+
+
+def _prefix(rng):
+    nick = _nick(rng)
+    return "%s!~%s@%s.users.example" % (nick, nick[:8],
+                                         rng.choice(_words))
+
+
+def _text(rng):
+    words = [rng.choice(_words) for i in range(rng.randrange(3, 20))]
+    roll = rng.random()
+    if roll < 0.1:
+        return "\x01ACTION %s\x01" % " ".join(words)
+    if roll < 0.25:
+        return "\x02%s\x02 \x0304,01%s\x03" % (words[0], " ".join(words[1:]))
+    return " ".join(words)
+
+
+def busy_channel(rng, count=20000):
+    """ Mostly channel messages, with some joins, parts and mode changes. """
+    lines = []
+    channels = ["#python", "#ircutils", "#chat"]
+    for i in range(count):
+        roll = rng.random()
+        channel = rng.choice(channels)
+        if roll < 0.85:
+            lines.append(":%s PRIVMSG %s :%s" % (_prefix(rng), channel,
+                                                 _text(rng)))
+        elif roll < 0.9:
+            lines.append(":%s JOIN %s" % (_prefix(rng), channel))
+        elif roll < 0.95:
+            lines.append(":%s PART %s :bye" % (_prefix(rng), channel))
+        elif roll < 0.98:
+            lines.append(":%s NOTICE %s :%s" % (_prefix(rng), channel,
+                                                _text(rng)))
+        else:
+            lines.append(":%s MODE %s +v %s" % (_prefix(rng), channel,
+                                                _nick(rng)))
+    return lines
+
+
+def names_burst(rng, channels=200, per_channel=400):
+    """ Joining many big channels: NAMES replies and their ends. """
+    lines = []
+    for c in range(channels):
+        channel = "#channel%d" % c
+        names = [rng.choice(["", "", "", "+", "@", "@+"]) + _nick(rng)
+                 for i in range(per_channel)]
+        for start in range(0, len(names), 50):
+            lines.append(":irc.example 353 bench = %s :%s" % (
+                channel, " ".join(names[start:start + 50])))
+        lines.append(":irc.example 366 bench %s :End of /NAMES list." %
+                     channel)
+    return lines
+
+
+def netsplit(rng, count=20000):
+    """ A netsplit: nothing but quits. """
+    return [":%s QUIT :hub.example leaf.example" % _prefix(rng)
+            for i in range(count)]
+
+
+def corpora():
+    rng = random.Random(2812)
+    return {
+        "busy": busy_channel(rng),
+        "names": names_burst(rng),
+        "netsplit": netsplit(rng),
+        }
+
+
+# ------------------------------------------------------------------------------
+# Benchmarks
+# ------------------------------------------------------------------------------
+
+def _new_client():
+    bench_client = client.SimpleClient("bench")
+    bench_client._bind_connection(replay.ReplayConnection())
+    return bench_client
+
+
+def make_benchmarks(corpus):
+    """ Returns ``(name, func, items)`` tuples; ``func`` is called once with
+    the whole list of ``items`` and returns whatever it built. """
+    busy = corpus["busy"]
+    parsed = [protocol.parse_line(line) for line in busy]
+    prefixes = [prefix for prefix, command, params in parsed]
+    targets = [params[0] for prefix, command, params in parsed if params]
+    messages = [params[-1] for prefix, command, params in parsed
+                if command in ("PRIVMSG", "NOTICE")]
+    numerics = [line.split()[1] for line in corpus["names"]] * 10
+
+    def parse_lines(lines):
+        parse_line = protocol.parse_line
+        return [parse_line(line) for line in lines]
+
+    def parse_prefixes(items):
+        parse_prefix = protocol.parse_prefix
+        return [parse_prefix(prefix) for prefix in items]
+
+    def check_channels(items):
+        is_channel = protocol.is_channel
+        return [is_channel(target) for target in items]
+
+    def extract_ctcp(items):
+        extract = ctcp.extract
+        return [extract(message) for message in items]
+
+    def filter_formatting(items):
+        filter_text = format.filter
+        return [filter_text(message) for message in items]
+
+    def from_digit(items):
+        convert = responses.from_digit
+        return [convert(numeric) for numeric in items]
+
+    def build_events(items):
+        build = _new_client()._build_events
+        return [build(prefix, command, params)
+                for prefix, command, params in items]
+
+    def dispatcher(lines):
+        parsed = [protocol.parse_line(line) for line in lines]
+        parsed = [(prefix, responses.from_digit(command), params)
+                  for prefix, command, params in parsed]
+
+        def dispatch(items):
+            bench_client = _new_client()
+            dispatch_event = bench_client._dispatch_event
+            for prefix, command, params in parsed:
+                dispatch_event(prefix, command, params)
+            return bench_client
+        return dispatch
+
+    def pipeline(lines):
+        # The lines arrive the way the socket hands them over: in reads of
+        # recv_buffer_size bytes that end wherever they end, so the bulk 
+        # split in Connection.handle_read is part of what's measured.
+        raw = b"".join(line.encode("UTF-8") + b"\r\n" for line in lines)
+        size = replay.ReplayConnection.recv_buffer_size
+        reads = [raw[start:start + size] for start in range(0, len(raw), size)]
+
+        def feed(items):
+            conn = _new_client().conn
+            pending = iter(reads)
+
+            def recv_into(buffer):
+                data = next(pending)
+                buffer[:len(data)] = data
+                return len(data)
+            conn._recv_into = recv_into
+            for data in reads:
+                conn.handle_read()
+            return conn
+        return feed
+
+    return [
+        ("parse_line", parse_lines, busy),
+        ("parse_prefix", parse_prefixes, prefixes),
+        ("is_channel", check_channels, targets),
+        ("ctcp.extract", extract_ctcp, messages),
+        ("format.filter", filter_formatting, messages),
+        ("responses.from_digit", from_digit, numerics),
+        ("build_events", build_events, parsed),
+        ("dispatch.busy", dispatcher(busy), busy),
+        ("dispatch.names", dispatcher(corpus["names"]), corpus["names"]),
+        ("dispatch.netsplit", dispatcher(corpus["netsplit"]),
+         corpus["netsplit"]),
+        ("pipeline.busy", pipeline(busy), busy),
+        ]
+
+
+def measure(func, items, repeat):
+    """ Returns the best lines per second out of ``repeat`` runs, and the
+    peak traced memory of one more run, per line. """
+    best = None
+    for i in range(repeat):
+        started = time.perf_counter()
+        func(items)
+        elapsed = time.perf_counter() - started
+        if best is None or elapsed < best:
+            best = elapsed
+    tracemalloc.start()
+    func(items)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return len(items) / best, peak / float(len(items))
+
+
+def run(pattern=None, repeat=5):
+    results = {}
+    for name, func, items in make_benchmarks(corpora()):
+        if pattern and pattern not in name:
+            continue
+        rate, peak = measure(func, items, repeat)
+        results[name] = {"lines_per_sec": rate, "peak_bytes_per_line": peak}
+        print("%-22s %12.0f lines/sec %10.1f bytes/line" %
+              (name, rate, peak))
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """ Prints the change against the baseline and returns the names of the
+    benchmarks that got slower by more than ``tolerance``. """
+    regressions = []
+    print()
+    for name, result in sorted(results.items()):
+        if name not in baseline:
+            continue
+        old = baseline[name]["lines_per_sec"]
+        change = result["lines_per_sec"] / old - 1.0
+        flag = ""
+        if change < -tolerance:
+            flag = "  REGRESSION"
+            regressions.append(name)
+        print("%-22s %+7.1f%%%s" % (name, change * 100, flag))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("pattern", nargs="?",
+                        help="only run benchmarks whose name contains this")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--save", metavar="FILE",
+                        help="write the results to FILE as a baseline")
+    parser.add_argument("--compare", metavar="FILE",
+                        help="compare the results with a saved baseline")
+    parser.add_argument("--tolerance", type=float, default=0.15,
+                        help="allowed slowdown before --compare fails")
+    args = parser.parse_args(argv)
+
+    results = run(args.pattern, args.repeat)
+    if args.save:
+        with open(args.save, "w") as baseline_file:
+            json.dump({"python": platform.python_version(),
+                       "results": results}, baseline_file, indent=2,
+                      sort_keys=True)
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)["results"]
+        if compare(results, baseline, args.tolerance):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
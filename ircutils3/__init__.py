@@ -21,7 +21,29 @@
 # ------------------------------------------------------------------------------
 __author__ = "Evan Fosmark"
 
+import importlib
+
+# The submodules are imported the first time they're used as attributes of
+# the package, as in ``ircutils.bot.SimpleBot``, so importing the package 
+# itself costs next to nothing.
+_submodules = frozenset(["bot", "client", "commands", "connection", "ctcp", 
+                         "dcc", "events", "fakeserver", "format", "ident", 
+                         "masks", "messagelog", "metrics", "profiling", 
+                         "protocol", "replay", "resolver", "responses", 
+                         "sasl", "timers", "watchdog"])
+
+
+def __getattr__(name):
+    if name in _submodules:
+        return importlib.import_module("." + name, __name__)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
+def __dir__():
+    return sorted(set(globals()) | _submodules)
+
+
 def start_all():
     """ Begins all waiting clients. """
-    import asyncore
-    asyncore.loop()
\ No newline at end of file
+    from . import timers
+    timers.loop()
\ No newline at end of file
@@ -3,6 +3,7 @@ level of abstraction of the IRC protocol available in ``ircutils``.
 
 """
 from . import client
+from . import commands
 from . import events
 
 
@@ -13,22 +14,72 @@ class SimpleBot(client.SimpleClient):
     This class inherits from :class:`ircutils.client.SimpleClient`, so be sure 
     to check that documentation to see more of what is available.
     
+    Methods marked with :func:`ircutils.commands.command` are called for 
+    messages that start with ``command_prefix`` followed by their name.
+    
     """
+    command_prefix = "!"
+    
     def __init__(self, nick, mode="+B", auto_handle=True):
         client.SimpleClient.__init__(self, nick, mode, auto_handle)
-        self._autobind_handlers()
+        self.commands = commands.CommandRouter(self.command_prefix)
+        self._autobind_commands()
+    
+    @classmethod
+    def _build_listener_table(cls, auto_handle):
+        dispatcher = super(SimpleBot, cls)._build_listener_table(auto_handle)
+        cls._autobind_handlers(dispatcher)
+        return dispatcher
     
-    def _autobind_handlers(self):
-        """ Looks for "on_<event-name>" methods on the object and automatically
-        binds them to the listener for that event.
+    @classmethod
+    def _autobind_handlers(cls, dispatcher):
+        """ Looks for "on_<event-name>" methods on the class and 
+        automatically binds them to the listener for that event. This is 
+        done once per class, and every instance shares the result.
         
         """
-        for listener_name in self.events:
-            name = "on_%s" % listener_name
-            if hasattr(self, name):
-                handler = getattr(self, name).__func__
-                self.events[listener_name].add_handler(handler)
+        for listener_name in dispatcher:
+            handler = getattr(cls, "on_%s" % listener_name, None)
+            if handler is not None:
+                dispatcher[listener_name].add_handler(handler)
 
+    @classmethod
+    def _class_commands(cls):
+        """ Returns the methods of the class that are marked as commands. """
+        found = cls.__dict__.get("_commands")
+        if found is None:
+            found = []
+            for name in dir(cls):
+                command = getattr(getattr(cls, name), "command", None)
+                if isinstance(command, commands.Command):
+                    found.append(command)
+            setattr(cls, "_commands", found)
+        return found
+    
+    def _autobind_commands(self):
+        """ Looks for methods marked as commands and adds them to the command
+        router.
+        
+        """
+        for command in self._class_commands():
+            self.add_command(command)
+    
+    def add_command(self, command, func=None, **kwargs):
+        """ Adds a command. Either pass a :class:`ircutils.commands.Command`
+        or a name and a function taking ``(client, event, *args)``. The
+        keyword arguments are the same as for 
+        :func:`ircutils.commands.command`.
+        ::
+        
+            bot.add_command("ping", lambda bot, event: 
+                            bot.send_message(event.reply_to, "pong"))
+        """
+        if not isinstance(command, commands.Command):
+            command = commands.Command(command, func, **kwargs)
+        if len(self.commands) == 0:
+            self.events["message"].add_handler(_route_command)
+        self.commands.add(command)
+    
     def register_listener(self, event_name, listener):
         """ Same as :func:`ircutils.client.SimpleClient.register_listener` 
         execpt that if there is a handler in the bot already, it auto-binds it
@@ -41,6 +92,10 @@ class SimpleBot(client.SimpleClient):
             self.events[event_name].add_handler(handler)
 
 
+def _route_command(bot, event):
+    bot.commands.route(bot, event)
+
+
 class _TestBot(SimpleBot):
     """ A bot for debugging. Designed to be subclassed to building test bots.
     
@@ -3,13 +3,17 @@ connection. If you are trying to build a bot, :class:`ircutils.bot.SimpleBot`
 inherits from :class:`SimpleClient` so it has the methods listed below.
 
 """
+import base64
 import collections
+import random
 
-from . import connection
 from . import ctcp
 from . import events
 from . import format
 from . import protocol
+from . import responses
+from . import sasl
+from . import timers
 
 
 class SimpleClient(object):
@@ -27,6 +31,18 @@ class SimpleClient(object):
     software = "http://dev.guardedcode.com/projects/ircutils/"
     version = (0,1,3)
     custom_listeners = {}
+    #: A :class:`ReconnectPolicy`, or ``None`` to stay disconnected when the
+    #: connection is lost.
+    reconnect_policy = None
+    #: IRCv3 capabilities to enable when the server offers them.
+    capabilities = ["multi-prefix", "away-notify", "extended-join", "batch"]
+    #: Batch types that are only dispatched as one 
+    #: :class:`ircutils.events.BatchEvent`. The lines of other batches are 
+    #: dispatched as usual, followed by the batch event.
+    aggregated_batches = frozenset(["netsplit", "netjoin", "chathistory"])
+    #: The :class:`ircutils.metrics.Metrics` the client is counted in, set 
+    #: by :meth:`ircutils.metrics.Metrics.attach`.
+    metrics = None
     
     def __init__(self, nick, mode="+B", auto_handle=True):
         self.nickname = nick
@@ -34,12 +50,27 @@ class SimpleClient(object):
         self.real_name = self.software
         self.filter_formatting = True
         self.channels = collections.defaultdict(protocol.Channel)
-        self.events = events.EventDispatcher()
+        self.events = self._listener_table(auto_handle).fork()
         self._prev_nickname = None
         self._mode = mode
-        self._register_default_listeners()
-        if auto_handle:
-            self._add_built_in_handlers()
+        self._server = None
+        self._ssl_options = {}
+        self._ns_password = None
+        self._channel_keys = {}
+        self._quitting = False
+        self._reconnect_timer = None
+        self._pending_replay = None
+        #: A :class:`ircutils.sasl.Mechanism` to log in with while 
+        #: registering, or ``None``.
+        self.sasl = None
+        #: The account the client is logged in to, if the server says so.
+        self.account = None
+        #: The capabilities the server offers, mapped to their values.
+        self.server_capabilities = {}
+        #: The capabilities that are enabled on the current connection.
+        self.enabled_capabilities = set()
+        self._negotiating = False
+        self._sasl_buffer = []
 
     
     def __getitem__(self, name):
@@ -49,47 +80,81 @@ class SimpleClient(object):
         self.register_listener(name, value)
     
     
-    def _register_default_listeners(self):
-        """ Registers the default listeners to the names listed in events. """
+    @classmethod
+    def _listener_table(cls, auto_handle):
+        """ Returns the :class:`ircutils.events.EventDispatcher` that every 
+        instance of the class forks its own from. It's built the first time
+        the class is instantiated, so listeners and ``on_`` handlers added
+        to the class after that aren't picked up.
+        """
+        tables = cls.__dict__.get("_listener_tables")
+        if tables is None:
+            tables = {}
+            setattr(cls, "_listener_tables", tables)
+        table = tables.get(auto_handle)
+        if table is None:
+            table = tables[auto_handle] = cls._build_listener_table(auto_handle)
+        return table
+    
+    @classmethod
+    def _build_listener_table(cls, auto_handle):
+        dispatcher = events.EventDispatcher()
+        cls._register_default_listeners(dispatcher)
+        # Capability negotiation is part of registering, so it's handled 
+        # even without auto_handle, and so is starting the reconnect 
+        # attempts over once registering has worked.
+        dispatcher["cap"].add_handler(_negotiate_capabilities)
+        dispatcher["welcome"].add_handler(_reset_reconnect_policy)
+        if auto_handle:
+            cls._add_built_in_handlers(dispatcher)
+        return dispatcher
+    
+    @classmethod
+    def _register_default_listeners(cls, dispatcher):
+        """ Registers the default listeners to the names listed in events.
+        They're only created once they are used. """
+        register_factory = dispatcher.register_factory
         
         # Connection events
         for name in events.connection:
-            self.events.register_listener(name, events.connection[name]())
+            register_factory(name, events.connection[name])
         
         # Standard events
         for name in events.standard:
-            self.events.register_listener(name, events.standard[name]())
+            register_factory(name, events.standard[name])
         
         # Message events
         for name in events.messages:
-            self.events.register_listener(name, events.messages[name]())
+            register_factory(name, events.messages[name])
         
         # CTCP events
         for name in events.ctcp:
-            self.events.register_listener(name, events.ctcp[name]())
+            register_factory(name, events.ctcp[name])
         
         # RPL_ events
         for name in events.replies:
-            self.events.register_listener(name, events.replies[name]())
+            register_factory(name, events.replies[name])
         
         # Custom listeners
-        for name in self.custom_listeners:
-            self.events.register_listener(name, self.custom_listeners[name])
+        for name in cls.custom_listeners:
+            dispatcher.register_listener(name, cls.custom_listeners[name])
     
-    
-    def _add_built_in_handlers(self):
+    @classmethod
+    def _add_built_in_handlers(cls, dispatcher):
         """ Adds basic client handlers.
         These handlers are bound to events that affect the data the the
         client handles. It is required to have these in order to keep
         track of things like client nick changes, joined channels, 
         and channel user lists.
         """
-        self.events["any"].add_handler(_update_client_info)
-        self.events["name_reply"].add_handler(_set_channel_names)
-        self.events["ctcp_version"].add_handler(_reply_to_ctcp_version)
-        self.events["part"].add_handler(_remove_channel_user_on_part)
-        self.events["quit"].add_handler(_remove_channel_user_on_quit)
-        self.events["join"].add_handler(_add_channel_user)
+        dispatcher["any"].add_handler(_update_client_info)
+        dispatcher["name_reply"].add_handler(_set_channel_names)
+        dispatcher["ctcp_version"].add_handler(_reply_to_ctcp_version)
+        dispatcher["part"].add_handler(_remove_channel_user_on_part)
+        dispatcher["quit"].add_handler(_remove_channel_user_on_quit)
+        dispatcher["join"].add_handler(_add_channel_user)
+        dispatcher["netsplit"].add_handler(_remove_split_users)
+        dispatcher["netjoin"].add_handler(_add_rejoined_users)
     
     
     def _dispatch_event(self, prefix, command, params):
@@ -98,6 +163,39 @@ class SimpleClient(object):
         primary event dispatcher.
         This replaces :func:`connection.Connection.handle_line`
         """
+        for event in self._build_events(prefix, command, params):
+            self.events.dispatch(self, event)
+    
+    
+    def _dispatch_batch(self, lines):
+        """ Builds the events for a list of ``(prefix, command, params)`` lines
+        and dispatches them together.
+        This replaces :func:`connection.Connection.handle_batch`
+        """
+        pending_events = []
+        build_events = self._build_events
+        for prefix, command, params in lines:
+            pending_events.extend(build_events(prefix, command, params))
+        self.events.dispatch_batch(self, pending_events)
+    
+    
+    def _dispatch_server_batch(self, batch_type, batch_params, lines):
+        """ Dispatches an IRCv3 batch as a single 
+        :class:`ircutils.events.BatchEvent`.
+        This replaces :func:`connection.Connection.handle_server_batch`
+        """
+        pending_events = []
+        build_events = self._build_events
+        for prefix, command, params in lines:
+            pending_events.extend(build_events(prefix, command, params))
+        if batch_type not in self.aggregated_batches:
+            self.events.dispatch_batch(self, pending_events)
+        event = events.BatchEvent(batch_type, batch_params, pending_events)
+        self.events.dispatch(self, event)
+    
+    
+    def _build_events(self, prefix, command, params):
+        """ Builds the list of events that a single line represents. """
         pending_events = []
         # TODO: Event parsing doesn't belong here.
         
@@ -121,21 +219,19 @@ class SimpleClient(object):
         else:
             pending_events.append(events.StandardEvent(prefix, command, params))
         
-        for event in pending_events:
-            self.events.dispatch(self, event)
+        return pending_events
     
     
     def connect(self, host, port=None, channel=None, use_ssl=False, 
-                password=None):
-        """ Connect to an IRC server. """
-        self.conn = connection.Connection()
-        self.conn.handle_line = self._dispatch_event
-        self.conn.connect(host, port, use_ssl, password)
-        self.conn.execute("USER", self.user, self._mode, "*", 
-                                  trailing=self.real_name)
-        self.conn.execute("NICK", self.nickname)
-        self.conn.handle_connect = self._handle_connect
-        self.conn.handle_close = self._handle_disconnect
+                password=None, ssl_context=None, certfile=None, keyfile=None):
+        """ Connect to an IRC server. The SSL options are passed on to
+        :meth:`ircutils.connection.Connection.connect`.
+        """
+        self._server = (host, port, use_ssl, password)
+        self._ssl_options = dict(ssl_context=ssl_context, certfile=certfile,
+                                 keyfile=keyfile)
+        self._quitting = False
+        self._open_connection(host, port, use_ssl, password)
         
         if channel is not None:
             # Builds a handler on-the-fly for joining init channels
@@ -149,21 +245,116 @@ class SimpleClient(object):
                 for channel in channels:
                     client.join_channel(channel)
             
-            self.events["welcome"].add_handler(_auto_joiner)
+            # Channels are tracked from then on, and rejoined after a 
+            # reconnect, so this is only needed once.
+            self.events["welcome"].add_handler(_auto_joiner, once=True)
+    
+    
+    def _open_connection(self, host, port, use_ssl, password):
+        """ Creates the connection and registers with the server. """
+        # Imported here so that clients which never connect, such as the
+        # ones that replay captures, don't pay for it.
+        from . import connection
+        self._bind_connection(connection.Connection())
+        self.conn.connect(host, port, use_ssl, password, **self._ssl_options)
+        self.server_capabilities = {}
+        self.enabled_capabilities = set()
+        self._sasl_buffer = []
+        self._negotiating = bool(self.capabilities or self.sasl is not None)
+        if self._negotiating:
+            # The server holds off registration until CAP END, so SASL is
+            # done before the client is welcomed.
+            self.conn.execute("CAP", "LS", "302")
+        self.conn.execute("USER", self.user, self._mode, "*", 
+                                  trailing=self.real_name)
+        self.conn.execute("NICK", self.nickname)
+    
+    
+    def _bind_connection(self, conn):
+        """ Makes ``conn`` the client's connection and routes its lines and
+        events to the client. """
+        self.conn = conn
+        conn.handle_line = self._dispatch_event
+        conn.handle_batch = self._dispatch_batch
+        conn.handle_server_batch = self._dispatch_server_batch
+        conn.handle_connect = self._handle_connect
+        conn.handle_close = self._handle_disconnect
+        conn.handle_lag = self._handle_lag
+        if self.metrics is not None:
+            self.metrics.attach_connection(conn)
     
     
     def is_connected(self):
         return self.conn.connected
     
+    @property
+    def lag(self):
+        """ The round trip time to the server in seconds, as measured by the 
+        connection's last keepalive PING. ``None`` until it's known. """
+        return self.conn.lag
+    
     def _handle_connect(self):
-        connection.Connection.handle_connect(self.conn)
+        type(self.conn).handle_connect(self.conn)
         event = events.ConnectionEvent("CONN_CONNECT")
         self.events.dispatch(self, event)
     
+    def _handle_lag(self, lag):
+        event = events.ConnectionEvent("CONN_LAG")
+        event.lag = lag
+        self.events.dispatch(self, event)
+    
     def _handle_disconnect(self):
-        connection.Connection.handle_close(self.conn)
+        type(self.conn).handle_close(self.conn)
         event = events.ConnectionEvent("CONN_DISCONNECT")
         self.events.dispatch(self, event)
+        if self.reconnect_policy is not None and not self._quitting:
+            self._schedule_reconnect()
+    
+    
+    def _schedule_reconnect(self):
+        """ Waits for the delay given by the reconnect policy and then 
+        reconnects. Does nothing if a reconnect is already pending or the 
+        policy has given up.
+        """
+        policy = self.reconnect_policy
+        if self._reconnect_timer is not None or not policy.should_retry():
+            return
+        delay = policy.next_delay()
+        self._reconnect_timer = timers.call_later(delay, self._reconnect)
+    
+    
+    def _reconnect(self):
+        """ Opens a new connection and replays the nickname, NickServ 
+        identification and channels once the server welcomes the client.
+        """
+        self._reconnect_timer = None
+        if self._quitting:
+            return
+        host, port, use_ssl, password = self._server
+        host, port = self.reconnect_policy.next_server(host, port)
+        if self._pending_replay is not None:
+            # The last attempt never got as far as the welcome, so its 
+            # channels still have to be rejoined.
+            handler, rejoin = self._pending_replay
+            self.events["welcome"].remove_handler(handler)
+        else:
+            rejoin = [(name, self._channel_keys.get(name)) 
+                      for name in self.channels]
+        self.channels.clear()
+        
+        def _replay_state(client, event):
+            client._pending_replay = None
+            if client._ns_password is not None:
+                client.identify(client._ns_password)
+            for channel, key in rejoin:
+                client.join_channel(channel, key)
+        
+        self.events["welcome"].add_handler(_replay_state, once=True)
+        self._pending_replay = (_replay_state, rejoin)
+        try:
+            self._open_connection(host, port, use_ssl, password)
+        except OSError:
+            self._schedule_reconnect()
     
     
     def register_listener(self, event_name, listener):
@@ -182,6 +373,7 @@ class SimpleClient(object):
         This assumes that NickServ is present on the server.
         
         """
+        self._ns_password = ns_password
         self.send_message("NickServ", "IDENTIFY {0}".format(ns_password))
     
     
@@ -194,10 +386,12 @@ class SimpleClient(object):
             client.join_channel("#channel_name", "channelkeyhere")
         """
         if channel == "0":
-            self.channels = []
+            self.channels.clear()
+            self._channel_keys.clear()
             self.conn.execute("JOIN", "0")
         else:
             if key is not None:
+                self._channel_keys[channel.lower()] = key
                 params = [channel, key]
             else:
                 params = [channel]
@@ -277,8 +471,12 @@ class SimpleClient(object):
         
             client.disconnect("Goodbye cruel world!")
         """
+        self._quitting = True
+        if self._reconnect_timer is not None:
+            self._reconnect_timer.cancel()
+            self._reconnect_timer = None
         self.conn.execute("QUIT", trailing=message)
-        self.channels = []
+        self.channels.clear()
         self.conn.close_when_done()
 
     
@@ -310,6 +508,64 @@ class SimpleClient(object):
 
 
 
+
+class ReconnectPolicy(object):
+    """ Decides when, and to which server, a client reconnects after losing its
+    connection. Set an instance as the client's ``reconnect_policy``::
+    
+        client.reconnect_policy = ReconnectPolicy(
+            servers=["irc.example.com", ("irc2.example.com", 6697)])
+    
+    The delay before each attempt grows from ``base_delay`` by ``factor`` up 
+    to ``max_delay`` seconds. The actual delay is picked at random between 
+    zero and that value, so that many clients that lost their connections at
+    the same time don't all reconnect at the same moment. The attempts start
+    over once the server welcomes the client. Each attempt moves on to the 
+    next server in ``servers``; without any, the client reconnects to the 
+    server it was connected to. After ``max_attempts`` failed attempts in a 
+    row the client stays disconnected.
+    """
+    
+    def __init__(self, servers=None, base_delay=2.0, max_delay=300.0, 
+                 factor=2.0, max_attempts=None):
+        self.servers = [(server, None) if isinstance(server, str) else server
+                        for server in (servers or [])]
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.factor = factor
+        self.max_attempts = max_attempts
+        self.attempts = 0
+        self._ceiling = None
+        self._server_index = -1
+    
+    def should_retry(self):
+        return self.max_attempts is None or self.attempts < self.max_attempts
+    
+    def next_delay(self):
+        """ Returns the delay before the next attempt and counts it. """
+        # The ceiling is grown a step at a time rather than recomputed as
+        # factor ** attempts, which overflows after enough attempts.
+        if self._ceiling is None:
+            ceiling = self.base_delay
+        else:
+            ceiling = self._ceiling * self.factor
+        self._ceiling = ceiling = min(self.max_delay, ceiling)
+        self.attempts += 1
+        return random.uniform(0, ceiling)
+    
+    def next_server(self, host, port):
+        """ Returns the ``(host, port)`` to try next. """
+        if not self.servers:
+            return host, port
+        self._server_index = (self._server_index + 1) % len(self.servers)
+        return self.servers[self._server_index]
+    
+    def reset(self):
+        self.attempts = 0
+        self._ceiling = None
+
+
+
 # TODO: UPDATE EVERYTHING HERE.
 
 def _reply_to_ctcp_version(client, event):
@@ -317,38 +573,47 @@ def _reply_to_ctcp_version(client, event):
     client.send_ctcp_reply(event.source, "VERSION", [version_info])
 
 
+# Replies that mean a channel couldn't be joined.
+_join_errors = frozenset([responses.ERR_INVITEONLYCHAN, 
+                          responses.ERR_CHANNELISFULL,
+                          responses.ERR_BANNEDFROMCHAN, 
+                          responses.ERR_BADCHANNELKEY,
+                          responses.ERR_TOOMANYCHANNELS, 
+                          responses.ERR_NOSUCHCHANNEL,
+                          responses.ERR_BADCHANMASK])
+
+
 def _update_client_info(client, event):
-    command = event.command
+    numeric = event.numeric
+    if numeric is None:
+        if event.command == "NICK" and event.source == client.nickname:
+            client.nickname = event.target
+        return
     params = event.params
-    if command == "RPL_WELCOME":
+    if numeric == responses.RPL_WELCOME:
         if client.nickname != event.target:
             client.nickname = event.target
-    if command == "ERR_ERRONEUSNICKNAME":
+    elif numeric == responses.ERR_ERRONEUSNICKNAME:
         client.set_nickname(protocol.filter_nick(client.nickname))
-    elif command == "ERR_NICKNAMEINUSE":
+    elif numeric == responses.ERR_NICKNAMEINUSE:
         client.set_nickname(client.nickname + "_")
-    elif command == "ERR_UNAVAILRESOURCE":
-        if not protocol.is_channel(event.params[0]):
-            client.nickname = client._prev_nickname
-    elif command == "NICK" and event.source == client.nickname:
-        client.nickname = event.target
-    
-    if command in ["ERR_INVITEONLYCHAN", "ERR_CHANNELISFULL",  "ERR_BANNEDFROMCHAN", 
-                   "ERR_BADCHANNELKEY", "ERR_TOOMANYCHANNELS", "ERR_NOSUCHCHANNEL"
-                   "ERR_BADCHANMASK"]:
+    elif numeric == responses.ERR_BANNICKCHANGE:
+        # 437 is ERR_UNAVAILRESOURCE in RFC 2812.
         channel_name = params[0].lower()
-        if channel_name in client.channels:
+        if not protocol.is_channel(channel_name):
+            client.nickname = client._prev_nickname
+        elif channel_name in client.channels:
             del client.channels[channel_name]
-    elif command == "ERR_UNAVAILRESOURCE":
+    elif numeric in _join_errors:
         channel_name = params[0].lower()
-        if protocol.is_channel(channel_name) and channel_name in client.channels:
+        if channel_name in client.channels:
             del client.channels[channel_name]
 
 
 def _set_channel_names(client, name_event):
     channel_name = name_event.channel.lower()
     client.channels[channel_name].name = channel_name
-    client.channels[channel_name].user_list = name_event.name_list
+    client.channels[channel_name].user_list = set(name_event.name_list)
 
 
 def _remove_channel_user_on_part(client, event):
@@ -362,9 +627,143 @@ def _remove_channel_user_on_part(client, event):
 def _remove_channel_user_on_quit(client, event):
     # TODO: This solution is slow. There might be a better one.
     for channel in list(client.channels.values()):
-        channel.user_list.remove(event.source)
+        channel.user_list.discard(event.source)
+
+
+def _remove_channel_users_on_quit(client, quit_events):
+    quitters = set(event.source for event in quit_events)
+    for channel in list(client.channels.values()):
+        channel.user_list.difference_update(quitters)
+
+_remove_channel_user_on_quit.batch = _remove_channel_users_on_quit
 
 
 def _add_channel_user(client, event):
     channel = event.target.lower()
     client.channels[channel].user_list.add(event.source)
+
+
+def _add_channel_users(client, join_events):
+    joined = collections.defaultdict(set)
+    for event in join_events:
+        joined[event.target.lower()].add(event.source)
+    for channel, users in joined.items():
+        client.channels[channel].user_list.update(users)
+
+_add_channel_user.batch = _add_channel_users
+
+
+def _remove_split_users(client, batch_event):
+    _remove_channel_users_on_quit(client, [event for event in batch_event.events
+                                           if event.command == "QUIT"])
+
+
+def _add_rejoined_users(client, batch_event):
+    _add_channel_users(client, [event for event in batch_event.events 
+                                if event.command == "JOIN"])
+
+
+def _reset_reconnect_policy(client, event):
+    if client.reconnect_policy is not None:
+        client.reconnect_policy.reset()
+
+
+def _negotiate_capabilities(client, event):
+    command = event.command
+    if command == "CAP":
+        _handle_cap(client, event)
+    elif command == "AUTHENTICATE":
+        _handle_authenticate(client, event)
+    elif command == "RPL_LOGGEDIN":
+        client.account = event.params[1]
+    elif command == "RPL_LOGGEDOUT":
+        client.account = None
+    elif command in ("RPL_SASLSUCCESS", "ERR_SASLFAIL", "ERR_SASLTOOLONG",
+                     "ERR_SASLABORTED", "ERR_SASLALREADY", "ERR_NICKLOCKED"):
+        _end_negotiation(client)
+
+
+def _parse_capabilities(text):
+    capabilities = {}
+    for token in text.split():
+        name, _, value = token.partition("=")
+        capabilities[name] = value
+    return capabilities
+
+
+def _handle_cap(client, event):
+    # CAP <target> <subcommand> [*] :<capabilities>
+    if not event.params:
+        return
+    subcommand = event.params[0].upper()
+    args = event.params[1:]
+    more = len(args) > 1 and args[0] == "*"
+    offered = _parse_capabilities(args[-1]) if args else {}
+    if subcommand == "LS":
+        client.server_capabilities.update(offered)
+        if not more and client._negotiating:
+            _request_capabilities(client, client.server_capabilities)
+    elif subcommand == "NEW":
+        client.server_capabilities.update(offered)
+        _request_capabilities(client, offered)
+    elif subcommand == "DEL":
+        for name in offered:
+            client.server_capabilities.pop(name, None)
+            client.enabled_capabilities.discard(name)
+    elif subcommand == "ACK":
+        for name in offered:
+            if name.startswith("-"):
+                client.enabled_capabilities.discard(name[1:])
+            else:
+                client.enabled_capabilities.add(name)
+        if more:
+            return
+        if "sasl" in offered and client.sasl is not None and \
+           client._negotiating:
+            client.sasl.start()
+            client.conn.execute("AUTHENTICATE", client.sasl.name)
+        else:
+            _end_negotiation(client)
+    elif subcommand == "NAK":
+        _end_negotiation(client)
+
+
+def _request_capabilities(client, offered):
+    wanted = [name for name in client.capabilities 
+              if name in offered and name not in client.enabled_capabilities]
+    if client._negotiating and client.sasl is not None and "sasl" in offered:
+        # A 3.2 server lists the mechanisms it supports.
+        mechanisms = offered["sasl"]
+        if not mechanisms or client.sasl.name in mechanisms.split(","):
+            wanted.append("sasl")
+    if wanted:
+        client.conn.execute("CAP", "REQ", trailing=" ".join(wanted))
+    else:
+        _end_negotiation(client)
+
+
+def _end_negotiation(client):
+    if client._negotiating:
+        client._negotiating = False
+        client.conn.execute("CAP", "END")
+
+
+def _handle_authenticate(client, event):
+    if client.sasl is None:
+        return
+    data = event.params[0] if event.params else "+"
+    if data != "+":
+        client._sasl_buffer.append(data)
+    if len(data) == 400:
+        # The challenge continues in the next message.
+        return
+    try:
+        challenge = base64.b64decode("".join(client._sasl_buffer))
+        response = client.sasl.respond(challenge)
+    except (sasl.SASLError, ValueError):
+        client.conn.execute("AUTHENTICATE", "*")
+        return
+    finally:
+        client._sasl_buffer = []
+    for chunk in sasl.encode_response(response):
+        client.conn.execute("AUTHENTICATE", chunk)
@@ -0,0 +1,242 @@
+""" This module provides command routing for :class:`ircutils.bot.SimpleBot`.
+Instead of parsing ``!command`` messages by hand, methods are marked with the
+:func:`command` decorator and the bot calls them with the parsed arguments::
+
+    from ircutils import bot, commands
+
+    class DiceBot(bot.SimpleBot):
+
+        @commands.command(aliases=["r"], rate=(3, 10))
+        def roll(self, event, sides: int = 6):
+            self.send_message(event.reply_to, str(random.randint(1, sides)))
+
+Commands are kept in a trie keyed on their names, so finding the command for
+a message only depends on the length of the name and not on how many commands
+there are.
+
+"""
+import inspect
+import shlex
+import time
+
+from . import protocol
+
+
+class Command(object):
+    """ A single command. ``func`` is called as ``func(client, event, *args)``
+    where ``args`` are the words following the command name. Arguments may
+    be quoted to include spaces. If a parameter of ``func`` is annotated
+    with a callable such as ``int``, the argument is converted with it.
+
+    ``rate`` limits how often each user may use the command, as a
+    ``(count, seconds)`` tuple.
+    """
+
+    def __init__(self, name, func, aliases=(), rate=None, help=None):
+        self.name = name
+        self.func = func
+        self.aliases = tuple(aliases)
+        self.rate = rate
+        self.help = help if help is not None else inspect.getdoc(func)
+        self.signature = inspect.signature(func)
+        self._converters = {}
+        for param in list(self.signature.parameters.values())[2:]:
+            if callable(param.annotation) and \
+               param.annotation is not inspect.Parameter.empty:
+                self._converters[param.name] = param.annotation
+
+    @property
+    def usage(self):
+        """ A short description of the arguments, like ``roll [sides]``. """
+        parts = [self.name]
+        for param in list(self.signature.parameters.values())[2:]:
+            if param.kind == param.VAR_POSITIONAL:
+                parts.append("[%s...]" % param.name)
+            elif param.default is param.empty:
+                parts.append("<%s>" % param.name)
+            else:
+                parts.append("[%s]" % param.name)
+        return " ".join(parts)
+
+    def bind(self, client, event, args):
+        """ Returns the arguments to call ``func`` with. Raises ``TypeError``
+        or ``ValueError`` if ``args`` don't fit the command.
+        """
+        bound = self.signature.bind(client, event, *args)
+        for name, convert in self._converters.items():
+            if name not in bound.arguments:
+                continue
+            value = bound.arguments[name]
+            if isinstance(value, tuple):
+                bound.arguments[name] = tuple(convert(v) for v in value)
+            else:
+                bound.arguments[name] = convert(value)
+        return bound.args, bound.kwargs
+
+
+
+def command(name=None, aliases=(), rate=None, help=None):
+    """ Marks a :class:`ircutils.bot.SimpleBot` method as a command. The
+    name defaults to the method's name. See :class:`Command` for the rest
+    of the arguments.
+    """
+    def decorator(func):
+        func.command = Command(name or func.__name__, func, aliases, rate,
+                               help)
+        return func
+    return decorator
+
+
+
+class _RateLimit(object):
+    """ A token bucket per user that allows ``count`` uses every ``per``
+    seconds. Buckets that have filled up again are the same as new ones, so
+    they're dropped every ``per`` seconds. """
+
+    def __init__(self, count, per):
+        self.count = count
+        self.per = per
+        self._buckets = {}
+        self._next_sweep = None
+
+    def _sweep(self, now):
+        rate = self.count / self.per
+        self._buckets = dict(
+            (key, bucket) for key, bucket in self._buckets.items()
+            if bucket[0] + (now - bucket[1]) * rate < self.count)
+        self._next_sweep = now + self.per
+
+    def allow(self, key, now):
+        if self._next_sweep is None or now >= self._next_sweep:
+            self._sweep(now)
+        allowance, last = self._buckets.get(key, (self.count, now))
+        allowance = min(self.count,
+                        allowance + (now - last) * self.count / self.per)
+        if allowance < 1:
+            self._buckets[key] = (allowance, now)
+            return False
+        self._buckets[key] = (allowance - 1, now)
+        return True
+
+
+
+class _TrieNode(object):
+    __slots__ = ("children", "command")
+
+    def __init__(self):
+        self.children = {}
+        self.command = None
+
+
+
+class CommandRouter(object):
+    """ Routes messages that start with ``prefix`` to their :class:`Command`.
+    Command names are matched case-insensitively unless ``case_sensitive`` is
+    set.
+    """
+
+    def __init__(self, prefix="!", case_sensitive=False):
+        self.prefix = prefix
+        self.case_sensitive = case_sensitive
+        self.commands = {}
+        self._root = _TrieNode()
+        self._rate_limits = {}
+
+    def __len__(self):
+        return len(self.commands)
+
+    def __contains__(self, name):
+        return self.lookup(name) is not None
+
+    def _key(self, name):
+        return name if self.case_sensitive else name.lower()
+
+    def add(self, command):
+        """ Adds a :class:`Command` under its name and aliases. """
+        names = (command.name,) + command.aliases
+        for name in names:
+            if self.lookup(name) is not None:
+                raise ValueError("A command named %r already exists." % name)
+        for name in names:
+            node = self._root
+            for char in self._key(name):
+                child = node.children.get(char)
+                if child is None:
+                    child = node.children[char] = _TrieNode()
+                node = child
+            node.command = command
+        self.commands[command.name] = command
+        if command.rate is not None:
+            self._rate_limits[command.name] = _RateLimit(*command.rate)
+
+    def remove(self, name):
+        """ Removes a command along with all of its aliases. """
+        command = self.commands.pop(name)
+        self._rate_limits.pop(name, None)
+        for alias in (command.name,) + command.aliases:
+            self._remove_name(self._root, self._key(alias), 0)
+
+    def _remove_name(self, node, key, depth):
+        """ Unsets the command for ``key`` and prunes nodes left empty. """
+        if depth == len(key):
+            node.command = None
+        else:
+            child = node.children[key[depth]]
+            self._remove_name(child, key, depth + 1)
+            if child.command is None and not child.children:
+                del node.children[key[depth]]
+
+    def lookup(self, name):
+        """ Returns the command or alias called ``name``, or ``None``. """
+        node = self._root
+        for char in self._key(name):
+            node = node.children.get(char)
+            if node is None:
+                return None
+        return node.command
+
+    def route(self, client, event):
+        """ Runs the command in ``event.message``, if there is one. Returns
+        ``True`` when a command was found.
+        """
+        text = event.message
+        if not text.startswith(self.prefix):
+            return False
+        # Walk the trie straight off the message text, so messages that
+        # don't name a command are rejected without splitting anything.
+        node = self._root
+        index = start = len(self.prefix)
+        length = len(text)
+        case_sensitive = self.case_sensitive
+        while index < length and text[index] != " ":
+            char = text[index] if case_sensitive else text[index].lower()
+            node = node.children.get(char)
+            if node is None:
+                return False
+            index += 1
+        command = node.command
+        if command is None or index == start:
+            return False
+
+        rate_limit = self._rate_limits.get(command.name)
+        if rate_limit is not None and \
+           not rate_limit.allow(event.source, time.monotonic()):
+            return True
+
+        rest = text[index:].strip()
+        try:
+            args = shlex.split(rest)
+        except ValueError:
+            args = rest.split()
+        try:
+            args, kwargs = command.bind(client, event, args)
+        except (TypeError, ValueError):
+            client.send_notice(event.source,
+                               "Usage: %s%s" % (self.prefix, command.usage))
+            return True
+        if protocol.is_channel(event.target):
+            event.reply_to = event.target
+        else:
+            event.reply_to = event.source
+        command.func(*args, **kwargs)
+        return True
@@ -4,18 +4,50 @@ connections.
 
 """
 import asyncore, asynchat
+import importlib.util
+import itertools
 import socket
+import time
 
-try:
-    import ssl
-except ImportError:
-    ssl_available = False
-else:
-    ssl_available = True
-    import errno
+# The ssl module takes a while to import, so it's only imported once an SSL
+# connection is made. See _import_ssl().
+ssl = None
+ssl_available = importlib.util.find_spec("_ssl") is not None
+
+
+def _import_ssl():
+    global ssl
+    if ssl is None:
+        import ssl as ssl_module
+        ssl = ssl_module
+    return ssl
 
 from . import protocol
+from . import resolver
 from . import responses
+from . import timers
+
+
+_ssl_contexts = {}
+_ssl_sessions = {}
+
+
+def get_ssl_context(certfile=None, keyfile=None):
+    """ Returns the SSL context for the given client certificate, creating it
+    the first time it's asked for. Every connection with the same certificate
+    shares one context, so certificates are only loaded once and TLS sessions
+    can be resumed when reconnecting. The context verifies the server's 
+    certificate against the system's trusted CAs.
+    
+    """
+    key = (certfile, keyfile)
+    context = _ssl_contexts.get(key)
+    if context is None:
+        context = _import_ssl().create_default_context()
+        if certfile is not None:
+            context.load_cert_chain(certfile, keyfile)
+        _ssl_contexts[key] = context
+    return context
 
 
 class Connection(asynchat.async_chat):
@@ -24,23 +56,77 @@ class Connection(asynchat.async_chat):
     the server as well as automatically handling PING requests.
    
     """
+    #: Size of the reusable buffer that each ``recv`` reads into.
+    recv_buffer_size = 65536
+    #: The longest line that's accepted, in bytes: 8191 bytes of tags plus
+    #: a 512 byte message. Anything longer is dropped.
+    max_line_length = 8703
+    #: Seconds between the PINGs the client sends to measure lag and detect
+    #: dead connections, or ``None`` to never send any.
+    keepalive_interval = 60.0
+    #: Seconds to wait for the PONG before the connection is closed.
+    keepalive_timeout = 30.0
+    #: The :class:`ircutils.metrics.Metrics` that lines are counted in, or
+    #: ``None``.
+    metrics = None
+    #: The most IRCv3 batches that may be open at once. Opening another one
+    #: gives up on the oldest, whose lines are handled as ordinary lines.
+    max_open_batches = 16
+    #: The most lines a batch may hold. A batch that grows past it is given 
+    #: up on the same way.
+    max_batch_lines = 10000
+    
+    _ping_tokens = itertools.count(1)
     
     def __init__(self, ipv6=False):
         asynchat.async_chat.__init__(self)
         self.ping_auto_respond = True
+        #: The round trip time of the last answered PING, in seconds.
+        self.lag = None
+        self._ping_token = None
+        self._ping_sent = None
+        self._keepalive_timer = None
+        self._pong_timer = None
         self.set_terminator(b"\r\n")
         self.collect_incoming_data = self._collect_incoming_data
-        if ipv6:
-            self.create_socket(socket.AF_INET6, socket.SOCK_STREAM)
-        else:
-            self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._recv_buffer = bytearray(self.recv_buffer_size)
+        self._recv_view = memoryview(self._recv_buffer)
+        self._partial_line = bytearray()
+        self._skipping_line = False
+        # IRCv3 batches that are still being received, by reference.
+        self._open_batches = {}
+        self._capture = None
+        self._capture_owned = False
+        # The socket is created once the host name has been resolved. With
+        # ``ipv6`` set, IPv6 addresses are tried first.
+        self._prefer_ipv6 = ipv6
+        self._pending_connect = None
+        self.use_ssl = False
+        self._handshaking = False
+        #: How many lines have been read so far.
+        self.lines_received = 0
+        #: While this is set, nothing more is read from the socket. See 
+        #: :meth:`pause_reading`.
+        self.reading_paused = False
     
     
-    def connect(self, hostname, port=None, use_ssl=False, password=None):
+    def connect(self, hostname, port=None, use_ssl=False, password=None,
+                ssl_context=None, certfile=None, keyfile=None):
         """ Create a connection to the specified host. If a port is given, it'll
         attempt to connect with that. A password may be specified and it'll
         be sent if the IRC server requires one.
         
+        The host name is resolved without blocking and every address it has
+        is tried using :class:`ircutils.resolver.HappyEyeballs`. Commands
+        executed in the meantime are sent once the connection is made. If 
+        it can't be made, :meth:`handle_close` is called.
+        
+        With ``use_ssl``, the TLS handshake is done on the loop as well, and
+        :meth:`handle_connect` is only called once it has finished. The 
+        context comes from :func:`get_ssl_context` unless ``ssl_context`` is 
+        given. ``certfile`` and ``keyfile`` name a client certificate, as used
+        by SASL EXTERNAL.
+        
         """
         self.hostname = hostname
         self.port = port
@@ -48,30 +134,292 @@ class Connection(asynchat.async_chat):
         if use_ssl and not ssl_available:
             raise ImportError("Python's SSL module is unavailable.")
         elif use_ssl:
+            _import_ssl()
             port = port or 7000
+            if ssl_context is None:
+                ssl_context = get_ssl_context(certfile, keyfile)
+            self.ssl_context = ssl_context
             self.send = self._ssl_send
             self.recv = self._ssl_recv
         else:
             port = port or 6667
-        asynchat.async_chat.connect(self, (hostname, port))
         if password is not None:
             self.execute("PASS", password)
+        pending = resolver.connect(hostname, port, self._handle_resolved,
+                                   prefer_ipv6=self._prefer_ipv6, map=self._map)
+        # The callback may already have run, e.g. on an immediate error, and
+        # handle_close may even have started a new attempt from it.
+        if not pending.finished:
+            self._pending_connect = pending
+    
+    
+    def _handle_resolved(self, sock, error):
+        """ Takes over the socket that won the connection race. """
+        self._pending_connect = None
+        if sock is None:
+            self.handle_close()
+            return
+        try:
+            self.addr = sock.getpeername()
+            if self.use_ssl:
+                sock = self._wrap_ssl(sock)
+        except (OSError, ValueError):
+            sock.close()
+            self.handle_close()
+            return
+        self.set_socket(sock)
+        if self.use_ssl:
+            self._do_handshake()
+        else:
+            self.handle_connect_event()
+    
+    
+    def _wrap_ssl(self, sock):
+        """ Wraps the socket for a handshake that's driven by the loop, 
+        offering the session from the last connection to the same server. """
+        self._session_key = (self.hostname, self.port)
+        self._handshaking = True
+        self._handshake_wants_write = False
+        session = None
+        cached = _ssl_sessions.get(self._session_key)
+        if cached is not None and cached[0] is self.ssl_context:
+            session = cached[1]
+        return self.ssl_context.wrap_socket(sock, 
+                                            server_hostname=self.hostname,
+                                            do_handshake_on_connect=False,
+                                            session=session)
+    
+    
+    def _do_handshake(self):
+        """ Takes the TLS handshake as far as it can go without blocking. """
+        try:
+            self.socket.do_handshake()
+        except ssl.SSLWantReadError:
+            self._handshake_wants_write = False
+            return
+        except ssl.SSLWantWriteError:
+            self._handshake_wants_write = True
+            return
+        except OSError:
+            self.handle_close()
+            return
+        self._handshaking = False
+        self._save_ssl_session()
+        self.handle_connect_event()
+    
+    
+    def _save_ssl_session(self):
+        sock = self.socket
+        if self.use_ssl and sock is not None and not self._handshaking:
+            session = sock.session
+            if session is not None:
+                _ssl_sessions[self._session_key] = (self.ssl_context, session)
+    
+    
+    def readable(self):
+        if self._handshaking:
+            return not self._handshake_wants_write
+        if self.reading_paused:
+            return False
+        return asynchat.async_chat.readable(self)
+    
+    
+    def pause_reading(self):
+        """ Stops reading from the socket until :meth:`resume_reading` is 
+        called. What the server sends meanwhile waits in the socket buffers,
+        and once they're full, TCP slows the server down. Keep pauses 
+        short: the server's PINGs aren't seen while reading is paused.
+        
+        """
+        self.reading_paused = True
+    
+    
+    def resume_reading(self):
+        """ Starts reading from the socket again. """
+        self.reading_paused = False
+    
+    
+    def writable(self):
+        if self._handshaking:
+            return self._handshake_wants_write
+        return asynchat.async_chat.writable(self)
+    
+    
+    def handle_read_event(self):
+        if self._handshaking:
+            self._do_handshake()
+        else:
+            asynchat.async_chat.handle_read_event(self)
+    
+    
+    def handle_write_event(self):
+        if self._handshaking:
+            self._do_handshake()
+        else:
+            asynchat.async_chat.handle_write_event(self)
+    
+    
+    def initiate_send(self):
+        # Hold on to the output until there is a socket to write it to and 
+        # the TLS handshake is done.
+        if self.socket is None or self._handshaking:
+            return
+        asynchat.async_chat.initiate_send(self)
     
     def send(self, data):
         if isinstance(data, str):
             data = data.encode('UTF-8', errors='ignore')
         return asynchat.async_chat.send(self, data)
     
+    def handle_read(self):
+        """ Reads whatever is available into the receive buffer and hands every
+        complete line to the parser in one pass. Do not call directly. """
+        partial = self._partial_line
+        while True:
+            received = self._recv_into(self._recv_view)
+            if not received:
+                return
+            partial += self._recv_view[:received]
+            # The SSL layer may already hold more decrypted data, which 
+            # select() can't see. Read it now rather than waiting for more.
+            if not self.use_ssl or not self.socket.pending():
+                break
+        if self._skipping_line:
+            start = partial.find(b"\r\n")
+            if start == -1:
+                # Keep the last byte, in case it's the \r of the \r\n.
+                del partial[:-1]
+                return
+            del partial[:start + 2]
+            self._skipping_line = False
+        end = partial.rfind(b"\r\n")
+        raw_lines = None
+        if end != -1:
+            raw_lines = partial[:end].split(b"\r\n")
+            del partial[:end + 2]
+        if len(partial) > self.max_line_length:
+            # Don't buffer a line without end; skip to wherever it stops.
+            del partial[:-1]
+            self._skipping_line = True
+        if raw_lines is not None:
+            self._handle_raw_lines(raw_lines)
+    
+    
     def found_terminator(self):
         """ Activated when ``\\r\\n`` is encountered. Do not call directly. """
-        data = b"".join(self.incoming).decode('UTF-8', errors='ignore')
+        data = b"".join(self.incoming)
         self.incoming = []
-        prefix, command, params = protocol.parse_line(data)
-        if command == "PING" and self.ping_auto_respond:
-            self.execute("PONG", *params)
-        if command.isdigit():
-            command = responses.from_digit(command)
-        self.handle_line(prefix, command, params)
+        self._handle_raw_lines([data])
+    
+    
+    def _handle_raw_lines(self, raw_lines):
+        """ Parses a list of raw lines and passes them to :meth:`handle_batch`.
+        PING requests are answered here, before any of the lines are handled.
+        
+        """
+        if self._capture is not None:
+            stamp = b"%.6f " % time.time()
+            self._capture.write(b"".join(stamp + line + b"\n" 
+                                         for line in raw_lines))
+        self.lines_received += len(raw_lines)
+        metrics = self.metrics
+        if metrics is not None:
+            metrics.bytes_received.inc(amount=sum(map(len, raw_lines)) + 
+                                              2 * len(raw_lines))
+        parse_line = protocol.parse_line
+        numerics = responses.by_digits
+        auto_pong = self.ping_auto_respond
+        open_batches = self._open_batches
+        lines = []
+        for raw_line in raw_lines:
+            if not raw_line:
+                continue
+            data = raw_line.decode('UTF-8', errors='ignore')
+            batch = None
+            if data[0] == "@" and open_batches:
+                tags = protocol.parse_tags(data[1:data.find(" ")])
+                reference = tags.get("batch")
+                batch = open_batches.get(reference)
+                if batch is not None and \
+                   len(batch[2]) >= self.max_batch_lines:
+                    lines.extend(open_batches.pop(reference)[2])
+                    batch = None
+            prefix, command, params = parse_line(data)
+            if metrics is not None:
+                metrics.lines_received.inc(command)
+            if command == "PING" and auto_pong:
+                self.execute("PONG", *params, urgent=True)
+            elif command == "PONG" and params and \
+                 params[-1] == self._ping_token:
+                self._handle_pong()
+            elif command == "BATCH" and params and \
+                 params[0][:1] in ("+", "-"):
+                reference = params[0][1:]
+                if params[0][0] == "+":
+                    if len(open_batches) >= self.max_open_batches:
+                        oldest = next(iter(open_batches))
+                        lines.extend(open_batches.pop(oldest)[2])
+                    batch_type = params[1] if len(params) > 1 else None
+                    open_batches[reference] = (batch_type, params[2:], [])
+                    continue
+                batch = open_batches.pop(reference, None)
+                if batch is not None:
+                    # Whatever came before the batch is handled first.
+                    if lines:
+                        self.handle_batch(lines)
+                        lines = []
+                    self.handle_server_batch(*batch)
+                continue
+            # Numerics become their responses.Numeric, everything else 
+            # stays as it is.
+            command = numerics.get(command, command)
+            if batch is not None:
+                batch[2].append((prefix, command, params))
+            else:
+                lines.append((prefix, command, params))
+        if lines:
+            self.handle_batch(lines)
+    
+    
+    def _recv_into(self, buffer):
+        """ Like ``recv()`` but it fills ``buffer`` instead of allocating a new
+        bytes object. Returns the number of bytes read. """
+        try:
+            received = self.socket.recv_into(buffer)
+        except OSError as why:
+            if self.use_ssl and isinstance(why, (ssl.SSLWantReadError,
+                                                 ssl.SSLWantWriteError)):
+                # Required in order to keep it non-blocking
+                return 0
+            if why.errno in asyncore._DISCONNECTED:
+                self.handle_close()
+                return 0
+            raise
+        if not received:
+            self.handle_close()
+        return received
+    
+    
+    def start_capture(self, capture):
+        """ Records every line received from now on, along with the time it 
+        arrived, so it can be played back with :mod:`ircutils.replay`. 
+        ``capture`` is a file name or a file opened in binary mode.
+        
+        """
+        self.stop_capture()
+        if isinstance(capture, str):
+            capture = open(capture, "ab")
+            self._capture_owned = True
+        self._capture = capture
+    
+    
+    def stop_capture(self):
+        """ Stops recording. A capture file opened by :meth:`start_capture`
+        is closed. """
+        if self._capture is not None and self._capture_owned:
+            self._capture.close()
+        self._capture = None
+        self._capture_owned = False
     
     
     def execute(self, command, *params, **kwargs):
@@ -80,14 +428,39 @@ class Connection(asynchat.async_chat):
         
             >>> self.execute("PRIVMSG", "#channel", trailing="Hello!")
         
+        With ``urgent=True`` the line is sent with :meth:`push_urgent`.
+        
         """
         params = [x for x in params if x is not None]
         if "trailing" in kwargs:
             params = list(params)
             if kwargs["trailing"] is not None:
                 params.append(":%s" % kwargs["trailing"])
-        cmd_line = "%s %s\r\n" % (command.upper(), " ".join(params))
-        self.push(bytes(cmd_line, 'UTF-8', errors='ignore'))
+        command = command.upper()
+        cmd_line = bytes("%s %s\r\n" % (command, " ".join(params)), 'UTF-8',
+                         errors='ignore')
+        if self.metrics is not None:
+            self.metrics.lines_sent.inc(command)
+            self.metrics.bytes_sent.inc(amount=len(cmd_line))
+        if kwargs.get("urgent"):
+            self.push_urgent(cmd_line)
+        else:
+            self.push(cmd_line)
+    
+    
+    def push_urgent(self, data):
+        """ Like ``push()``, but ``data`` goes ahead of everything else that 
+        is waiting to be sent, so that replies such as PONG aren't held up 
+        behind a long queue. Only the line that's already being written is 
+        sent first. 
+        
+        """
+        fifo = self.producer_fifo
+        if fifo:
+            fifo.insert(1, data)
+        else:
+            fifo.append(data)
+        self.initiate_send()
     
     
     def handle_error(self):
@@ -95,12 +468,100 @@ class Connection(asynchat.async_chat):
               # that asyncore uses.
     
     
+    def handle_connect_event(self):
+        asynchat.async_chat.handle_connect_event(self)
+        if self.keepalive_interval is not None:
+            self._keepalive_timer = timers.call_later(self.keepalive_interval, 
+                                                      self._send_keepalive)
+    
+    
+    def close(self):
+        if self._pending_connect is not None:
+            self._pending_connect.cancel()
+            self._pending_connect = None
+        # TLS 1.3 servers send the session ticket after the handshake, so
+        # the session is saved once more on the way out.
+        self._save_ssl_session()
+        for timer in (self._keepalive_timer, self._pong_timer):
+            if timer is not None:
+                timer.cancel()
+        self._keepalive_timer = self._pong_timer = None
+        # Batches that were never closed won't be now.
+        self._open_batches.clear()
+        del self._partial_line[:]
+        self._skipping_line = False
+        self.stop_capture()
+        asynchat.async_chat.close(self)
+    
+    
+    def _send_keepalive(self):
+        """ Sends a PING and waits for the matching PONG. """
+        self._keepalive_timer = timers.call_later(self.keepalive_interval, 
+                                                  self._send_keepalive)
+        if self._pong_timer is not None:
+            # Still waiting on the last one.
+            return
+        self._ping_token = "ircutils-%d" % next(self._ping_tokens)
+        self._ping_sent = time.monotonic()
+        self.execute("PING", trailing=self._ping_token)
+        self._pong_timer = timers.call_later(self.keepalive_timeout, 
+                                             self._handle_keepalive_timeout)
+    
+    
+    def _handle_pong(self):
+        self.lag = time.monotonic() - self._ping_sent
+        self._ping_token = None
+        if self._pong_timer is not None:
+            self._pong_timer.cancel()
+            self._pong_timer = None
+        self.handle_lag(self.lag)
+    
+    
+    def _handle_keepalive_timeout(self):
+        """ The server didn't answer in time, so the connection is 
+        considered dead. """
+        self._pong_timer = None
+        self.handle_close()
+    
+    
+    def handle_lag(self, lag):
+        """ This gets called with the round trip time, in seconds, each time
+        the server answers one of the client's PINGs. It is meant to be 
+        replaced.
+        
+        """
+        pass
+    
+    
     def handle_connect(self):
-        """ Initializes SSL support after the connection has been made. This is used
-        internally. Do not call this yourself. """
-        if self.use_ssl:
-            self.ssl = ssl.wrap_socket(self.socket)
-            self.set_socket(self.ssl)
+        """ This gets called once the connection has been made and, for SSL
+        connections, the handshake is done. It is meant to be replaced.
+        
+        """
+        pass
+    
+    
+    def handle_batch(self, lines):
+        """ This gets called with every line that was read in one go, as a list
+        of ``(prefix, command, params)`` tuples. By default it just calls 
+        :meth:`handle_line` for each of them. Replace it if the lines can be 
+        handled more efficiently as a group.
+        
+        """
+        handle_line = self.handle_line
+        for prefix, command, params in lines:
+            handle_line(prefix, command, params)
+    
+    
+    def handle_server_batch(self, batch_type, params, lines):
+        """ This gets called when the server closes an IRCv3 ``BATCH``, such 
+        as a netsplit or a chathistory playback. ``lines`` has every line
+        that was tagged with the batch, in the same form as for
+        :meth:`handle_batch`. By default they're simply passed on to 
+        :meth:`handle_batch`.
+        
+        """
+        self.handle_batch(lines)
     
     
     def handle_line(self, prefix, command, params):
@@ -119,37 +580,36 @@ class Connection(asynchat.async_chat):
         ``ircutils.start_all()`` after they have been instantiated.
         
         """
-        asyncore.loop(map=self._map)
+        timers.loop(map=self._map)
     
     
     def _ssl_send(self, data):
         """ Replacement for self.send() during SSL connections. """
+        if isinstance(data, str):
+            data = data.encode('UTF-8', errors='ignore')
         try:
-            result = self.write(data)
-            return result
-        except ssl.SSLError as why:
-            if why[0] == asyncore.EWOULDBLOCK:
-                return 0
-            else:
-                raise ssl.SSLError(why)
+            return self.socket.send(data)
+        except (ssl.SSLWantReadError, ssl.SSLWantWriteError):
             return 0
+        except OSError as why:
+            if why.errno in asyncore._DISCONNECTED:
+                self.handle_close()
+                return 0
+            raise
         
         
     def _ssl_recv(self, buffer_size):
         """ Replacement for self.recv() during SSL connections. """
         try:
-            data = self.read(buffer_size)
-            if not data:
+            data = self.socket.recv(buffer_size)
+        except (ssl.SSLWantReadError, ssl.SSLWantWriteError):
+            # Required in order to keep it non-blocking
+            return b''
+        except OSError as why:
+            if why.errno in asyncore._DISCONNECTED:
                 self.handle_close()
-                return ''
-            return data
-        except ssl.SSLError as why:
-            if why[0] in [asyncore.ECONNRESET, asyncore.ENOTCONN, 
-                          asyncore.ESHUTDOWN]:
-                self.handle_close()
-                return ''
-            elif why[0] == errno.ENOENT:
-                # Required in order to keep it non-blocking
-                return ''
-            else:
-                raise
\ No newline at end of file
+                return b''
+            raise
+        if not data:
+            self.handle_close()
+        return data
@@ -0,0 +1,788 @@
+""" This module does DCC (Direct Client-to-Client): files and chats that go
+straight from one user to another rather than through the IRC server. A
+:class:`DCCManager` is attached to a client. It makes and accepts the
+connections on the same loop as the client, and answers the ``RESUME``,
+``ACCEPT`` and passive ``SEND`` and ``CHAT`` replies to its own requests
+itself::
+
+    from ircutils import bot, dcc
+
+    manager = dcc.DCCManager(download_dir="downloads", max_transfers=4)
+
+    class FileBot(bot.SimpleBot):
+
+        def on_dcc(self, event):
+            offer = dcc.parse_offer(event)
+            if offer is not None:
+                manager.accept(self, offer)
+
+        def on_dcc_chat(self, event):
+            if event.message is not None:
+                event.chat.send_line("You said: " + event.message)
+
+        def on_dcc_transfer(self, event):
+            print(event.transfer, event.error)
+
+    file_bot = FileBot("FileBot")
+    manager.attach(file_bot)
+    file_bot.connect("irc.example.net", channel="#ircutils")
+    file_bot.start()
+
+Files are sent with ``os.sendfile``, so they go from the disk to the socket
+without being copied through Python. Received files are read into a buffer
+of ``buffer_size`` bytes and written out straight away, so a transfer never
+holds more than that in memory. Transfers beyond ``max_transfers`` wait
+until one of the others finishes.
+
+"""
+import asyncore, asynchat
+import collections
+import errno
+import itertools
+import os
+import socket
+import struct
+import sys
+
+from . import events
+from . import protocol
+from . import timers
+
+
+_sendfile = getattr(os, "sendfile", None)
+_ack = struct.Struct("!I")
+
+
+class Offer(object):
+    """ A DCC request from another user, as returned by :func:`parse_offer`.
+    ``kind`` is ``"SEND"``, ``"CHAT"``, ``"RESUME"`` or ``"ACCEPT"``.
+    """
+
+    def __init__(self, kind, source, filename, host=None, port=0, size=None,
+                 position=None, token=None):
+        self.kind = kind
+        #: The nickname of the user the request came from.
+        self.source = source
+        #: The name of the file, or ``"chat"`` for a chat.
+        self.filename = filename
+        #: The address to connect to, for SEND and CHAT.
+        self.host = host
+        self.port = port
+        #: The size of the file in bytes, if it was given.
+        self.size = size
+        #: The byte to carry on from, for RESUME and ACCEPT.
+        self.position = position
+        #: The token of a passive request.
+        self.token = token
+
+    @property
+    def passive(self):
+        """ Whether the other user can't be connected to, and will connect
+        instead once they are told where to. """
+        return self.port == 0 and self.token is not None
+
+    def __repr__(self):
+        return "<Offer %s %r from %s at %s:%s>" % (self.kind, self.filename,
+                                                   self.source, self.host,
+                                                   self.port)
+
+
+def parse_offer(event):
+    """ Returns an :class:`Offer` for a ``CTCP_DCC`` event, or ``None`` if it
+    isn't a request that's understood. """
+    params = _split_params(event.params)
+    if len(params) < 3:
+        return None
+    kind = params[0].upper()
+    try:
+        if kind == "SEND":
+            # SEND <file> <ip> <port> [<size> [<token>]]
+            return Offer(kind, event.source, params[1], _parse_host(params[2]),
+                         int(params[3]),
+                         size=int(params[4]) if len(params) > 4 else None,
+                         token=params[5] if len(params) > 5 else None)
+        if kind == "CHAT":
+            # CHAT chat <ip> <port> [<token>]
+            return Offer(kind, event.source, params[1], _parse_host(params[2]),
+                         int(params[3]),
+                         token=params[4] if len(params) > 4 else None)
+        if kind in ("RESUME", "ACCEPT"):
+            # RESUME <file> <port> <position> [<token>]
+            return Offer(kind, event.source, params[1], port=int(params[2]),
+                         position=int(params[3]),
+                         token=params[4] if len(params) > 4 else None)
+    except (IndexError, ValueError, OSError, OverflowError):
+        pass
+    return None
+
+
+def _split_params(params):
+    """ Splits the parameters of a DCC request again, keeping a quoted file
+    name that has spaces in it together. """
+    text = " ".join(params)
+    split = []
+    while True:
+        text = text.lstrip(" ")
+        if not text:
+            return split
+        if text[0] == '"':
+            end = text.find('"', 1)
+            if end != -1:
+                split.append(text[1:end])
+                text = text[end + 1:]
+                continue
+        word, space, text = text.partition(" ")
+        split.append(word)
+
+
+def _parse_host(value):
+    if ":" in value or "." in value:
+        return value
+    return protocol.ascii_to_ip(value)
+
+
+def _format_host(host):
+    if ":" in host:
+        return host
+    return str(protocol.ip_to_ascii(host))
+
+
+def _quote(filename):
+    if " " in filename:
+        return '"%s"' % filename
+    return filename
+
+
+def _safe_filename(filename):
+    """ Returns the last part of a received file name, so that a file can't
+    be written outside of the download directory. """
+    filename = os.path.basename(filename.replace("\\", "/"))
+    if filename in ("", ".", ".."):
+        return "unnamed"
+    return filename
+
+
+
+class _Endpoint(object):
+    """ Making or taking the connection, which transfers and chats share. """
+    status = "queued"
+    _timer = None
+
+    def _listen(self):
+        """ Listens on a port of the manager's, and returns it. """
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        ports = self.manager.ports or (0,)
+        for port in ports:
+            try:
+                self.bind((self.manager.bind_host, port))
+                break
+            except OSError:
+                if port == ports[-1]:
+                    raise
+        self.listen(1)
+        self.status = "waiting"
+        self._wait()
+        return self.socket.getsockname()[1]
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is None:
+            return
+        listening = self.socket
+        self.del_channel()
+        listening.close()
+        self.accepting = False
+        pair[0].setblocking(False)
+        self.set_socket(pair[0])
+        self.connected = True
+        self._cancel_timer()
+        self._start()
+
+    def _connect(self, host, port):
+        family = socket.AF_INET6 if ":" in host else socket.AF_INET
+        self.create_socket(family, socket.SOCK_STREAM)
+        self.status = "waiting"
+        self._wait()
+        self.connect((host, port))
+
+    def handle_connect(self):
+        self._cancel_timer()
+        self._start()
+
+    def _wait(self):
+        self._timer = timers.call_later(self.manager.timeout, self._timed_out)
+
+    def _timed_out(self):
+        self._timer = None
+        self._finish(TimeoutError("No connection was made within %s seconds"
+                                  % self.manager.timeout))
+
+    def _cancel_timer(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def handle_error(self):
+        self._finish(sys.exc_info()[1])
+
+
+
+class Transfer(_Endpoint, asyncore.dispatcher):
+    """ A file being sent or received. Its ``status`` is ``"queued"`` while
+    it waits for a free slot, ``"waiting"`` until the connection is made,
+    then ``"active"``, and finally ``"done"`` or ``"failed"``.
+    """
+    #: Whether the file is being sent rather than received.
+    outgoing = False
+
+    def __init__(self, manager, client, nick, filename, path, size):
+        asyncore.dispatcher.__init__(self, map=manager.map)
+        self.manager = manager
+        self.client = client
+        #: The nickname of the other user.
+        self.nick = nick
+        #: The name the file is offered under.
+        self.filename = filename
+        #: Where the file is on disk.
+        self.path = path
+        #: The size of the file in bytes, or ``None`` if it isn't known.
+        self.size = size
+        #: The byte of the file the transfer started at, when resuming.
+        self.position = 0
+        #: How many bytes have gone through the connection.
+        self.transferred = 0
+        #: Why the transfer failed, if it did.
+        self.error = None
+        self.port = None
+        self.token = None
+        self._file = None
+
+    def writable(self):
+        return not self.connected and not self.accepting
+
+    def handle_close(self):
+        self._finish(None)
+
+    def cancel(self):
+        """ Stops the transfer. """
+        self._finish(ConnectionAbortedError("The transfer was cancelled."))
+
+    def _finish(self, error):
+        if self.status in ("done", "failed"):
+            return
+        self.status = "failed" if error is not None else "done"
+        self.error = error
+        self._cancel_timer()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self.close()
+        self.manager._finished(self)
+
+    def __repr__(self):
+        return "<%s %r %s %s: %s/%s bytes>" % (
+            self.__class__.__name__, self.filename,
+            "to" if self.outgoing else "from", self.nick,
+            self.position + self.transferred, self.size)
+
+
+class FileSend(Transfer):
+    """ A file being sent, with ``os.sendfile`` where there is one. """
+    outgoing = True
+    #: The most bytes handed to the socket in one go.
+    chunk_size = 1 << 20
+
+    def __init__(self, manager, client, nick, path):
+        Transfer.__init__(self, manager, client, nick,
+                          os.path.basename(path), path,
+                          os.path.getsize(path))
+        self._offset = 0
+        self._acked = 0
+        self._partial_ack = b""
+        self._use_sendfile = _sendfile is not None
+
+    def _start(self):
+        self.manager._forget_offer(self)
+        self.status = "active"
+        self._file = open(self.path, "rb")
+        self._offset = self.position
+
+    def writable(self):
+        if not self.connected:
+            return not self.accepting
+        return self.status == "active" and self._offset < self.size
+
+    def handle_write(self):
+        count = min(self.chunk_size, self.size - self._offset)
+        try:
+            if self._use_sendfile:
+                sent = _sendfile(self.socket.fileno(), self._file.fileno(),
+                                 self._offset, count)
+            else:
+                self._file.seek(self._offset)
+                sent = self.socket.send(self._file.read(
+                    min(count, self.manager.buffer_size)))
+        except BlockingIOError:
+            return
+        except OSError as error:
+            if self._use_sendfile and error.errno in (errno.EINVAL,
+                                                      errno.ENOSYS,
+                                                      errno.ENOTSOCK):
+                # Not every kind of file or socket can be used with it.
+                self._use_sendfile = False
+                return
+            raise
+        self._offset += sent
+        self.transferred += sent
+
+    def handle_read(self):
+        # The receiver acknowledges how much it has with 4-byte counts.
+        data = self._partial_ack + self.recv(4096)
+        end = len(data) - len(data) % 4
+        self._partial_ack = data[end:]
+        if end:
+            self._acked = _ack.unpack_from(data, end - 4)[0]
+            if self._offset >= self.size and \
+               self._acked == self.size & 0xFFFFFFFF:
+                self._finish(None)
+
+    def handle_close(self):
+        if self.status == "active" and self._offset >= self.size:
+            self._finish(None)
+        else:
+            self._finish(ConnectionResetError("The connection was closed "
+                                              "before the file was sent."))
+
+
+class FileReceive(Transfer):
+    """ A file being received, through a buffer of the manager's
+    ``buffer_size``. """
+
+    def __init__(self, manager, client, offer, path):
+        Transfer.__init__(self, manager, client, offer.source,
+                          offer.filename, path, offer.size)
+        self.offer = offer
+        #: Whether a smaller file that's already at ``path`` is carried on
+        #: from where it ends, rather than written over.
+        self.resume = True
+        self._buffer = None
+        # The acknowledgements that are still to be sent, and how many bytes
+        # of them have been sent altogether.
+        self._acks = bytearray()
+        self._acks_sent = 0
+        self._complete = False
+
+    def _start(self):
+        self.status = "active"
+        if self.position:
+            self._file = open(self.path, "r+b")
+            self._file.truncate(self.position)
+            self._file.seek(self.position)
+        else:
+            self._file = open(self.path, "wb")
+        self._buffer = bytearray(self.manager.buffer_size)
+        self._view = memoryview(self._buffer)
+
+    def handle_read(self):
+        if self._buffer is None:
+            return
+        try:
+            count = self.socket.recv_into(self._buffer)
+        except BlockingIOError:
+            return
+        if not count:
+            self.handle_close()
+            return
+        self._file.write(self._view[:count])
+        self.transferred += count
+        received = self.position + self.transferred
+        self._queue_ack(received)
+        if self.size is not None and received >= self.size:
+            self._complete = True
+        self.handle_write()
+
+    def _queue_ack(self, received):
+        """ Queues the count of bytes received. Every count says how much
+        has arrived so far, so only the newest one that hasn't started 
+        going out is kept. A count that's partly sent is always finished,
+        so the sender reads whole counts. """
+        acks = self._acks
+        partial = self._acks_sent % 4
+        del acks[4 - partial if partial else 0:]
+        acks += _ack.pack(received & 0xFFFFFFFF)
+
+    def writable(self):
+        if not self.connected:
+            return not self.accepting
+        return bool(self._acks)
+
+    def handle_write(self):
+        if self._acks:
+            sent = self.send(self._acks)
+            del self._acks[:sent]
+            self._acks_sent += sent
+        if self._complete and not self._acks:
+            self._finish(None)
+
+    def handle_close(self):
+        if self.status == "active" and \
+           (self.size is None or self.position + self.transferred >= self.size):
+            self._finish(None)
+        else:
+            self._finish(ConnectionResetError("The connection was closed "
+                                              "before the file was received."))
+
+
+
+class DCCChat(_Endpoint, asynchat.async_chat):
+    """ A chat with another user. Every line received is dispatched to the
+    client as a ``CONN_DCC_CHAT`` event, and one with a ``message`` of
+    ``None`` when the chat ends. """
+    #: The longest line that's read, in bytes. Longer ones end the chat.
+    max_line_length = 8192
+
+    def __init__(self, manager, client, nick):
+        asynchat.async_chat.__init__(self, map=manager.map)
+        self.manager = manager
+        self.client = client
+        #: The nickname of the other user.
+        self.nick = nick
+        self.token = None
+        #: Why the chat ended, if it wasn't closed normally.
+        self.error = None
+        self.set_terminator(b"\n")
+        self.incoming = []
+        self._received = 0
+
+    def _start(self):
+        self.manager._forget_offer(self)
+        self.status = "active"
+
+    def send_line(self, text):
+        """ Sends a line of text. """
+        self.push(text.encode("UTF-8") + b"\n")
+
+    def collect_incoming_data(self, data):
+        self._received += len(data)
+        if self._received > self.max_line_length:
+            self._finish(ValueError("A line was too long."))
+            return
+        self.incoming.append(data)
+
+    def found_terminator(self):
+        line = b"".join(self.incoming).rstrip(b"\r").decode("UTF-8",
+                                                             "replace")
+        self.incoming = []
+        self._received = 0
+        self._dispatch(line)
+
+    def handle_close(self):
+        self._finish(None)
+
+    def end(self):
+        """ Ends the chat once everything has been sent. """
+        self.close_when_done()
+
+    def writable(self):
+        return not self.accepting and asynchat.async_chat.writable(self)
+
+    def close(self):
+        if self.status in ("done", "failed"):
+            asynchat.async_chat.close(self)
+        else:
+            self._finish(None)
+
+    def _finish(self, error):
+        if self.status in ("done", "failed"):
+            return
+        self.status = "failed" if error is not None else "done"
+        self.error = error
+        self._cancel_timer()
+        asynchat.async_chat.close(self)
+        self.manager._chat_ended(self)
+        self._dispatch(None)
+
+    def _dispatch(self, message):
+        event = events.ConnectionEvent("CONN_DCC_CHAT")
+        event.source = self.nick
+        event.chat = self
+        event.message = message
+        self.client.events.dispatch(self.client, event)
+
+
+
+class DCCManager(object):
+    """ Makes and accepts DCC connections for the clients it's attached to.
+    Files are received into ``download_dir``. At most ``max_transfers``
+    files are sent or received at once. ``host`` is the address other users
+    are told to connect to; it's the address of the client's connection to
+    the server unless it's given, which only works when that isn't behind
+    NAT. Incoming connections are taken on ``ports``, a sequence of port
+    numbers, or on any free port. A connection that isn't made within
+    ``timeout`` seconds is given up on.
+    """
+
+    def __init__(self, download_dir=".", max_transfers=4, host=None,
+                 ports=None, timeout=120.0, buffer_size=65536, map=None):
+        self.download_dir = download_dir
+        self.max_transfers = max_transfers
+        self.host = host
+        self.bind_host = ""
+        self.ports = tuple(ports) if ports is not None else None
+        self.timeout = timeout
+        self.buffer_size = buffer_size
+        self.map = map
+        #: The transfers that are waiting for a connection or active.
+        self.transfers = []
+        #: The chats that haven't ended.
+        self.chats = []
+        self._queue = collections.deque()
+        # Our requests that are waiting for a reply, by the kind of reply 
+        # and its port or token.
+        self._offers = {}
+        self._tokens = itertools.count(1)
+
+    def attach(self, client):
+        """ Starts answering the replies to the requests made for
+        ``client``. """
+        client.events["dcc"].add_handler(self._handle_dcc, priority=-1)
+
+    def detach(self, client):
+        """ Stops answering for ``client``. """
+        client.events["dcc"].remove_handler(self._handle_dcc)
+
+    # --------------------------------------------------------------------------
+    # Requests from other users
+    # --------------------------------------------------------------------------
+
+    def accept(self, client, offer):
+        """ Accepts a SEND or CHAT :class:`Offer` and returns the
+        :class:`FileReceive` or :class:`DCCChat`. ``None`` is returned for
+        the other kinds, and for replies to the manager's own requests. """
+        if self._reply_to(offer) is not None:
+            return None
+        if offer.kind == "SEND":
+            return self.receive(client, offer)
+        if offer.kind == "CHAT":
+            return self.accept_chat(client, offer)
+        return None
+
+    def receive(self, client, offer, path=None, resume=True):
+        """ Receives the file of a SEND :class:`Offer` into ``path``, or into
+        the download directory under the name it was offered with. With
+        ``resume``, a smaller file that's already there is carried on from
+        where it ends. """
+        if path is None:
+            path = os.path.join(self.download_dir,
+                                _safe_filename(offer.filename))
+        transfer = FileReceive(self, client, offer, path)
+        transfer.resume = resume
+        transfer.port = offer.port
+        transfer.token = offer.token
+        self._start_or_queue(transfer)
+        return transfer
+
+    def accept_chat(self, client, offer):
+        """ Accepts a CHAT :class:`Offer` and returns the :class:`DCCChat`.
+        """
+        chat = DCCChat(self, client, offer.source)
+        self.chats.append(chat)
+        try:
+            if offer.passive:
+                chat.token = offer.token
+                port = chat._listen()
+                self._send(client, offer.source, "CHAT", "chat",
+                           _format_host(self._local_host(client)), port,
+                           offer.token)
+            else:
+                chat._connect(offer.host, offer.port)
+        except OSError as error:
+            chat._finish(error)
+        return chat
+
+    # --------------------------------------------------------------------------
+    # Requests to other users
+    # --------------------------------------------------------------------------
+
+    def send_file(self, client, nick, path, passive=False):
+        """ Offers the file at ``path`` to ``nick`` and returns the
+        :class:`FileSend`. With ``passive``, ``nick`` is asked to make the
+        connection instead, for when this side can't be connected to. """
+        transfer = FileSend(self, client, nick, path)
+        if passive:
+            transfer.token = str(next(self._tokens))
+        self._start_or_queue(transfer)
+        return transfer
+
+    def chat(self, client, nick, passive=False):
+        """ Asks ``nick`` to chat and returns the :class:`DCCChat`. """
+        chat = DCCChat(self, client, nick)
+        self.chats.append(chat)
+        try:
+            host = _format_host(self._local_host(client))
+            if passive:
+                chat.token = str(next(self._tokens))
+                self._offers[("CHAT", chat.token)] = chat
+                chat.status = "waiting"
+                chat._wait()
+                self._send(client, nick, "CHAT", "chat", host, 0, chat.token)
+            else:
+                port = chat._listen()
+                self._send(client, nick, "CHAT", "chat", host, port)
+        except OSError as error:
+            chat._finish(error)
+        return chat
+
+    # --------------------------------------------------------------------------
+    # Internals
+    # --------------------------------------------------------------------------
+
+    def _start_or_queue(self, transfer):
+        if len(self.transfers) < self.max_transfers:
+            self.transfers.append(transfer)
+            self._begin(transfer)
+        else:
+            self._queue.append(transfer)
+
+    def _begin(self, transfer):
+        """ Starts a transfer that's been given a slot. If the socket can't
+        be set up, the transfer fails, which lets the next one start. """
+        try:
+            self._offer(transfer)
+        except OSError as error:
+            transfer._finish(error)
+
+    def _offer(self, transfer):
+        client = transfer.client
+        if transfer.outgoing:
+            host = _format_host(self._local_host(client))
+            if transfer.token is not None:
+                self._offers[("SEND", transfer.token)] = transfer
+                self._offers[("RESUME", transfer.token)] = transfer
+                transfer.status = "waiting"
+                transfer._wait()
+                self._send(client, transfer.nick, "SEND",
+                           _quote(transfer.filename), host, 0, transfer.size,
+                           transfer.token)
+            else:
+                transfer.port = transfer._listen()
+                self._offers[("RESUME", transfer.port)] = transfer
+                self._send(client, transfer.nick, "SEND",
+                           _quote(transfer.filename), host, transfer.port,
+                           transfer.size)
+            return
+        offer = transfer.offer
+        existing = _file_size(transfer.path) if transfer.resume else 0
+        if existing and offer.size is not None and existing < offer.size:
+            # Ask to carry on, and connect once it's accepted.
+            transfer.position = existing
+            self._offers[_reply_key("ACCEPT", offer)] = transfer
+            transfer.status = "waiting"
+            transfer._wait()
+            self._send(client, offer.source, "RESUME", _quote(offer.filename),
+                       offer.port, existing, *_token(offer))
+        else:
+            self._connect_or_listen(transfer)
+
+    def _connect_or_listen(self, transfer):
+        offer = transfer.offer
+        if offer.passive:
+            port = transfer._listen()
+            self._send(transfer.client, offer.source, "SEND",
+                       _quote(offer.filename),
+                       _format_host(self._local_host(transfer.client)),
+                       port, offer.size, offer.token)
+        else:
+            transfer._connect(offer.host, offer.port)
+
+    def _handle_dcc(self, client, event):
+        offer = parse_offer(event)
+        if offer is None:
+            return
+        pending = self._reply_to(offer)
+        if pending is None or pending.client is not client:
+            return
+        try:
+            self._handle_reply(client, offer, pending)
+        except OSError as error:
+            pending._finish(error)
+
+    def _handle_reply(self, client, offer, pending):
+        if offer.kind == "RESUME" and isinstance(pending, FileSend):
+            if pending.status == "waiting" and not pending.connected:
+                pending.position = max(0, min(offer.position, pending.size))
+                self._send(client, offer.source, "ACCEPT",
+                           _quote(offer.filename), offer.port,
+                           pending.position, *_token(offer))
+        elif offer.kind == "ACCEPT" and isinstance(pending, FileReceive):
+            self._forget_offer(pending)
+            pending._cancel_timer()
+            self._connect_or_listen(pending)
+        elif offer.kind in ("SEND", "CHAT") and not offer.passive:
+            # The other side of our passive request is listening.
+            self._forget_offer(pending)
+            pending._cancel_timer()
+            pending._connect(offer.host, offer.port)
+
+    def _reply_to(self, offer):
+        """ Returns our request that ``offer`` replies to, if it does. """
+        if offer.kind in ("SEND", "CHAT") and offer.passive:
+            return None
+        return self._offers.get(_reply_key(offer.kind, offer))
+
+    def _forget_offer(self, pending):
+        for key in [key for key, value in self._offers.items()
+                    if value is pending]:
+            del self._offers[key]
+
+    def _chat_ended(self, chat):
+        self._forget_offer(chat)
+        if chat in self.chats:
+            self.chats.remove(chat)
+
+    def _finished(self, transfer):
+        self._forget_offer(transfer)
+        if transfer in self.transfers:
+            self.transfers.remove(transfer)
+        elif transfer in self._queue:
+            self._queue.remove(transfer)
+        while self._queue and len(self.transfers) < self.max_transfers:
+            waiting = self._queue.popleft()
+            self.transfers.append(waiting)
+            self._begin(waiting)
+        event = events.ConnectionEvent("CONN_DCC_TRANSFER")
+        event.source = transfer.nick
+        event.transfer = transfer
+        event.error = transfer.error
+        transfer.client.events.dispatch(transfer.client, event)
+
+    def _local_host(self, client):
+        if self.host is not None:
+            return self.host
+        return client.conn.socket.getsockname()[0]
+
+    def _send(self, client, nick, *params):
+        client.send_ctcp(nick, "DCC", [str(param) for param in params])
+
+
+def _reply_key(kind, offer):
+    """ The key of our request that a ``kind`` reply about ``offer`` is
+    for. Replies to passive requests are told apart by their token, and
+    the others by the port. """
+    if kind in ("SEND", "CHAT") or (offer.port == 0 and
+                                    offer.token is not None):
+        return (kind, offer.token)
+    return (kind, offer.port)
+
+
+def _token(offer):
+    if offer.token is not None:
+        return (offer.token,)
+    return ()
+
+
+def _file_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
@@ -9,9 +9,17 @@ is parsed to fill in the values for the event object.
 """
 import bisect
 import collections
+import copy
+import itertools
+import operator
+import re
+import time
 import traceback
 
+from . import masks
 from . import protocol
+from . import responses
+from . import timers
 
 
 class EventDispatcher(object):
@@ -19,22 +27,149 @@ class EventDispatcher(object):
     listeners to the dispatcher, (2) providing a way to interact with the
     listeners, and (3) dispatching events.
     """
+    #: The :class:`ircutils.metrics.Metrics` that listener and handler 
+    #: timings go to, or ``None``. Use :meth:`set_metrics` to change it.
+    metrics = None
+    #: The :class:`ircutils.profiling.Profiler` that handler timings go to,
+    #: or ``None``. Use :meth:`set_profiler` to change it.
+    profiler = None
+    #: While this is set, handlers with this priority or more are skipped.
+    #: Use :meth:`set_shed_priority` to change it.
+    shed_priority = None
     
     def __init__(self):
         self._listeners = {}
+        self._factories = {}
+        # The position of every name, so that listeners created later are
+        # still notified in the order they were registered.
+        self._order = {}
+        self._filters = []
+        self._template = None
     
     def register_listener(self, name, listener):
         """ Adds a listener to the dispatcher. """
+        self._configure(listener)
+        if name not in self._order:
+            self._unshare_tables()
+            self._order[name] = len(self._order)
+        created = name not in self._listeners
         self._listeners[name] = listener
+        if created and len(self._listeners) > 1:
+            order = self._order
+            self._listeners = dict(sorted(self._listeners.items(), 
+                                          key=lambda item: order[item[0]]))
+    
+    def register_factory(self, name, factory):
+        """ Registers a listener that isn't created until it's first looked
+        up, by calling ``factory()``, which is usually the listener class. 
+        A listener without handlers never sees any events, so nothing is 
+        missed by waiting. 
+        """
+        if name not in self._listeners:
+            self._unshare_tables()
+            self._order.setdefault(name, len(self._order))
+            self._factories[name] = factory
+    
+    def fork(self):
+        """ Returns a new dispatcher with the same listeners and handlers.
+        Clients fork one dispatcher that's built per class, so that 
+        identical bots share their listeners instead of each building its
+        own. A shared listener is copied the first time it's looked up, 
+        which is how handlers are added to it. Listeners that keep state 
+        between events, such as the WHOIS replies still being received, 
+        are copied right away. Filters and settings aren't carried over.
+        """
+        dispatcher = EventDispatcher()
+        dispatcher._template = self
+        dispatcher._factories = self._factories
+        dispatcher._order = self._order
+        listeners = dispatcher._listeners
+        for name, listener in self._listeners.items():
+            if listener.stateful:
+                listener = listener.copy()
+            listeners[name] = listener
+        return dispatcher
+    
+    def _unshare_tables(self):
+        """ Copies the names and factories shared with the template before 
+        they're changed. """
+        template = self._template
+        if template is not None and self._order is template._order:
+            self._order = self._order.copy()
+            self._factories = self._factories.copy()
+    
+    def _configure(self, listener):
+        for setting in _listener_settings:
+            value = getattr(self, setting)
+            if value is not None:
+                setattr(listener, setting, value)
+    
+    def _apply(self, setting, value):
+        """ Sets ``setting`` on the dispatcher and on every listener. """
+        setattr(self, setting, value)
+        for name in list(self._listeners):
+            setattr(self[name], setting, value)
+    
+    def set_metrics(self, metrics):
+        """ Starts timing every listener and its handlers into ``metrics``,
+        or stops timing them if it's ``None``. """
+        self._apply("metrics", metrics)
+    
+    def set_profiler(self, profiler):
+        """ Starts reporting how long every handler takes to ``profiler``, 
+        or stops if it's ``None``. """
+        self._apply("profiler", profiler)
+    
+    def set_shed_priority(self, priority):
+        """ Skips every handler whose priority is ``priority`` or more, 
+        until it's set back to ``None``. This is how 
+        :class:`ircutils.watchdog.Watchdog` sheds load. """
+        self._apply("shed_priority", priority)
+    
+    def add_filter(self, event_filter):
+        """ Adds a filter that is consulted before any listener is notified.
+        Filters are called as ``event_filter(client, event)`` and the event is
+        dropped unless every filter returns a true value. See 
+        :meth:`ircutils.masks.MaskSet.allows` for ignoring users.
+        """
+        self._filters.append(event_filter)
+    
+    def remove_filter(self, event_filter):
+        """ Removes a filter added with :meth:`add_filter`. """
+        self._filters.remove(event_filter)
+    
+    def _allowed(self, client, event):
+        for event_filter in self._filters:
+            if not event_filter(client, event):
+                return False
+        return True
     
     def __setitem__(self, name, listener):
         self.register_listener(name, listener)
     
     def __getitem__(self, name):
-        return self._listeners[name]
+        try:
+            listener = self._listeners[name]
+        except KeyError:
+            factory = self._factories.get(name)
+            if factory is None:
+                raise
+            listener = factory()
+            self.register_listener(name, listener)
+            return listener
+        template = self._template
+        if template is not None and \
+           listener is template._listeners.get(name):
+            listener = listener.copy()
+            self._configure(listener)
+            self._listeners[name] = listener
+        return listener
+    
+    def __contains__(self, name):
+        return name in self._listeners or name in self._factories
     
     def __iter__(self):
-        return iter(list(self._listeners.keys()))
+        return iter(list(self._order))
     
     def dispatch(self, client, event):
         """ Notifies all of the listeners that an event is available.
@@ -42,9 +177,60 @@ class EventDispatcher(object):
         the listener is looking for will then activate its event handlers.
         
         """
+        if self._filters and not self._allowed(client, event):
+            return
+        if self.metrics is not None:
+            self._dispatch_timed(client, [event])
+            return
         for name, listener in list(self._listeners.items()):
-            if listener.handlers != []:
+            if listener.handlers:
                 listener.notify(client, event)
+    
+    def dispatch_batch(self, client, events):
+        """ Dispatches a list of events, such as the lines of a connect burst
+        or a netsplit, in order. Consecutive events that share a command are 
+        handed to each listener as a single run through 
+        :meth:`EventListener.notify_batch`, so a listener sees the whole run 
+        before the next listener does.
+        
+        """
+        if self._filters:
+            events = [event for event in events if self._allowed(client, event)]
+        if self.metrics is not None:
+            self._dispatch_timed(client, events)
+            return
+        for command, run in itertools.groupby(events, _get_command):
+            run = list(run)
+            for name, listener in list(self._listeners.items()):
+                if not listener.handlers:
+                    continue
+                if len(run) == 1:
+                    listener.notify(client, run[0])
+                else:
+                    listener.notify_batch(client, run)
+    
+    def _dispatch_timed(self, client, events):
+        """ :meth:`dispatch_batch` with the time each listener takes going 
+        to :attr:`metrics`. """
+        observe = self.metrics.listener_seconds.observe
+        clock = time.perf_counter
+        for command, run in itertools.groupby(events, _get_command):
+            run = list(run)
+            for name, listener in list(self._listeners.items()):
+                if not listener.handlers:
+                    continue
+                started = clock()
+                if len(run) == 1:
+                    listener.notify(client, run[0])
+                else:
+                    listener.notify_batch(client, run)
+                observe(clock() - started, name)
+
+
+_get_command = operator.attrgetter("command")
+
+# The dispatcher attributes that are passed on to every listener.
+_listener_settings = ("metrics", "profiler", "shed_priority")
 
 
 
@@ -55,12 +241,20 @@ class EventDispatcher(object):
 
 
 class Event(object):
-    pass
+    #: The value of a numeric reply's command, such as ``353`` for 
+    #: ``RPL_NAMREPLY``, or ``None`` for other commands.
+    numeric = None
 
 
 class ConnectionEvent(Event):
     """ Handles events for connecting and disconnecting. Currently, the only useful data in
-    the event object is the command. It will either be CONN_CONNECT or CONN_DISCONNECT.
+    the event object is the command. It will either be CONN_CONNECT, CONN_DISCONNECT,
+    CONN_LAG, CONN_SLOW_HANDLER or CONN_BACKPRESSURE. CONN_LAG events also have a ``lag`` 
+    attribute with the round trip time to the server in seconds. CONN_SLOW_HANDLER events 
+    are sent by :class:`ircutils.profiling.Profiler` and have ``handler``, 
+    ``handler_name``, ``seconds`` and ``event`` attributes. CONN_BACKPRESSURE events are 
+    sent by :class:`ircutils.watchdog.Watchdog` and have ``overloaded``, ``lag`` and 
+    ``work`` attributes.
     """
     def __init__(self, command):
         self.command = command
@@ -73,6 +267,8 @@ class StandardEvent(Event):
     """ Represents a standard event. """
     def __init__(self, prefix, command, params):
         self.command = command
+        if command.__class__ is responses.Numeric:
+            self.numeric = command.value
         self.prefix = prefix
         self.source, self.user, self.host = protocol.parse_prefix(prefix)
         if len(params) > 0:
@@ -114,6 +310,21 @@ class CTCPEvent(StandardEvent):
         self.params = []
 
 
+class BatchEvent(Event):
+    """ Represents a whole IRCv3 ``BATCH``, such as a netsplit. The command
+    is ``BATCH``; ``batch_type`` is the type of the batch (``netsplit``, 
+    ``netjoin``, ``chathistory``, ...), ``params`` are the batch's 
+    parameters, and ``events`` holds the events of every line in it.
+    """
+    def __init__(self, batch_type, params, events):
+        self.command = "BATCH"
+        self.source = None
+        self.target = None
+        self.batch_type = batch_type
+        self.params = params
+        self.events = events
+
+
 
 # ------------------------------------------------------------------------------
 # > BEGIN EventListener AND HELPER CODE
@@ -121,17 +332,123 @@ class CTCPEvent(StandardEvent):
 
 
 
+HandlerToken = collections.namedtuple("HandlerToken", "priority sequence")
+
+
+class HandlerQueue(object):
+    """ A sorted store of event handlers. Handlers are kept in order of their
+    priority, and handlers with the same priority keep the order they were 
+    added in. Every handler gets a :class:`HandlerToken` when it is added, 
+    which can be used to remove it again with a binary search.
+    
+    The entry list is changed in place until :meth:`snapshot` hands it out
+    to be iterated over. The first change after that goes to a copy, so 
+    handlers may safely add or remove handlers while they are being 
+    activated, and adding many handlers outside of dispatch doesn't copy 
+    the list each time.
+    """
+    def __init__(self):
+        #: The ``(priority, sequence, handler)`` entries in activation order.
+        #: Use :meth:`snapshot` to iterate over them.
+        self.entries = []
+        self._next_sequence = 0
+        # Whether nothing else holds on to ``entries``, so it may be changed
+        # in place.
+        self._private = True
+    
+    def snapshot(self):
+        """ Returns the list of entries. It won't change after this; the 
+        queue makes a new one the next time a handler is added or removed.
+        """
+        self._private = False
+        return self.entries
+    
+    def _writable_entries(self):
+        if not self._private:
+            self.entries = self.entries[:]
+            self._private = True
+        return self.entries
+    
+    def add(self, handler, priority=0):
+        """ Adds a handler and returns its :class:`HandlerToken`. """
+        token = HandlerToken(priority, self._next_sequence)
+        self._next_sequence += 1
+        entries = self._writable_entries()
+        entries.insert(bisect.bisect(entries, token), token + (handler,))
+        return token
+    
+    def remove(self, token):
+        """ Removes the handler that was given ``token`` when it was added.
+        Returns ``False`` if it was already removed.
+        """
+        index = bisect.bisect_left(self.entries, token)
+        if index == len(self.entries) or self.entries[index][:2] != token:
+            return False
+        del self._writable_entries()[index]
+        return True
+    
+    def remove_handler(self, handler):
+        """ Removes every entry for ``handler``. """
+        self.entries = [entry for entry in self.entries if entry[2] != handler]
+        self._private = True
+    
+    def copy(self):
+        """ Returns a new queue with the same handlers. """
+        queue = HandlerQueue()
+        queue.entries = self.snapshot()
+        queue._private = False
+        queue._next_sequence = self._next_sequence
+        return queue
+    
+    def __iter__(self):
+        return ((priority, handler) 
+                for priority, seq, handler in self.snapshot())
+    
+    def __len__(self):
+        return len(self.entries)
+    
+    def __bool__(self):
+        return len(self.entries) != 0
+    
+    def __contains__(self, handler):
+        return any(entry[2] == handler for entry in self.entries)
+
+
 class EventListener(object):
     """ This class is a simple event listener designed to be subclassed. Each
     event listener is in charge of activating its handlers. 
     """
+    #: Set by :meth:`EventDispatcher.set_metrics` to time the handlers.
+    metrics = None
+    #: Set by :meth:`EventDispatcher.set_profiler` to time the handlers.
+    profiler = None
+    #: A ``cProfile.Profile`` that is enabled while the handlers run, set by
+    #: :meth:`ircutils.profiling.Profiler.start_profile`.
+    profile = None
+    #: Set by :meth:`EventDispatcher.set_shed_priority` to skip handlers.
+    shed_priority = None
+    #: Whether the listener keeps state between events, so that it can't be
+    #: shared between clients. See :meth:`EventDispatcher.fork`.
+    stateful = False
+    
     def __init__(self):
-        self.handlers = []
+        self.handlers = HandlerQueue()
     
-    def add_handler(self, handler, priority=0):
+    def copy(self):
+        """ Returns a listener of the same kind with the same handlers, that
+        handlers can be added to and removed from separately. Any state 
+        built up from events isn't copied. 
+        """
+        listener = copy.copy(self)
+        listener.handlers = self.handlers.copy()
+        return listener
+    
+    def add_handler(self, handler, priority=0, once=False, ttl=None, 
+                    on_expire=None):
         """ Add a handler to the event listener. It will be called when the 
         listener decides it's time. It will place it in order depending
-        on the priority specified. The default is 0. 
+        on the priority specified. The default is 0. Handlers with the same
+        priority are activated in the order they were added.
         Event handlers take the form of::
             
             def my_handler(client, event):
@@ -141,23 +458,44 @@ class EventListener(object):
         
         If :class:`ircutils.bot.SimpleBot` is being used, you do not need to
         use this method as handlers are automatically added.
+        
+        If ``once`` is true, the handler is removed right before it is 
+        activated for the first time. If ``ttl`` is given, the handler is 
+        removed after that many seconds and ``on_expire()`` is called if it 
+        hasn't been removed some other way by then. For example, to wait 
+        for the next notice from NickServ for up to 10 seconds::
+        
+            listener = events.create_listener(command="NOTICE", 
+                                              source="NickServ")
+            client.register_listener("nickserv", listener)
+            listener.add_handler(got_reply, once=True, ttl=10, 
+                                 on_expire=gave_up)
+        
+        The expiry runs on the timers of :mod:`ircutils.timers`, so the 
+        client must be started with ``start()`` or ``ircutils.start_all()``.
+        
+        A :class:`HandlerToken` is returned which can be given to
+        :meth:`remove_handler` to remove this exact handler again.
                 
         """
-        if len(self.handlers) == 0:
-            self.handlers.append((priority, handler))
-        else:
-            handler_priorities = list(zip(*self.handlers))[0]
-            ins_loc = bisect.bisect(handler_priorities, priority)
-            self.handlers.insert(ins_loc, (priority, handler))
+        if not once and ttl is None:
+            return self.handlers.add(handler, priority)
+        handler = _LimitedHandler(self, handler, once)
+        handler.token = self.handlers.add(handler, priority)
+        if ttl is not None:
+            handler.timer = timers.call_later(ttl, handler.expire, on_expire)
+        return handler.token
     
     def remove_handler(self, handler):
         """ This removes all handlers that are equal to the ``handler`` which
-        are bound to the event listener. This isn't too efficient since
-        it is ``O(n^2)``.
+        are bound to the event listener. If ``handler`` is a 
+        :class:`HandlerToken` returned by :meth:`add_handler`, only that one
+        entry is removed, which only takes ``O(log n)`` to find.
         """
-        for p, l in self.handlers:
-            if l == handler:
-                self.handlers.remove((p,l))
+        if isinstance(handler, HandlerToken):
+            self.handlers.remove(handler)
+        else:
+            self.handlers.remove_handler(handler)
     
     def activate_handlers(self, *args):
         """ This activates each handler that's bound to the listener. It works
@@ -166,7 +504,20 @@ class EventListener(object):
         handler. It's a good idea to always make sure to send in the client
         and the event.
         """
-        for p, handler in self.handlers:
+        self._activate_entries(self.handlers.snapshot(), args)
+    
+    def _activate_entries(self, entries, args):
+        """ Activates the handlers of sorted ``(priority, sequence, 
+        handler)`` entries, skipping the ones that are shed and timing them
+        if the listener is timed. Listeners that pick the handlers for an
+        event themselves run them through this too. """
+        if self.shed_priority is not None:
+            entries = self._unshed(entries)
+        if self.metrics is not None or self.profiler is not None:
+            for priority, sequence, handler in entries:
+                self._run_timed(handler, handler, args)
+            return
+        for priority, sequence, handler in entries:
             handler(*args)
             # try:
             #     handler(*args)
@@ -174,33 +525,396 @@ class EventListener(object):
             #     #traceback.print_exc(ex)
             #     self.handlers.remove((p, handler))
     
+    def activate_handlers_batch(self, client, events):
+        """ Activates each handler for every event in ``events``. A handler 
+        that has a ``batch`` attribute is given the whole list at once by 
+        calling ``handler.batch(client, events)``, otherwise it is called once 
+        per event.
+        """
+        entries = self.handlers.snapshot()
+        if self.shed_priority is not None:
+            entries = self._unshed(entries)
+        timed = self.metrics is not None or self.profiler is not None
+        for priority, sequence, handler in entries:
+            batch_handler = getattr(handler, "batch", None)
+            if batch_handler is not None:
+                if timed:
+                    self._run_timed(handler, batch_handler, (client, events))
+                else:
+                    batch_handler(client, events)
+            elif timed:
+                for event in events:
+                    self._run_timed(handler, handler, (client, event))
+            else:
+                for event in events:
+                    handler(client, event)
+    
+    def _unshed(self, entries):
+        """ Returns the entries that aren't skipped while load is shed. They
+        are sorted by priority, so it's a prefix. """
+        shed_priority = self.shed_priority
+        for index, entry in enumerate(entries):
+            if entry[0] >= shed_priority:
+                return entries[:index]
+        return entries
+    
+    def _run_timed(self, handler, call, args):
+        """ Calls ``call(*args)`` on behalf of ``handler`` and reports the 
+        time it took to :attr:`metrics` and :attr:`profiler`. """
+        profile = self.profile
+        started = time.perf_counter()
+        if profile is not None:
+            profile.enable()
+            try:
+                call(*args)
+            finally:
+                profile.disable()
+        else:
+            call(*args)
+        elapsed = time.perf_counter() - started
+        if self.metrics is not None:
+            self.metrics.handler_seconds.observe(elapsed, 
+                                                 handler_name(handler))
+        if self.profiler is not None:
+            self.profiler.record(handler, elapsed, args)
+    
     def notify(self, client, event):
         """ This is to be overridden when subclassed. It gets called after each
         event generated by the system. If the event listener decides to, it
         should run its handlers from here.
         """
         raise NotImplementedError("notify() must be overridden.")
+    
+    def notify_batch(self, client, events):
+        """ Gets called with a list of events during bursts of server data. 
+        By default it calls :meth:`notify` for each event. Listeners that can 
+        do better by looking at the events as a group may override it.
+        """
+        notify = self.notify
+        for event in events:
+            notify(client, event)
+
+
+
+
+
+def handler_name(handler):
+    """ Returns a readable name for a handler, such as 
+    ``"mybot.MyBot.on_message"``, for metrics and logs. """
+    while isinstance(handler, (_LimitedHandler, _PatternRule)):
+        handler = handler.handler
+    name = getattr(handler, "__qualname__", None) or \
+           type(handler).__qualname__
+    module = getattr(handler, "__module__", None)
+    if module:
+        return "%s.%s" % (module, name)
+    return name
+
+
+class _LimitedHandler(object):
+    """ Wraps a handler that is only activated once and/or expires. It
+    compares equal to the handler it wraps so that 
+    :meth:`EventListener.remove_handler` still finds it.
+    """
+    
+    def __init__(self, listener, handler, once):
+        self.listener = listener
+        self.handler = handler
+        self.once = once
+        self.token = None
+        self.timer = None
+    
+    def __call__(self, *args):
+        if self.once:
+            self.discard()
+        return self.handler(*args)
+    
+    def batch(self, client, events):
+        if self.once:
+            self(client, events[0])
+            return
+        batch_handler = getattr(self.handler, "batch", None)
+        if batch_handler is not None:
+            batch_handler(client, events)
+        else:
+            for event in events:
+                self.handler(client, event)
+    
+    def discard(self):
+        self.listener.handlers.remove(self.token)
+        if self.timer is not None:
+            self.timer.cancel()
+    
+    def expire(self, on_expire):
+        if self.listener.handlers.remove(self.token) and on_expire is not None:
+            on_expire()
+    
+    def __eq__(self, other):
+        if isinstance(other, _LimitedHandler):
+            other = other.handler
+        return self.handler == other
+    
+    def __hash__(self):
+        return hash(self.handler)
 
 
 
+def _is_mask(value):
+    return "*" in value or "?" in value
+
+
+def _compile_mask(mask):
+    """ Compiles an IRC wildcard mask into a case-insensitive regex. """
+    return masks.compile_mask(mask, re.IGNORECASE | re.DOTALL)
+
+
+def _event_text(event):
+    """ The text a message pattern is matched against. """
+    message = getattr(event, "message", None)
+    if message is None and event.params:
+        message = event.params[-1]
+    return message
+
+
+class _PatternRule(object):
+    """ The conditions that have to match before a handler is activated. """
+    
+    def __init__(self, handler, command=None, target=None, source=None, 
+                 message=None):
+        self.handler = handler
+        self.command = command.upper() if command is not None else None
+        self.target = self.target_mask = None
+        if target is not None:
+            if _is_mask(target):
+                self.target_mask = _compile_mask(target)
+            else:
+                self.target = target.lower()
+        self.source = self.source_mask = None
+        self.match_prefix = False
+        if source is not None:
+            self.match_prefix = "!" in source or "@" in source
+            if self.match_prefix or _is_mask(source):
+                self.source_mask = _compile_mask(source)
+            else:
+                self.source = source.lower()
+        if isinstance(message, str):
+            message = re.compile(message)
+        self.message = message
+    
+    def __call__(self, client, event):
+        return self.handler(client, event)
+    
+    def __eq__(self, other):
+        if isinstance(other, _PatternRule):
+            other = other.handler
+        return self.handler == other
+    
+    def __hash__(self):
+        return hash(self.handler)
+    
+    def matches(self, event):
+        """ Checks every condition against ``event``. """
+        if self.command is not None and self.command != event.command:
+            return False
+        if self.target is not None and \
+           (event.target is None or self.target != event.target.lower()):
+            return False
+        if self.message is not None:
+            text = _event_text(event)
+            if text is None or self.message.search(text) is None:
+                return False
+        return self.matches_unindexed(event)
+    
+    def matches_unindexed(self, event):
+        """ Checks the conditions that :class:`PatternListener` can't look up
+        by key, apart from the message pattern. """
+        if self.target_mask is not None and \
+           (event.target is None or not self.target_mask.match(event.target)):
+            return False
+        if self.source is not None:
+            return event.source is not None and \
+                   self.source == event.source.lower()
+        if self.source_mask is not None:
+            if event.source is None:
+                return False
+            source = event.source
+            if self.match_prefix:
+                user = getattr(event, "user", None)
+                host = getattr(event, "host", None)
+                source = protocol.create_prefix(source, user, host)
+            return self.source_mask.match(source) is not None
+        return True
+
+
+
+# Numbered back-references and conditional groups, which would point at the
+# wrong group once their pattern is merged with others.
+_group_reference = re.compile(r"(?<!\\)(?:\\\\)*(?:\\[1-9]|\(\?\(\d)")
+
+
+class _RuleGroup(object):
+    """ The rules of a :class:`PatternListener` that share a command and 
+    target. Their message patterns are merged into one regex so that a 
+    message that none of them match is rejected with a single search. 
+    Patterns that refer to their groups by number are left out of it and
+    always searched on their own.
+    """
+    
+    def __init__(self):
+        self.plain = []
+        self.patterned = []
+        self.merged = None
+        self.merged_rules = []
+        self.separate_rules = []
+    
+    def add(self, entry, rule):
+        if rule.message is None:
+            self.plain.append((entry, rule))
+        else:
+            self.patterned.append((entry, rule))
+    
+    def compile(self):
+        self.merged = None
+        self.merged_rules = []
+        self.separate_rules = self.patterned
+        mergeable = []
+        separate = []
+        for entry, rule in self.patterned:
+            pattern = rule.message.pattern
+            if isinstance(pattern, str) and \
+               _group_reference.search(pattern) is None:
+                mergeable.append((entry, rule))
+            else:
+                separate.append((entry, rule))
+        if len(mergeable) < 2:
+            return
+        flags = set(rule.message.flags for entry, rule in mergeable)
+        if len(flags) != 1:
+            return
+        patterns = ["(?:%s)" % rule.message.pattern 
+                    for entry, rule in mergeable]
+        try:
+            self.merged = re.compile("|".join(patterns), flags.pop())
+        except re.error:
+            # Things like repeated group names or inline flags can't be 
+            # merged.
+            return
+        self.merged_rules = mergeable
+        self.separate_rules = separate
+    
+    def match(self, event, text, matched):
+        for entry, rule in self.plain:
+            if rule.matches_unindexed(event):
+                matched.append(entry)
+        if not self.patterned or text is None:
+            return
+        if self.merged is not None and self.merged.search(text) is not None:
+            self._match_patterns(self.merged_rules, event, text, matched)
+        self._match_patterns(self.separate_rules, event, text, matched)
+    
+    @staticmethod
+    def _match_patterns(rules, event, text, matched):
+        for entry, rule in rules:
+            if rule.message.search(text) is not None and \
+               rule.matches_unindexed(event):
+                matched.append(entry)
+
+
+
+class PatternListener(EventListener):
+    """ A listener for bots with many triggers. Each handler is added with 
+    its own conditions through :meth:`add_pattern`. The rules are indexed 
+    by their exact command and target, and the message patterns of each 
+    index entry are merged into a single regex, so an event is only checked
+    against the rules that could possibly match it. ::
+    
+        triggers = events.PatternListener()
+        client.register_listener("triggers", triggers)
+        triggers.add_pattern(greet, command="PRIVMSG", message=r"^(hi|hello)")
+        triggers.add_pattern(op_only, source="*!*@staff.example.com")
+    
+    Handlers added with plain :meth:`add_handler` match every event.
+    """
+    
+    def __init__(self):
+        EventListener.__init__(self)
+        self._index = {}
+        self._indexed_entries = None
+    
+    def add_pattern(self, handler, command=None, target=None, source=None,
+                    message=None, priority=0, **kwargs):
+        """ Adds a handler that's activated for events matching every 
+        condition given. Targets and sources may be wildcard masks. A source
+        containing ``!`` or ``@`` is matched against the whole 
+        ``nick!user@host`` prefix, otherwise it's matched against the 
+        nickname. Targets and sources are compared case-insensitively. 
+        ``message`` is a regular expression that is searched for in the 
+        message text. The remaining keyword arguments are passed to 
+        :meth:`add_handler`.
+        """
+        rule = _PatternRule(handler, command, target, source, message)
+        return self.add_handler(rule, priority, **kwargs)
+    
+    def _build_index(self):
+        """ Rebuilds the index. The handler queue replaces the entry list it
+        handed out on the next change, so this only happens after handlers 
+        were added or removed.
+        """
+        index = {}
+        entries = self.handlers.snapshot()
+        for entry in entries:
+            rule = entry[2]
+            if isinstance(rule, _LimitedHandler):
+                rule = rule.handler
+            if not isinstance(rule, _PatternRule):
+                rule = _PatternRule(rule)
+            key = (rule.command, rule.target)
+            if key not in index:
+                index[key] = _RuleGroup()
+            index[key].add(entry, rule)
+        for group in index.values():
+            group.compile()
+        self._index = index
+        self._indexed_entries = entries
+    
+    def notify(self, client, event):
+        if self.handlers.entries is not self._indexed_entries:
+            self._build_index()
+        index = self._index
+        command = event.command
+        target = event.target.lower() if event.target else None
+        if target is None:
+            keys = ((command, None), (None, None))
+        else:
+            keys = ((command, target), (command, None), 
+                    (None, target), (None, None))
+        text = _event_text(event)
+        matched = []
+        for key in keys:
+            group = index.get(key)
+            if group is not None:
+                group.match(event, text, matched)
+        if len(matched) > 1:
+            matched.sort()
+        self._activate_entries(matched, (client, event))
+
 
 
 class _CustomListener(EventListener):
     
-    def __init__(self, command, target, source):
+    def __init__(self, command, target, source, message=None):
         EventListener.__init__(self)
         self.command = command
         self.target = target
         self.source = source
+        self._rule = _PatternRule(None, command, target, source, message)
     
     def notify(self, client, event):
-        if self.command in (None, event.command) and \
-           self.target  in (None, event.target)  and \
-           self.source  in (None, event.source):
+        if self._rule.matches(event):
             self.activate_handlers(client, event)
 
 
-def create_listener(command=None, target=None, source=None):
+def create_listener(command=None, target=None, source=None, message=None):
     """ Create a listener on-the-fly. This is the simplest way of creating event
     listeners, but also very limited. Examples::
     
@@ -212,8 +926,15 @@ def create_listener(command=None, target=None, source=None):
         
         # Listens for events that are messages to a specific channel
         example = events.create_listener(command="PRIVMSG", target="#channel")
+        
+        # Sources and targets may be wildcard masks, and messages can be
+        # matched with a regular expression
+        example = events.create_listener(source="*!*@*.example.com",
+                                         message=r"^!deploy\b")
+    
+    If you need many of these, use a single :class:`PatternListener` instead.
     """
-    return _CustomListener(command, target, source)
+    return _CustomListener(command, target, source, message)
 
 
 
@@ -232,10 +953,40 @@ class DisconnectListener(EventListener):
         if event.command == "CONN_DISCONNECT":
             self.activate_handlers(client, event)
 
+class LagListener(EventListener):
+    def notify(self, client, event):
+        if event.command == "CONN_LAG":
+            self.activate_handlers(client, event)
+
+class SlowHandlerListener(EventListener):
+    def notify(self, client, event):
+        if event.command == "CONN_SLOW_HANDLER":
+            self.activate_handlers(client, event)
+
+class BackpressureListener(EventListener):
+    def notify(self, client, event):
+        if event.command == "CONN_BACKPRESSURE":
+            self.activate_handlers(client, event)
+
+class DCCChatListener(EventListener):
+    def notify(self, client, event):
+        if event.command == "CONN_DCC_CHAT":
+            self.activate_handlers(client, event)
+
+class DCCTransferListener(EventListener):
+    def notify(self, client, event):
+        if event.command == "CONN_DCC_TRANSFER":
+            self.activate_handlers(client, event)
+
 
 connection = {
     "connect": ConnectListener,
-    "disconnect": DisconnectListener
+    "disconnect": DisconnectListener,
+    "lag": LagListener,
+    "slow_handler": SlowHandlerListener,
+    "backpressure": BackpressureListener,
+    "dcc_chat": DCCChatListener,
+    "dcc_transfer": DCCTransferListener
 }
 
 
@@ -243,10 +994,13 @@ connection = {
 class AnyListener(EventListener):
     def notify(self, client, event):
         self.activate_handlers(client, event)
+    
+    def notify_batch(self, client, events):
+        self.activate_handlers_batch(client, events)
 
 class WelcomeListener(EventListener):
     def notify(self, client, event):
-        if event.command == "RPL_WELCOME":
+        if event.numeric == responses.RPL_WELCOME:
             self.activate_handlers(client, event)
 
 class NickChangeListener(EventListener):
@@ -273,16 +1027,31 @@ class JoinListener(EventListener):
     def notify(self, client, event):
         if event.command == "JOIN":
             self.activate_handlers(client, event)
+    
+    def notify_batch(self, client, events):
+        matched = [event for event in events if event.command == "JOIN"]
+        if matched:
+            self.activate_handlers_batch(client, matched)
 
 class QuitListener(EventListener):
     def notify(self, client, event):
         if event.command == "QUIT":
             self.activate_handlers(client, event)
+    
+    def notify_batch(self, client, events):
+        matched = [event for event in events if event.command == "QUIT"]
+        if matched:
+            self.activate_handlers_batch(client, matched)
 
 class PartListener(EventListener):
     def notify(self, client, event):
         if event.command == "PART":
             self.activate_handlers(client, event)
+    
+    def notify_batch(self, client, events):
+        matched = [event for event in events if event.command == "PART"]
+        if matched:
+            self.activate_handlers_batch(client, matched)
 
 class ErrorListener(EventListener):
     def notify(self, client, event):
@@ -294,6 +1063,41 @@ class ModeListener(EventListener):
         if event.command == "MODE":
             self.activate_handlers(client, event)
 
+class AwayListener(EventListener):
+    def notify(self, client, event):
+        if event.command == "AWAY":
+            self.activate_handlers(client, event)
+
+class BatchListener(EventListener):
+    #: Only batches of this type are passed on, or every batch if ``None``.
+    batch_type = None
+    
+    def notify(self, client, event):
+        if event.command == "BATCH" and isinstance(event, BatchEvent):
+            if self.batch_type is None or event.batch_type == self.batch_type:
+                self.activate_handlers(client, event)
+
+class NetsplitListener(BatchListener):
+    batch_type = "netsplit"
+
+class NetjoinListener(BatchListener):
+    batch_type = "netjoin"
+
+class ChatHistoryListener(BatchListener):
+    batch_type = "chathistory"
+
+class CapListener(EventListener):
+    """ Listens for capability negotiation and SASL authentication; the 
+    ``CAP`` and ``AUTHENTICATE`` commands and the SASL replies. """
+    commands = frozenset(["CAP", "AUTHENTICATE", "RPL_LOGGEDIN", 
+                          "RPL_LOGGEDOUT", "ERR_NICKLOCKED", "RPL_SASLSUCCESS",
+                          "ERR_SASLFAIL", "ERR_SASLTOOLONG", "ERR_SASLABORTED",
+                          "ERR_SASLALREADY", "RPL_SASLMECHS"])
+    
+    def notify(self, client, event):
+        if event.command in self.commands:
+            self.activate_handlers(client, event)
+
 
 
 standard = {
@@ -308,6 +1112,12 @@ standard = {
     "nick_change": NickChangeListener,
     "error": ErrorListener,
     "mode": ModeListener,
+    "away": AwayListener,
+    "cap": CapListener,
+    "batch": BatchListener,
+    "netsplit": NetsplitListener,
+    "netjoin": NetjoinListener,
+    "chathistory": ChatHistoryListener,
     }
 
 
@@ -420,12 +1230,13 @@ ctcp = {
 
 class ReplyListener(EventListener):
     def notify(self, client, event):
-        if event.command.startswith("RPL_"):
+        if event.numeric in responses.reply_values:
             self.activate_handlers(client, event)
 
 
 
 class NameReplyListener(ReplyListener):
+    stateful = True
     
     class NameReplyEvent(Event):
         def __init__(self):
@@ -436,8 +1247,13 @@ class NameReplyListener(ReplyListener):
         ReplyListener.__init__(self)
         self._name_lists = collections.defaultdict(self.NameReplyEvent)
     
+    def copy(self):
+        listener = ReplyListener.copy(self)
+        listener._name_lists = collections.defaultdict(self.NameReplyEvent)
+        return listener
+    
     def notify(self, client, event):
-        if event.command == "RPL_NAMREPLY":
+        if event.numeric == responses.RPL_NAMREPLY:
             # "( "=" / "*" / "@" ) <channel>
             # :[ "@" / "+" ] <nick> *( " " [ "@" / "+" ] <nick> )
             # 
@@ -448,17 +1264,29 @@ class NameReplyListener(ReplyListener):
             # TODO: This line below is wrong. It doesn't use name symbols.
             names = list(map(protocol.strip_name_symbol, names))
             self._name_lists[channel].name_list.extend(names)
-        elif event.command == "RPL_ENDOFNAMES":
+        elif event.numeric == responses.RPL_ENDOFNAMES:
             # <channel> :End of NAMES list
             channel_name = event.params[0]
             name_event = self._name_lists[channel_name]
             name_event.channel = channel_name
             self.activate_handlers(client, name_event)
             del self._name_lists[channel_name]
+    
+    def notify_batch(self, client, events):
+        name_lists = self._name_lists
+        strip_name_symbol = protocol.strip_name_symbol
+        for event in events:
+            if event.numeric == responses.RPL_NAMREPLY:
+                names = event.params[2].strip().split(" ")
+                name_list = name_lists[event.params[1].lower()].name_list
+                name_list.extend([strip_name_symbol(name) for name in names])
+            else:
+                self.notify(client, event)
 
 
 
 class ListReplyListener(ReplyListener):
+    stateful = True
     
     class ListReplyEvent(Event):
         def __init__(self, channel_list):
@@ -468,12 +1296,17 @@ class ListReplyListener(ReplyListener):
         ReplyListener.__init__(self)
         self.channel_list = []
     
+    def copy(self):
+        listener = ReplyListener.copy(self)
+        listener.channel_list = []
+        return listener
+    
     def notify(self, client, event):
-        if event.command == "RPL_LIST":
+        if event.numeric == responses.RPL_LIST:
             # <channel> <# visible> :<topic>
             channel_data = (event.params[0].lower(), event.params[1], event.params[2])
             self.channel_list.append(channel_data)
-        elif event.command == "RPL_LISTEND":
+        elif event.numeric == responses.RPL_LISTEND:
             # :End of LIST
             list_event = self.ListReplyEvent(self.channel_list)
             self.activate_handlers(client, list_event)
@@ -483,6 +1316,7 @@ class ListReplyListener(ReplyListener):
 
 class WhoisReplyListener(ReplyListener):
     """ http://tools.ietf.org/html/rfc1459#section-4.5.2 """
+    stateful = True
     
     class WhoisReplyEvent(Event):
         def __init__(self):
@@ -499,29 +1333,35 @@ class WhoisReplyListener(ReplyListener):
         ReplyListener.__init__(self)
         self._whois_replies = collections.defaultdict(self.WhoisReplyEvent)
     
+    def copy(self):
+        listener = ReplyListener.copy(self)
+        listener._whois_replies = collections.defaultdict(
+            self.WhoisReplyEvent)
+        return listener
+    
     def notify(self, client, event):
-        if event.command == "RPL_WHOISUSER":
+        if event.numeric == responses.RPL_WHOISUSER:
             # <nick> <user> <host> * :<real name>
             reply = self._whois_replies[event.params[1]]
             reply.nick = event.params[0] 
             reply.user = event.params[1] 
             reply.host = event.params[2] 
             reply.real_name = event.params[4]
-        elif event.command == "RPL_WHOISCHANNELS":
+        elif event.numeric == responses.RPL_WHOISCHANNELS:
             # <nick> :*( ( "@" / "+" ) <channel> " " )
             channels = event.params[1].strip().split()
             channels = list(map(protocol.strip_name_symbol, channels))
             self._whois_replies[event.params[0]].channels.extend(channels)
-        elif event.command == "RPL_WHOISSERVER":
+        elif event.numeric == responses.RPL_WHOISSERVER:
             # <nick> <server> :<server info> 
             self._whois_replies[event.params[0]].server = event.params[1]
-        elif event.command == "RPL_WHOISIDLE":
+        elif event.numeric == responses.RPL_WHOISIDLE:
             # <nick> <integer> :seconds idle
             self._whois_replies[event.params[0]].idle_time = event.params[1]
-        elif event.command == "RPL_WHOISOPERATOR":
+        elif event.numeric == responses.RPL_WHOISOPERATOR:
             # <nick> :is an IRC operator
             self._whois_replies[event.params[0]].is_operator = True
-        elif event.command == "RPL_ENDOFWHOIS":
+        elif event.numeric == responses.RPL_ENDOFWHOIS:
             # <nick> :End of WHOIS list
             self.activate_handlers(client, self._whois_replies[event.params[0]])
             del self._whois_replies[event.params[0]]
@@ -530,6 +1370,7 @@ class WhoisReplyListener(ReplyListener):
 
 class WhoReplyListener(ReplyListener):
     """ http://tools.ietf.org/html/rfc1459#section-4.5.2 """
+    stateful = True
     
     class WhoReplyEvent(Event):
         def __init__(self):
@@ -540,8 +1381,13 @@ class WhoReplyListener(ReplyListener):
         ReplyListener.__init__(self)
         self._who_replies = collections.defaultdict(self.WhoReplyEvent)
     
+    def copy(self):
+        listener = ReplyListener.copy(self)
+        listener._who_replies = collections.defaultdict(self.WhoReplyEvent)
+        return listener
+    
     def notify(self, client, event):
-        if event.command == "RPL_WHOREPLY":
+        if event.numeric == responses.RPL_WHOREPLY:
             channel = event.params[0].lower()
             user = protocol.User()
             user.user = event.params[1]
@@ -550,7 +1396,7 @@ class WhoReplyListener(ReplyListener):
             user.nick = event.params[4]
             user.real_name = event.params[6].split()[1]
             self._who_replies[channel].user_list.append(user)
-        elif event.command == "RPL_ENDOFWHO":
+        elif event.numeric == responses.RPL_ENDOFWHO:
             channel = event.params[0].lower()
             self._who_replies[channel].channel_name = channel
             self.activate_handlers(client, self._who_replies[channel])
@@ -560,7 +1406,7 @@ class WhoReplyListener(ReplyListener):
 
 class ErrorReplyListener(ReplyListener):
     def notify(self, client, event):
-        if event.command.startswith("ERR_"):
+        if event.numeric in responses.error_values:
             self.activate_handlers(client, event)
 
 
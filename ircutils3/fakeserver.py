@@ -0,0 +1,509 @@
+""" This module has a small IRC server that runs on the same asyncore loop as
+the clients, for testing and load testing without a real network. It
+speaks enough of :rfc:`2812` and IRCv3 for
+:class:`ircutils.client.SimpleClient`: registration with ``CAP`` and SASL
+``PLAIN``, ``JOIN``, ``PART``, ``PRIVMSG``, ``NOTICE``, ``NAMES``, ``WHO``,
+``WHOIS``, ``LIST`` and the ``005`` reply. It can also flood channels with
+generated traffic::
+
+    from ircutils import bot, fakeserver, timers
+
+    server = fakeserver.FakeServer()
+    bots = []
+    for n in range(1000):
+        b = bot.SimpleBot("bot%d" % n)
+        b.connect("127.0.0.1", server.port, channel="#load")
+        bots.append(b)
+    timers.call_later(5, server.flood, "#load", 10000, per_second=2000)
+    timers.loop()
+
+A flood message can hold ``{n}`` and ``{time}``; the latter is replaced
+with ``time.time()`` when the message is sent, so the receiving handler can
+work out the end-to-end latency.
+
+"""
+import asyncore, asynchat
+import base64
+import socket
+import time
+
+from . import masks
+from . import protocol
+from . import timers
+
+
+#: The ``005`` tokens the server announces.
+isupport = ["CASEMAPPING=rfc1459", "CHANTYPES=#&", "PREFIX=(ov)@+",
+            "CHANMODES=b,k,l,imnpst", "NICKLEN=30", "CHANNELLEN=50",
+            "NETWORK=FakeNet"]
+
+#: The capabilities the server offers.
+capabilities = ["multi-prefix", "away-notify", "extended-join", "batch",
+                "sasl=PLAIN"]
+
+# The commands a client may send before it has registered.
+_unregistered_commands = frozenset(["CAP", "AUTHENTICATE", "PASS", "NICK",
+                                    "USER", "PING", "PONG", "QUIT"])
+
+
+class _Channel(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.topic = ""
+        self.members = {}
+        self.ops = set()
+
+
+class FakeServer(asyncore.dispatcher):
+    """ Listens on ``host`` and ``port``; port 0 picks a free one, which is
+    then in ``port``. If ``accounts`` is a dict of account names to
+    passwords, SASL logins are checked against it; otherwise every login
+    succeeds.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, name="irc.fake.example",
+                 accounts=None, map=None):
+        asyncore.dispatcher.__init__(self, map=map)
+        self.name = name
+        self.accounts = accounts
+        self.users = {}
+        self.channels = {}
+        self.sessions = set()
+        #: The number of lines the server has received.
+        self.lines_received = 0
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind((host, port))
+        self.listen(socket.SOMAXCONN)
+        self.host, self.port = self.socket.getsockname()[:2]
+
+    def handle_accepted(self, sock, addr):
+        self.sessions.add(_Session(self, sock, addr, self._map))
+
+    def handle_error(self):
+        raise
+
+    def find_user(self, nick):
+        return self.users.get(masks.casefold(nick))
+
+    def get_channel(self, name, create=False):
+        key = masks.casefold(name)
+        channel = self.channels.get(key)
+        if channel is None and create:
+            channel = self.channels[key] = _Channel(name)
+        return channel
+
+    def send_to_channel(self, channel, line, exclude=None):
+        data = (line + "\r\n").encode("UTF-8")
+        for member in channel.members.values():
+            if member is not exclude:
+                member.push(data)
+
+    def flood(self, channel, count, per_second=None, sources=100,
+              message="flood message {n} sent at {time}",
+              command="PRIVMSG"):
+        """ Sends ``count`` messages to everyone in ``channel`` from
+        ``sources`` made-up users. With ``per_second`` set, they're spread
+        out over time on the timer wheel; otherwise they're all sent at
+        once.
+        """
+        channel = self.get_channel(channel)
+        if channel is None:
+            return
+        chunk = count if per_second is None else \
+            max(1, int(per_second * 0.05))
+        self._flood_chunk(channel, 0, count, chunk, sources, message,
+                          command)
+
+    def _flood_chunk(self, channel, sent, count, chunk, sources, message,
+                     command):
+        end = min(count, sent + chunk)
+        lines = []
+        for n in range(sent, end):
+            source = "flood%d!flood@flood.example" % (n % sources)
+            text = message.format(n=n, time="%.6f" % time.time())
+            lines.append(":%s %s %s :%s\r\n" % (source, command,
+                                                 channel.name, text))
+        data = "".join(lines).encode("UTF-8")
+        for member in channel.members.values():
+            member.push(data)
+        if end < count:
+            timers.call_later(0.05, self._flood_chunk, channel, end, count,
+                              chunk, sources, message, command)
+
+    def netsplit(self, channel, count, split=("hub.fake.example",
+                                              "leaf.fake.example")):
+        """ Has ``count`` made-up users join ``channel`` and then quit in a
+        netsplit. Clients with the ``batch`` capability get the quits in a
+        ``netsplit`` batch. """
+        channel = self.get_channel(channel)
+        if channel is None:
+            return
+        nicks = ["split%d" % n for n in range(count)]
+        joins = "".join(":%s!split@split.example JOIN %s\r\n" %
+                        (nick, channel.name) for nick in nicks)
+        quits = [":%s!split@split.example QUIT :%s %s\r\n" %
+                 (nick, split[0], split[1]) for nick in nicks]
+        for member in channel.members.values():
+            member.push(joins.encode("UTF-8"))
+            if "batch" in member.caps:
+                reference = "ns%d" % count
+                tag = "@batch=%s " % reference
+                data = ":%s BATCH +%s netsplit %s %s\r\n" % (
+                    self.name, reference, split[0], split[1])
+                data += "".join(tag + line for line in quits)
+                data += ":%s BATCH -%s\r\n" % (self.name, reference)
+            else:
+                data = "".join(quits)
+            member.push(data.encode("UTF-8"))
+
+    def close(self):
+        for session in list(self.sessions):
+            session.close()
+        asyncore.dispatcher.close(self)
+
+
+class _Session(asynchat.async_chat):
+    """ The server's side of one client connection. """
+
+    def __init__(self, server, sock, addr, map):
+        asynchat.async_chat.__init__(self, sock, map=map)
+        self.set_terminator(b"\r\n")
+        self.server = server
+        self.host = addr[0]
+        self.nick = None
+        self.user = None
+        self.real_name = None
+        self.account = None
+        self.caps = set()
+        self.registered = False
+        self.negotiating = False
+        self.channels = set()
+        self._sasl = False
+        self._incoming = []
+
+    def collect_incoming_data(self, data):
+        self._incoming.append(data)
+
+    def found_terminator(self):
+        data = b"".join(self._incoming).decode("UTF-8", "ignore")
+        self._incoming = []
+        if not data:
+            return
+        self.server.lines_received += 1
+        prefix, command, params = protocol.parse_line(data)
+        if not self.registered and \
+           command.upper() not in _unregistered_commands:
+            self.reply("451", "You have not registered")
+            return
+        handler = getattr(self, "irc_" + command.upper(), None)
+        if handler is None:
+            self.reply("421", command, "Unknown command")
+        else:
+            handler(params)
+
+    @property
+    def prefix(self):
+        return "%s!%s@%s" % (self.nick, self.user, self.host)
+
+    def send_line(self, line):
+        self.push((line + "\r\n").encode("UTF-8"))
+
+    def reply(self, numeric, *params):
+        params = list(params)
+        if params:
+            params[-1] = ":" + params[-1]
+        self.send_line(" ".join([":" + self.server.name, numeric,
+                                 self.nick or "*"] + params))
+
+    def handle_error(self):
+        raise
+
+    def handle_close(self):
+        self.quit("Connection closed")
+
+    def quit(self, reason):
+        if self.nick is not None and \
+           self.server.users.get(masks.casefold(self.nick)) is self:
+            line = ":%s QUIT :%s" % (self.prefix, reason)
+            told = set()
+            for channel in list(self.channels):
+                for member in channel.members.values():
+                    if member is not self and member not in told:
+                        told.add(member)
+                        member.send_line(line)
+                self._leave(channel)
+            del self.server.users[masks.casefold(self.nick)]
+        self.server.sessions.discard(self)
+        self.close()
+
+    def _leave(self, channel):
+        channel.members.pop(masks.casefold(self.nick), None)
+        channel.ops.discard(self)
+        self.channels.discard(channel)
+        if not channel.members:
+            self.server.channels.pop(masks.casefold(channel.name),
+                                     None)
+
+    # Registration
+
+    def irc_CAP(self, params):
+        subcommand = params[0].upper() if params else ""
+        if subcommand == "LS":
+            self.negotiating = True
+            self.reply("CAP", "LS", " ".join(capabilities))
+        elif subcommand == "REQ":
+            offered = set(cap.split("=")[0] for cap in capabilities)
+            wanted = params[-1].split()
+            if all(cap.lstrip("-") in offered for cap in wanted):
+                for cap in wanted:
+                    if cap.startswith("-"):
+                        self.caps.discard(cap[1:])
+                    else:
+                        self.caps.add(cap)
+                self.reply("CAP", "ACK", params[-1])
+            else:
+                self.reply("CAP", "NAK", params[-1])
+        elif subcommand == "END":
+            self.negotiating = False
+            self._try_register()
+
+    def irc_AUTHENTICATE(self, params):
+        if not params:
+            return
+        if params[0] == "PLAIN":
+            self._sasl = True
+            self.send_line("AUTHENTICATE +")
+            return
+        if params[0] == "*" or not self._sasl:
+            self.reply("906", "SASL authentication aborted")
+            return
+        self._sasl = False
+        try:
+            authzid, name, password = base64.b64decode(params[0]) \
+                .decode("UTF-8").split("\0")
+        except ValueError:
+            self.reply("904", "SASL authentication failed")
+            return
+        accounts = self.server.accounts
+        if accounts is not None and accounts.get(name) != password:
+            self.reply("904", "SASL authentication failed")
+            return
+        self.account = name
+        self.reply("900", "%s!%s@%s" % (self.nick or "*", self.user or "*",
+                                        self.host), name,
+                   "You are now logged in as %s" % name)
+        self.reply("903", "SASL authentication successful")
+
+    def irc_PASS(self, params):
+        pass
+
+    def irc_NICK(self, params):
+        if not params:
+            self.reply("431", "No nickname given")
+            return
+        nick = params[0]
+        if not protocol.is_nick(nick):
+            self.reply("432", nick, "Erroneous nickname")
+            return
+        other = self.server.find_user(nick)
+        if other is not None and other is not self:
+            self.reply("433", nick, "Nickname is already in use")
+            return
+        if self.nick is not None:
+            del self.server.users[masks.casefold(self.nick)]
+        if self.registered:
+            line = ":%s NICK :%s" % (self.prefix, nick)
+            told = set([self])
+            self.send_line(line)
+            for channel in self.channels:
+                channel.members.pop(masks.casefold(self.nick), None)
+                channel.members[masks.casefold(nick)] = self
+                for member in channel.members.values():
+                    if member not in told:
+                        told.add(member)
+                        member.send_line(line)
+        self.nick = nick
+        self.server.users[masks.casefold(nick)] = self
+        self._try_register()
+
+    def irc_USER(self, params):
+        if len(params) < 4:
+            self.reply("461", "USER", "Not enough parameters")
+            return
+        self.user = params[0]
+        self.real_name = params[3]
+        self._try_register()
+
+    def _try_register(self):
+        if self.registered or self.negotiating or \
+           self.nick is None or self.user is None:
+            return
+        self.registered = True
+        name = self.server.name
+        self.reply("001", "Welcome to FakeNet, %s" % self.prefix)
+        self.reply("002", "Your host is %s" % name)
+        self.reply("003", "This server was created just now")
+        self.reply("004", name, "fakeserver", "iow", "biklmnopstv")
+        self.reply("005", *(isupport + ["are supported by this server"]))
+        self.reply("422", "MOTD File is missing")
+
+    def irc_PING(self, params):
+        self.send_line(":%s PONG %s :%s" % (self.server.name,
+                                            self.server.name,
+                                            params[-1] if params else ""))
+
+    def irc_PONG(self, params):
+        pass
+
+    def irc_QUIT(self, params):
+        self.quit(params[0] if params else "Quit")
+
+    # Everything else is only allowed once registered; found_terminator
+    # answers ERR_NOTREGISTERED before that.
+
+    def irc_JOIN(self, params):
+        if not params:
+            return
+        if params[0] == "0":
+            for channel in list(self.channels):
+                self.irc_PART([channel.name])
+            return
+        for name in params[0].split(","):
+            if not protocol.is_channel(name):
+                self.reply("403", name, "No such channel")
+                continue
+            channel = self.server.get_channel(name, create=True)
+            key = masks.casefold(self.nick)
+            if key in channel.members:
+                continue
+            if not channel.members:
+                channel.ops.add(self)
+            channel.members[key] = self
+            self.channels.add(channel)
+            for member in channel.members.values():
+                if "extended-join" in member.caps:
+                    member.send_line(":%s JOIN %s %s :%s" % (
+                        self.prefix, channel.name, self.account or "*",
+                        self.real_name))
+                else:
+                    member.send_line(":%s JOIN %s" % (self.prefix,
+                                                      channel.name))
+            if channel.topic:
+                self.reply("332", channel.name, channel.topic)
+            self._send_names(channel)
+
+    def irc_PART(self, params):
+        if not params:
+            return
+        reason = params[1] if len(params) > 1 else ""
+        for name in params[0].split(","):
+            channel = self.server.get_channel(name)
+            if channel is None or channel not in self.channels:
+                self.reply("442", name, "You're not on that channel")
+                continue
+            self.server.send_to_channel(
+                channel, ":%s PART %s :%s" % (self.prefix, channel.name,
+                                              reason))
+            self._leave(channel)
+
+    def irc_PRIVMSG(self, params, command="PRIVMSG"):
+        if len(params) < 2:
+            self.reply("412", "No text to send")
+            return
+        line = ":%s %s %s :%s" % (self.prefix, command, params[0], params[1])
+        for target in params[0].split(","):
+            if protocol.is_channel(target):
+                channel = self.server.get_channel(target)
+                if channel is None:
+                    self.reply("403", target, "No such channel")
+                else:
+                    self.server.send_to_channel(channel, line, exclude=self)
+            else:
+                user = self.server.find_user(target)
+                if user is None:
+                    self.reply("401", target, "No such nick/channel")
+                else:
+                    user.send_line(line)
+
+    def irc_NOTICE(self, params):
+        self.irc_PRIVMSG(params, "NOTICE")
+
+    def irc_TOPIC(self, params):
+        channel = self.server.get_channel(params[0]) if params else None
+        if channel is None:
+            return
+        if len(params) > 1:
+            channel.topic = params[1]
+            self.server.send_to_channel(
+                channel, ":%s TOPIC %s :%s" % (self.prefix, channel.name,
+                                               channel.topic))
+        elif channel.topic:
+            self.reply("332", channel.name, channel.topic)
+        else:
+            self.reply("331", channel.name, "No topic is set")
+
+    def _member_prefix(self, channel, member):
+        return "@" if member in channel.ops else ""
+
+    def _send_names(self, channel):
+        names = [self._member_prefix(channel, member) + member.nick
+                 for member in channel.members.values()]
+        for start in range(0, len(names), 50):
+            self.reply("353", "=", channel.name,
+                       " ".join(names[start:start + 50]))
+        self.reply("366", channel.name, "End of /NAMES list.")
+
+    def irc_NAMES(self, params):
+        for name in params[0].split(",") if params else []:
+            channel = self.server.get_channel(name)
+            if channel is None:
+                self.reply("366", name, "End of /NAMES list.")
+            else:
+                self._send_names(channel)
+
+    def irc_WHO(self, params):
+        mask = params[0] if params else "*"
+        channel = self.server.get_channel(mask)
+        if channel is not None:
+            members = [(channel.name, member)
+                       for member in channel.members.values()]
+        else:
+            user = self.server.find_user(mask)
+            members = [("*", user)] if user is not None else []
+        for channel_name, member in members:
+            self.reply("352", channel_name, member.user, member.host,
+                       self.server.name, member.nick, "H",
+                       "0 %s" % member.real_name)
+        self.reply("315", mask, "End of /WHO list.")
+
+    def irc_WHOIS(self, params):
+        if not params:
+            return
+        nick = params[-1]
+        user = self.server.find_user(nick)
+        if user is None:
+            self.reply("401", nick, "No such nick/channel")
+        else:
+            self.reply("311", user.nick, user.user, user.host, "*",
+                       user.real_name)
+            if user.channels:
+                self.reply("319", user.nick, " ".join(
+                    self._member_prefix(channel, user) + channel.name
+                    for channel in user.channels))
+            self.reply("312", user.nick, self.server.name, "FakeNet")
+            if user.account is not None:
+                self.reply("330", user.nick, user.account, "is logged in as")
+        self.reply("318", nick, "End of /WHOIS list.")
+
+    def irc_LIST(self, params):
+        self.reply("321", "Channel", "Users  Name")
+        for channel in list(self.server.channels.values()):
+            self.reply("322", channel.name, str(len(channel.members)),
+                       channel.topic)
+        self.reply("323", "End of /LIST")
+
+    def irc_MODE(self, params):
+        if params and protocol.is_channel(params[0]) and len(params) == 1:
+            self.reply("324", params[0], "+nt")
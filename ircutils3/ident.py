@@ -1,14 +1,17 @@
 """ This module contains a quick ident server implentation: 
-``IdentServer``. IdentServer is a functional ident server that returns fake data
-and can be used with IRC bots or clients. This is useful for two reasons; it
-speeds up connection time, and some servers require an ident response for 
-security purposes.
+``IdentServer``. IdentServer is a functional ident server that answers for 
+the connections of IRC bots or clients, and returns fake data for anything 
+else. This is useful for two reasons; it speeds up connection time, and some
+servers require an ident response for security purposes.
 
 """
 import asyncore, asynchat
 import os
 import socket
 import uuid
+import weakref
+
+from . import timers
 
 
 def get_operating_system():
@@ -41,30 +44,46 @@ class _IdentChannel(asynchat.async_chat):
     to the IdentServer. It isn't designed to be used directly.
     """
     
-    def __init__(self, userid, sock, addr):
+    def __init__(self, server, sock, map=None):
         """ Set up the object by specifying the terminator and initializing the
         input buffer and using the socket passed from the dispatcher. The 
-        terminator for the ident protocol is CR+LF.
+        terminator for the ident protocol is CR+LF, but a bare LF is 
+        accepted too.
         """
-        asynchat.async_chat.__init__(self, sock)
-        self.set_terminator("\r\n")
-        self.userid = userid
-        self.collect_incoming_data = self._collect_incoming_data
+        asynchat.async_chat.__init__(self, sock, map)
+        self.set_terminator(b"\n")
+        self.server = server
+        self.incoming = []
+        self._received = 0
+        self._timer = timers.call_later(server.timeout, self.close)
+
+    def collect_incoming_data(self, data):
+        self._received += len(data)
+        if self._received > self.server.max_request_size:
+            self.close()
+            return
+        self.incoming.append(data)
 
     def found_terminator(self):
-        """ When this is activated, it means that the terminator (\r\n) has been
+        """ When this is activated, it means that the terminator (\n) has been
         read. When that happens, we get the input data, clear the buffer,
         and then handle the data collected.
         """
-        request = "".join(self.incoming)
-        sysos = get_operating_system()
-        
-        response = (request, "USERID", sysos, self.userid)
-        
+        request = b"".join(self.incoming).decode("ascii", "replace").strip()
         self.incoming = []
-        self.push(":".join(response))
+        self.set_terminator(None)
+        self.push(("%s\r\n" % self.server.answer(request)).encode("ascii"))
         self.close_when_done()
 
+    def handle_error(self):
+        self.close()
+
+    def close(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        asynchat.async_chat.close(self)
+
 
 
 
@@ -73,18 +92,116 @@ class IdentServer(asyncore.dispatcher):
     with an IRC bot or client, be sure to use ``start_all()`` instead of 
     calling the ``start()`` method.
     
+    Each query names the two ports of a connection. The connections of the
+    clients given to :meth:`attach`, and the port pairs given to 
+    :meth:`register`, are answered with their own user ID; a client is 
+    answered with its ``user``. Any other connection gets ``userid``, or a 
+    ``NO-USER`` error if ``fallback`` is false. A request that isn't 
+    finished within ``timeout`` seconds, or that is longer than 
+    ``max_request_size`` bytes, is dropped.
+    
     """
-    def __init__(self, port=113, userid=None):
-        asyncore.dispatcher.__init__(self)
+    #: The longest request that's read, in bytes. Valid ones are much 
+    #: shorter.
+    max_request_size = 64
+    #: Whether connections that aren't known are answered with ``userid``.
+    fallback = True
+    
+    def __init__(self, port=113, userid=None, host="", timeout=30.0, 
+                 map=None):
+        asyncore.dispatcher.__init__(self, map=map)
         self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.bind(("", port))
-        self.listen(5)
+        self.set_reuse_addr()
+        self.bind((host, port))
+        self.listen(socket.SOMAXCONN)
         self.userid = userid or generate_fake_userid()
+        self.timeout = timeout
+        self._users = {}
+        self._clients = weakref.WeakSet()
+        # The (local port, remote port) of every client connection that's 
+        # been looked up.
+        self._ports = weakref.WeakKeyDictionary()
         
     def handle_accept(self):
         """ Dispatch a request onto an _IdentChannel instance. """
-        _IdentChannel(self.userid, *self.accept())
+        pair = self.accept()
+        if pair is not None:
+            _IdentChannel(self, pair[0], self._map)
+    
+    def attach(self, client):
+        """ Answers for the connections ``client`` makes with its user name.
+        """
+        self._clients.add(client)
+    
+    def detach(self, client):
+        """ Stops answering for the connections of ``client``. """
+        self._clients.discard(client)
+    
+    def register(self, local_port, remote_port, userid):
+        """ Answers for the connection from ``local_port`` to 
+        ``remote_port`` with ``userid``. """
+        self._users[(local_port, remote_port)] = userid
+    
+    def unregister(self, local_port, remote_port):
+        """ Forgets a connection added with :meth:`register`. """
+        self._users.pop((local_port, remote_port), None)
+    
+    def lookup(self, local_port, remote_port):
+        """ Returns the user ID for a connection, or ``None`` if it isn't 
+        known. """
+        userid = self._users.get((local_port, remote_port))
+        if userid is not None:
+            return userid
+        pair = (local_port, remote_port)
+        ports = self._ports
+        for client in list(self._clients):
+            conn = getattr(client, "conn", None)
+            if conn is None:
+                continue
+            conn_pair = ports.get(conn)
+            if conn_pair is None:
+                conn_pair = _get_ports(conn)
+                if conn_pair is None:
+                    continue
+                ports[conn] = conn_pair
+            if conn_pair == pair:
+                return client.user
+        return None
+    
+    def answer(self, request):
+        """ Returns the response line to an ident request, such as 
+        ``"6193, 23"``, without the line ending. """
+        try:
+            local_port, remote_port = [int(port) for port in 
+                                       request.split(",")]
+        except ValueError:
+            return "0, 0 : ERROR : INVALID-PORT"
+        if not (0 < local_port < 65536 and 0 < remote_port < 65536):
+            return "%d, %d : ERROR : INVALID-PORT" % (local_port, remote_port)
+        userid = self.lookup(local_port, remote_port)
+        if userid is None:
+            if not self.fallback:
+                return "%d, %d : ERROR : NO-USER" % (local_port, remote_port)
+            userid = self.userid
+        return "%d, %d : USERID : %s : %s" % (local_port, remote_port, 
+                                               get_operating_system(), 
+                                               userid)
         
     def start(self):
         """ Begin serving ident requests on the port specified. """
-        asyncore.loop(map=self._map)
\ No newline at end of file
+        timers.loop(map=self._map)
+
+
+def _get_ports(conn):
+    """ Returns the local and remote port of a 
+    :class:`ircutils.connection.Connection`, or ``None`` if it isn't 
+    connected. A connection isn't marked as connected until its TLS 
+    handshake is done, which is when servers ask, so the socket is asked
+    instead. """
+    sock = getattr(conn, "socket", None)
+    if sock is None:
+        return None
+    try:
+        return sock.getsockname()[1], sock.getpeername()[1]
+    except (OSError, IndexError):
+        return None
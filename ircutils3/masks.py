@@ -0,0 +1,219 @@
+""" This module matches ``nick!user@host`` prefixes against wildcard masks,
+such as the masks in ban, ignore, and access lists. In a mask, ``*`` matches
+any number of characters and ``?`` matches exactly one.
+
+Large lists are compiled into a single regular expression that is shaped like
+a trie of the masks, so masks that share a beginning (like every
+``*!*@...`` mask) are only walked once per prefix. ::
+
+    >>> ignored = MaskSet(["*!*@*.spam.example", "troll"])
+    >>> ignored.match("troll!~t@home.example")
+    True
+    >>> ignored.match("friend!~f@home.example")
+    False
+
+"""
+import re
+
+from . import protocol
+
+
+_ascii_lower = dict((ord(c), ord(c.lower()))
+                    for c in "ABCDEFGHIJKLMNOPQRSTUVWXYZ")
+_strict_rfc1459 = dict(_ascii_lower)
+_strict_rfc1459.update({ord("["): ord("{"), ord("]"): ord("}"),
+                        ord("\\"): ord("|")})
+_rfc1459 = dict(_strict_rfc1459)
+_rfc1459[ord("~")] = ord("^")
+
+#: Translation tables for the casemappings servers announce in ``005``.
+casemappings = {
+    "ascii": _ascii_lower,
+    "strict-rfc1459": _strict_rfc1459,
+    "rfc1459": _rfc1459,
+    }
+
+
+def casefold(text, casemapping="rfc1459"):
+    """ Lower-cases ``text`` the way the server does when comparing names.
+    With ``rfc1459``, ``[]\\~`` are the upper-case forms of ``{}|^``.
+
+        >>> casefold("Nick[away]")
+        'nick{away}'
+    """
+    return text.translate(casemappings[casemapping])
+
+
+def normalize_mask(mask):
+    """ Fills in the missing parts of a mask, the same way servers do for
+    bans.
+
+        >>> normalize_mask("nick")
+        'nick!*@*'
+        >>> normalize_mask("*@host.example")
+        '*!*@host.example'
+    """
+    if "!" not in mask and "@" not in mask:
+        return mask + "!*@*"
+    if "!" not in mask:
+        return "*!" + mask
+    if "@" not in mask:
+        return mask + "@*"
+    return mask
+
+
+def _is_wild(mask):
+    return "*" in mask or "?" in mask
+
+
+def _mask_tokens(mask):
+    for char in mask:
+        if char == "*":
+            yield ".*"
+        elif char == "?":
+            yield "."
+        else:
+            yield re.escape(char)
+
+
+def compile_mask(mask, flags=re.DOTALL):
+    """ Compiles a single wildcard mask into a regular expression that has to
+    match the whole string. """
+    return re.compile("".join(_mask_tokens(mask)) + r"\Z", flags)
+
+
+def _event_prefix(event):
+    return "%s!%s@%s" % (event.source, getattr(event, "user", None) or "",
+                         getattr(event, "host", None) or "")
+
+
+class _TrieNode(object):
+    __slots__ = ("children", "end")
+
+    def __init__(self):
+        self.children = {}
+        self.end = False
+
+
+class MaskSet(object):
+    """ A set of masks that can be matched against a prefix in one go. Masks
+    are normalized with :func:`normalize_mask` and compared using the
+    given casemapping. Masks without wildcards are kept in a plain set; the
+    rest are compiled into a single regex the first time it's needed after
+    a change.
+    """
+
+    def __init__(self, masks=(), casemapping="rfc1459"):
+        self.casemapping = casemapping
+        self._masks = set()
+        self._exact = set()
+        self._regex = None
+        self._dirty = False
+        for mask in masks:
+            self.add(mask)
+
+    def __len__(self):
+        return len(self._masks)
+
+    def __iter__(self):
+        return iter(self._masks)
+
+    def __contains__(self, mask):
+        return self._fold(normalize_mask(mask)) in self._masks
+
+    def _fold(self, text):
+        return text.translate(casemappings[self.casemapping])
+
+    def add(self, mask):
+        """ Adds a mask to the set. """
+        mask = self._fold(normalize_mask(mask))
+        if mask in self._masks:
+            return
+        self._masks.add(mask)
+        if _is_wild(mask):
+            self._dirty = True
+        else:
+            self._exact.add(mask)
+
+    def discard(self, mask):
+        """ Removes a mask if it is in the set. """
+        mask = self._fold(normalize_mask(mask))
+        if mask not in self._masks:
+            return
+        self._masks.discard(mask)
+        if _is_wild(mask):
+            self._dirty = True
+        else:
+            self._exact.discard(mask)
+
+    def clear(self):
+        """ Removes every mask. """
+        self._masks.clear()
+        self._exact.clear()
+        self._regex = None
+        self._dirty = False
+
+    def _compile(self):
+        """ Builds a trie out of the wildcard masks and turns it into one
+        regular expression. """
+        root = _TrieNode()
+        for mask in self._masks:
+            if not _is_wild(mask):
+                continue
+            node = root
+            for token in _mask_tokens(mask):
+                child = node.children.get(token)
+                if child is None:
+                    child = node.children[token] = _TrieNode()
+                node = child
+            node.end = True
+        if root.children:
+            self._regex = re.compile(self._emit(root), re.DOTALL)
+        else:
+            self._regex = None
+        self._dirty = False
+
+    def _emit(self, node):
+        """ Writes out the regex for the part of the trie below ``node``.
+        Chains of single children are written without any grouping. """
+        parts = []
+        while not node.end and len(node.children) == 1:
+            token, node = next(iter(node.children.items()))
+            parts.append(token)
+        branches = []
+        if node.end:
+            branches.append(r"\Z")
+        for token, child in node.children.items():
+            branches.append(token + self._emit(child))
+        if len(branches) == 1:
+            parts.append(branches[0])
+        elif branches:
+            parts.append("(?:%s)" % "|".join(branches))
+        return "".join(parts)
+
+    def match(self, prefix):
+        """ Checks if a ``nick!user@host`` prefix matches any mask. """
+        prefix = self._fold(prefix)
+        if prefix in self._exact:
+            return True
+        if self._dirty:
+            self._compile()
+        return self._regex is not None and \
+               self._regex.match(prefix) is not None
+
+    def match_user(self, nick, user, host):
+        """ Same as :meth:`match` but takes the parts of the prefix. """
+        return self.match(protocol.create_prefix(nick, user or "", host or ""))
+
+    def allows(self, client, event):
+        """ Returns ``False`` for events whose source matches one of the
+        masks. It can be used as a filter for
+        :meth:`ircutils.events.EventDispatcher.add_filter` to drop events
+        from ignored users before any listener sees them::
+
+            ignored = masks.MaskSet(["*!*@*.spam.example"])
+            client.events.add_filter(ignored.allows)
+        """
+        if event.source is None:
+            return True
+        return not self.match(_event_prefix(event))
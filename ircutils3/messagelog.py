@@ -0,0 +1,343 @@
+""" This module keeps a persistent log of the messages a client sees. It
+hooks into the client's events, so logging costs the loop no more than
+appending to a list; a writer thread does the actual writing, a batch at a
+time::
+
+    from ircutils import bot, messagelog
+
+    log = messagelog.MessageLog("logs/", compress=True)
+    my_bot = bot.SimpleBot("LogBot")
+    log.attach(my_bot)
+
+    ...
+
+    for record in log.query(channel="#ircutils", start=time.time() - 3600):
+        print(record.time, record.source, record.text)
+
+The log is a directory of append-only segments. Each batch the writer
+takes is stored as one block per channel, optionally compressed with
+``zlib``, and every block gets a fixed-size entry in the segment's index
+with the batch's time span and the block's channel. Records are stored one
+per line with tab-separated fields; tabs, newlines and backslashes inside a
+field are escaped. Queries memory-map the index, skip straight to the first
+block in range, and only read the blocks of the channel they ask for.
+
+"""
+import collections
+import itertools
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+import zlib
+
+from . import protocol
+
+
+#: A single logged message.
+LogRecord = collections.namedtuple("LogRecord",
+                                   "time channel source command text")
+
+# batch first time, batch last time, offset, length, channel crc32, count,
+# flags
+_index_entry = struct.Struct("<ddQIIIB3x")
+_COMPRESSED = 1
+_segment_name = re.compile(r"^(\d+)\.log$")
+
+
+_escapes = {"\\": "\\\\", "\t": "\\t", "\n": "\\n"}
+_unescapes = {"\\": "\\", "t": "\t", "n": "\n"}
+_escaped = re.compile(r"[\\\t\n]")
+_unescaped = re.compile(r"\\(.)")
+
+
+def _escape(field):
+    """ Escapes the backslashes, tabs and newlines in a record field, so
+    they can't split the record. """
+    return _escaped.sub(lambda match: _escapes[match.group()], field)
+
+
+def _unescape(field):
+    if "\\" not in field:
+        return field
+    return _unescaped.sub(lambda match: _unescapes[match.group(1)], field)
+
+
+def _channel_key(channel):
+    return zlib.crc32(channel.encode("UTF-8"))
+
+
+def _event_record(event):
+    """ Turns a message event into a :class:`LogRecord`. Private messages
+    are filed under the sender's name. """
+    text = getattr(event, "message", None)
+    if text is None:
+        params = event.params
+        text = params if isinstance(params, str) else " ".join(params)
+    target = event.target or ""
+    channel = target if protocol.is_channel(target) else event.source
+    return LogRecord(time.time(), (channel or "").lower(), event.source or "",
+                     event.command, text)
+
+
+class _Segment(object):
+    """ One data file and the index that goes with it. """
+
+    def __init__(self, directory, start):
+        self.start = start
+        base = os.path.join(directory, "%d" % start)
+        self.data_path = base + ".log"
+        self.index_path = base + ".idx"
+
+    def size(self):
+        try:
+            return os.path.getsize(self.data_path)
+        except OSError:
+            return 0
+
+    def entries(self):
+        """ Returns the index entries as a list of tuples. """
+        try:
+            with open(self.index_path, "rb") as index:
+                size = os.fstat(index.fileno()).st_size
+                size -= size % _index_entry.size
+                if not size:
+                    return []
+                with mmap.mmap(index.fileno(), size,
+                               access=mmap.ACCESS_READ) as view:
+                    return list(_index_entry.iter_unpack(view))
+        except FileNotFoundError:
+            return []
+
+
+class MessageLog(object):
+    """ Writes messages to the segments in ``directory``. A new segment is
+    started once the current one grows past ``segment_size`` bytes. The
+    writer thread wakes up every ``flush_interval`` seconds, or as soon as
+    ``batch_size`` messages are waiting.
+    """
+
+    def __init__(self, directory, compress=False, segment_size=64 << 20,
+                 flush_interval=1.0, batch_size=5000):
+        self.directory = directory
+        self.compress = compress
+        self.segment_size = segment_size
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        os.makedirs(directory, exist_ok=True)
+        self._segments = self._find_segments()
+        self._pending = []
+        self._condition = threading.Condition()
+        self._written = threading.Condition()
+        self._taken = 0
+        self._done = 0
+        self._closing = False
+        # What stopped the writer thread, if it failed.
+        self._error = None
+        self._thread = threading.Thread(target=self._run,
+                                        name="ircutils-messagelog",
+                                        daemon=True)
+        self._thread.start()
+
+    def _find_segments(self):
+        segments = []
+        for name in os.listdir(self.directory):
+            match = _segment_name.match(name)
+            if match:
+                segments.append(_Segment(self.directory,
+                                         int(match.group(1))))
+        segments.sort(key=lambda segment: segment.start)
+        return segments
+
+    def attach(self, client, listeners=("message", "notice", "ctcp_action")):
+        """ Starts logging the events of the given listeners on ``client``.
+        """
+        for name in listeners:
+            client.events[name].add_handler(self.handle_event)
+
+    def detach(self, client, listeners=("message", "notice", "ctcp_action")):
+        """ Stops logging ``client``. """
+        for name in listeners:
+            client.events[name].remove_handler(self.handle_event)
+
+    def handle_event(self, client, event):
+        """ The event handler that :meth:`attach` adds. """
+        self.append(_event_record(event))
+
+    def append(self, record):
+        """ Queues a :class:`LogRecord` to be written. If the writer thread
+        has failed, its error is raised instead. """
+        if self._error is not None:
+            raise self._error
+        with self._condition:
+            self._pending.append(record)
+            if len(self._pending) >= self.batch_size:
+                self._condition.notify()
+
+    def flush(self, timeout=None):
+        """ Waits until everything queued so far has been written. Raises 
+        the error that stopped the writer thread, if it failed. """
+        with self._condition:
+            target = self._taken + len(self._pending)
+            self._condition.notify()
+        with self._written:
+            written = self._written.wait_for(
+                lambda: self._done >= target or self._error is not None,
+                timeout)
+        if self._error is not None:
+            raise self._error
+        return written
+
+    def close(self):
+        """ Writes what's left and stops the writer thread. Raises the error
+        that stopped the writer thread, if it failed. """
+        with self._condition:
+            self._closing = True
+            self._condition.notify()
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+    def _run(self):
+        while True:
+            with self._condition:
+                if not self._pending and not self._closing:
+                    self._condition.wait(self.flush_interval)
+                records, self._pending = self._pending, []
+                self._taken += len(records)
+                closing = self._closing
+            if records:
+                try:
+                    self._write_block(records)
+                except Exception as error:
+                    with self._written:
+                        self._error = error
+                        self._written.notify_all()
+                    return
+            with self._written:
+                self._done += len(records)
+                self._written.notify_all()
+            if closing and not records:
+                return
+
+    def _current_segment(self, now):
+        if not self._segments or \
+           self._segments[-1].size() >= self.segment_size:
+            self._segments.append(_Segment(self.directory, int(now * 1000)))
+        return self._segments[-1]
+
+    def _write_block(self, records):
+        """ Writes a batch of records, one block per channel. The entries of
+        every block get the time span of the whole batch, which keeps the 
+        index sorted by time. The data goes out before the index entries, so
+        readers never find an entry whose data isn't there yet. """
+        by_channel = collections.defaultdict(list)
+        for record in records:
+            by_channel[record.channel].append(record)
+        first, last = records[0].time, records[-1].time
+        segment = self._current_segment(first)
+        flags = _COMPRESSED if self.compress else 0
+        entries = []
+        with open(segment.data_path, "ab") as data:
+            offset = data.tell()
+            for channel, channel_records in by_channel.items():
+                block = "".join("%r\t%s\n" % (record.time, "\t".join(
+                    map(_escape, record[1:]))) for record in channel_records)
+                block = block.encode("UTF-8")
+                if self.compress:
+                    block = zlib.compress(block)
+                data.write(block)
+                entries.append(_index_entry.pack(
+                    first, last, offset, len(block), _channel_key(channel),
+                    len(channel_records), flags))
+                offset += len(block)
+        with open(segment.index_path, "ab") as index:
+            index.write(b"".join(entries))
+
+    def query(self, start=None, end=None, channel=None):
+        """ Yields the logged :class:`LogRecord` objects from ``start`` to
+        ``end`` (as ``time.time()`` values) in time order, for one channel 
+        or for all of them. Records that are still queued aren't included; 
+        call :meth:`flush` first to see them.
+        """
+        if channel is not None:
+            channel = channel.lower()
+            key = _channel_key(channel)
+        segments = list(self._segments) or self._find_segments()
+        for position, segment in enumerate(segments):
+            if end is not None and segment.start / 1000.0 > end:
+                break
+            if start is not None and position + 1 < len(segments) and \
+               segments[position + 1].start / 1000.0 < start:
+                continue
+            entries = segment.entries()
+            first = 0
+            if start is not None:
+                first = self._first_entry(entries, start)
+            wanted = [entry for entry in entries[first:]
+                      if channel is None or entry[4] == key]
+            if wanted:
+                for record in self._read(segment, wanted, start, end,
+                                         channel):
+                    yield record
+
+    @staticmethod
+    def _first_entry(entries, start):
+        """ Finds the first entry that may hold records at or after
+        ``start``. """
+        low, high = 0, len(entries)
+        while low < high:
+            middle = (low + high) // 2
+            if entries[middle][1] < start:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def _read(self, segment, entries, start, end, channel):
+        with open(segment.data_path, "rb") as data:
+            size = os.fstat(data.fileno()).st_size
+            with mmap.mmap(data.fileno(), size,
+                           access=mmap.ACCESS_READ) as view:
+                # The blocks of one batch are read together and put back 
+                # into time order.
+                for span, batch in itertools.groupby(entries, _entry_span):
+                    if end is not None and span[0] > end:
+                        return
+                    records = []
+                    for entry in batch:
+                        records.extend(self._read_block(view, entry, start,
+                                                        end, channel))
+                    if len(records) > 1:
+                        records.sort(key=_record_time)
+                    for record in records:
+                        yield record
+
+    @staticmethod
+    def _read_block(view, entry, start, end, channel):
+        offset, length, flags = entry[2], entry[3], entry[6]
+        block = view[offset:offset + length]
+        if flags & _COMPRESSED:
+            block = zlib.decompress(block)
+        # Only split on newlines; messages may hold other line breaks.
+        for line in block.decode("UTF-8").split("\n")[:-1]:
+            stamp, name, source, command, text = map(_unescape,
+                                                     line.split("\t", 4))
+            stamp = float(stamp)
+            if start is not None and stamp < start:
+                continue
+            if end is not None and stamp > end:
+                break
+            if channel is not None and name != channel:
+                continue
+            yield LogRecord(stamp, name, source, command, text)
+
+
+def _entry_span(entry):
+    return entry[0], entry[1]
+
+
+def _record_time(record):
+    return record.time
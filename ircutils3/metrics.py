@@ -0,0 +1,292 @@
+""" This module counts what goes through a client: lines and bytes in each
+direction, how long every listener and handler takes, how many lines are
+waiting to be sent and the lag to each server. Nothing is counted until a
+:class:`Metrics` is attached, and the counts can be served in the 
+Prometheus text format::
+
+    from ircutils import bot, metrics
+
+    stats = metrics.Metrics()
+    my_bot = bot.SimpleBot("StatsBot")
+    stats.attach(my_bot)
+    metrics.MetricsServer(stats, port=9100)
+
+    my_bot.connect("irc.example.net", channel="#ircutils")
+    my_bot.start()
+
+One :class:`Metrics` can be attached to any number of clients; their counts
+are added together.
+
+"""
+import asyncore, asynchat
+import bisect
+import socket
+import weakref
+
+
+#: Upper bounds, in seconds, of the latency histogram buckets.
+default_buckets = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+                   0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n") \
+                     .replace('"', '\\"')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (name, _escape(value))
+                             for name, value in labels)
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+class Counter(object):
+    """ A count that only goes up. With a ``label``, a separate count is kept
+    for every key passed to :meth:`inc`. """
+    kind = "counter"
+
+    def __init__(self, name, description, label=None):
+        self.name = name
+        self.description = description
+        self.label = label
+        self.values = {}
+
+    def inc(self, key=None, amount=1):
+        """ Adds ``amount`` to the count for ``key``. """
+        values = self.values
+        values[key] = values.get(key, 0) + amount
+
+    def samples(self):
+        """ Yields ``(name, labels, value)`` for every count. """
+        for key, value in sorted(self.values.items(), key=_sort_key):
+            yield self.name, self._labels(key), value
+
+    def _labels(self, key):
+        if self.label is None:
+            return ()
+        return ((self.label, key),)
+
+
+class Gauge(Counter):
+    """ A value that's read when the metrics are rendered, by calling
+    ``func``. It returns a number, or a dict of numbers by label key. """
+    kind = "gauge"
+
+    def __init__(self, name, description, func, label=None):
+        Counter.__init__(self, name, description, label)
+        self.func = func
+
+    def samples(self):
+        values = self.func()
+        if not isinstance(values, dict):
+            values = {None: values}
+        for key, value in sorted(values.items(), key=_sort_key):
+            yield self.name, self._labels(key), value
+
+
+class Histogram(Counter):
+    """ Counts observed values into ``buckets``, which are sorted upper
+    bounds, and keeps their sum. """
+    kind = "histogram"
+
+    def __init__(self, name, description, label=None,
+                 buckets=default_buckets):
+        Counter.__init__(self, name, description, label)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, key=None):
+        """ Records one value for ``key``. """
+        series = self.values.get(key)
+        if series is None:
+            series = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def samples(self):
+        for key, (counts, total) in sorted(self.values.items(),
+                                           key=_sort_key):
+            labels = self._labels(key)
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                yield (self.name + "_bucket", labels + (("le", bound),),
+                       cumulative)
+            yield self.name + "_sum", labels, total
+            yield self.name + "_count", labels, cumulative
+
+
+def _server_label(conn):
+    return "%s:%s" % (getattr(conn, "hostname", None),
+                      getattr(conn, "port", None))
+
+
+def _sort_key(item):
+    return str(item[0])
+
+
+class Metrics(object):
+    """ The metrics of one or more clients. Every metric is an attribute,
+    and more can be added with :meth:`register`.
+    """
+
+    def __init__(self, prefix="ircutils_"):
+        self._metrics = []
+        self._connections = weakref.WeakSet()
+        self.lines_received = self.register(Counter(
+            prefix + "lines_received_total",
+            "Lines received from the server.", "command"))
+        self.lines_sent = self.register(Counter(
+            prefix + "lines_sent_total",
+            "Lines queued to be sent to the server.", "command"))
+        self.bytes_received = self.register(Counter(
+            prefix + "received_bytes_total",
+            "Bytes received from the server."))
+        self.bytes_sent = self.register(Counter(
+            prefix + "sent_bytes_total",
+            "Bytes queued to be sent to the server."))
+        self.listener_seconds = self.register(Histogram(
+            prefix + "listener_seconds",
+            "Time each listener took to handle an event.", "listener"))
+        self.handler_seconds = self.register(Histogram(
+            prefix + "handler_seconds",
+            "Time each event handler took to run.", "handler"))
+        self.send_queue = self.register(Gauge(
+            prefix + "send_queue_depth",
+            "Lines waiting to be written to the socket.",
+            self._send_queue_depths, "server"))
+        self.lag = self.register(Gauge(
+            prefix + "lag_seconds",
+            "Round trip time of the last answered keepalive PING.",
+            self._lags, "server"))
+
+    def register(self, metric):
+        """ Adds a :class:`Counter`, :class:`Gauge` or :class:`Histogram` to
+        the ones that are rendered, and returns it. """
+        self._metrics.append(metric)
+        return metric
+
+    def attach(self, client):
+        """ Starts counting for ``client``, including the connections it
+        makes later on. """
+        client.metrics = self
+        client.events.set_metrics(self)
+        conn = getattr(client, "conn", None)
+        if conn is not None:
+            self.attach_connection(conn)
+
+    def detach(self, client):
+        """ Stops counting for ``client``. """
+        client.metrics = None
+        client.events.set_metrics(None)
+        conn = getattr(client, "conn", None)
+        if conn is not None:
+            conn.metrics = None
+            self._connections.discard(conn)
+
+    def attach_connection(self, conn):
+        """ Starts counting the lines of a single
+        :class:`ircutils.connection.Connection`. """
+        conn.metrics = self
+        self._connections.add(conn)
+
+    def _send_queue_depths(self):
+        depths = {}
+        for conn in list(self._connections):
+            server = _server_label(conn)
+            depths[server] = depths.get(server, 0) + len(conn.producer_fifo)
+        return depths
+
+    def _lags(self):
+        lags = {}
+        for conn in list(self._connections):
+            lag = getattr(conn, "lag", None)
+            if lag is not None:
+                server = _server_label(conn)
+                lags[server] = max(lags.get(server, 0.0), lag)
+        return lags
+
+    def render(self):
+        """ Returns every metric in the Prometheus text format. """
+        output = []
+        for metric in self._metrics:
+            output.append("# HELP %s %s\n" % (metric.name,
+                                              metric.description))
+            output.append("# TYPE %s %s\n" % (metric.name, metric.kind))
+            for name, labels, value in metric.samples():
+                output.append("%s%s %s\n" % (name, _format_labels(labels),
+                                             _format_value(value)))
+        return "".join(output)
+
+
+class _MetricsRequest(asynchat.async_chat):
+    """ Answers a single HTTP request with the rendered metrics. """
+
+    max_request_size = 8192
+
+    def __init__(self, metrics, sock, map=None):
+        asynchat.async_chat.__init__(self, sock, map)
+        self.metrics = metrics
+        self.set_terminator(b"\r\n\r\n")
+        self.incoming = []
+        self._received = 0
+
+    def collect_incoming_data(self, data):
+        self._received += len(data)
+        if self._received > self.max_request_size:
+            self.close()
+            return
+        self.incoming.append(data)
+
+    def found_terminator(self):
+        request = b"".join(self.incoming).decode("latin-1")
+        self.incoming = []
+        self.set_terminator(None)
+        parts = request.split("\r\n", 1)[0].split()
+        if len(parts) < 2 or parts[0] not in ("GET", "HEAD"):
+            self._respond("405 Method Not Allowed", "")
+        elif parts[1].split("?", 1)[0] not in ("/", "/metrics"):
+            self._respond("404 Not Found", "")
+        else:
+            body = self.metrics.render()
+            self._respond("200 OK", "" if parts[0] == "HEAD" else body)
+
+    def _respond(self, status, body):
+        body = body.encode("UTF-8")
+        self.push(b"".join([
+            ("HTTP/1.0 %s\r\n" % status).encode("ascii"),
+            b"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n",
+            b"Content-Length: %d\r\n" % len(body),
+            b"Connection: close\r\n\r\n",
+            body]))
+        self.close_when_done()
+
+    def handle_error(self):
+        self.close()
+
+
+class MetricsServer(asyncore.dispatcher):
+    """ Serves ``metrics`` over HTTP at ``/metrics`` on the same loop as the
+    clients. It only listens on the loopback interface unless another
+    ``host`` is given. """
+
+    def __init__(self, metrics, host="127.0.0.1", port=9100, map=None):
+        asyncore.dispatcher.__init__(self, map=map)
+        self.metrics = metrics
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind((host, port))
+        self.listen(socket.SOMAXCONN)
+        #: The ``(host, port)`` the server is listening on.
+        self.address = self.socket.getsockname()
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            _MetricsRequest(self.metrics, pair[0], self._map)
@@ -0,0 +1,150 @@
+""" This module finds the event handlers that hold up the loop. Every
+connection of a client shares one loop, so a handler that takes two seconds
+stalls all of them for two seconds. A :class:`Profiler` times each handler
+call, keeps the slowest handlers, and sends a ``CONN_SLOW_HANDLER`` event
+whenever a call goes over its budget::
+
+    from ircutils import bot, profiling
+
+    class MyBot(bot.SimpleBot):
+
+        def on_slow_handler(self, event):
+            print("%s took %.3f seconds" % (event.handler_name,
+                                            event.seconds))
+
+    my_bot = MyBot("MyBot")
+    profiler = profiling.Profiler(budget=0.05)
+    profiler.attach(my_bot)
+
+Once a slow listener has been found, its handlers can be run under
+``cProfile`` to see where the time goes.
+
+"""
+import cProfile
+import heapq
+import operator
+
+from . import events
+
+
+class HandlerStats(object):
+    """ The timings of one handler, by its name from
+    :func:`ircutils.events.handler_name`. """
+
+    def __init__(self, name):
+        self.name = name
+        #: How many times it was called.
+        self.calls = 0
+        #: The seconds spent in it altogether.
+        self.total = 0.0
+        #: The seconds its slowest call took.
+        self.slowest = 0.0
+
+    @property
+    def mean(self):
+        """ The seconds an average call takes. """
+        if not self.calls:
+            return 0.0
+        return self.total / self.calls
+
+    def __repr__(self):
+        return "<HandlerStats %s: %d calls, %.6fs mean, %.6fs slowest>" % (
+            self.name, self.calls, self.mean, self.slowest)
+
+
+class Profiler(object):
+    """ Times the handlers of the clients it's attached to. A call that
+    takes longer than ``budget`` seconds is reported with a
+    ``CONN_SLOW_HANDLER`` event; set ``budget`` to ``None`` to never report
+    one. ``top`` is how many handlers :meth:`slowest` returns by default.
+    """
+
+    def __init__(self, budget=0.1, top=10):
+        self.budget = budget
+        self.top = top
+        #: :class:`HandlerStats` by handler name.
+        self.stats = {}
+        self._profile = None
+        self._profiled = None
+        self._profiled_client = None
+        self._reporting = False
+
+    def attach(self, client):
+        """ Starts timing the handlers of ``client``. """
+        client.events.set_profiler(self)
+
+    def detach(self, client):
+        """ Stops timing the handlers of ``client``. """
+        client.events.set_profiler(None)
+        if self._profiled_client is client:
+            self.stop_profile()
+
+    def record(self, handler, seconds, args):
+        """ Called by the listeners with the time a handler took. ``args``
+        are the arguments the handler was called with. """
+        name = events.handler_name(handler)
+        stats = self.stats.get(name)
+        if stats is None:
+            stats = self.stats[name] = HandlerStats(name)
+        stats.calls += 1
+        stats.total += seconds
+        if seconds > stats.slowest:
+            stats.slowest = seconds
+        if self.budget is not None and seconds > self.budget and \
+           not self._reporting:
+            self._report(handler, name, seconds, args)
+
+    def _report(self, handler, name, seconds, args):
+        client, event = args[0], args[1]
+        warning = events.ConnectionEvent("CONN_SLOW_HANDLER")
+        warning.handler = handler
+        warning.handler_name = name
+        warning.seconds = seconds
+        warning.event = event
+        # A slow handler of the warning itself isn't reported again.
+        self._reporting = True
+        try:
+            client.events.dispatch(client, warning)
+        finally:
+            self._reporting = False
+
+    def slowest(self, count=None, key="slowest"):
+        """ Returns the :class:`HandlerStats` of the ``count`` slowest
+        handlers, slowest first. ``key`` is ``"slowest"`` to rank them by
+        their slowest call, ``"mean"`` for their average call, or
+        ``"total"`` for the time spent in them altogether.
+        """
+        return heapq.nlargest(count or self.top, self.stats.values(),
+                              key=operator.attrgetter(key))
+
+    def reset(self):
+        """ Forgets every timing so far. """
+        self.stats = {}
+
+    def start_profile(self, client, name):
+        """ Runs the handlers of the listener called ``name`` on ``client``
+        under ``cProfile`` until :meth:`stop_profile` is called. Only one
+        listener is profiled at a time. The profiler has to be attached to
+        ``client``. """
+        self.stop_profile()
+        self._profile = cProfile.Profile()
+        self._profiled = client.events[name]
+        self._profiled_client = client
+        self._profiled.profile = self._profile
+
+    def stop_profile(self):
+        """ Stops profiling and returns the ``cProfile.Profile``, or
+        ``None`` if no listener was being profiled. """
+        profile = self._profile
+        if self._profiled is not None:
+            self._profiled.profile = None
+        self._profile = self._profiled = self._profiled_client = None
+        return profile
+
+    def dump_profile(self, filename):
+        """ Writes what's been profiled so far to ``filename`` in the
+        ``pstats`` format, which ``python -m pstats``, snakeviz and
+        gprof2dot can all read. """
+        if self._profile is None:
+            raise ValueError("No listener is being profiled.")
+        self._profile.dump_stats(filename)
@@ -18,7 +18,7 @@ name_symbols = {
     }
 
 
-commands_with_no_target = ["QUIT", "PING", "SQUIT"]
+commands_with_no_target = ["QUIT", "PING", "SQUIT", "AUTHENTICATE"]
 
 
 def strip_name_symbol(nickname):
@@ -29,8 +29,13 @@ def strip_name_symbol(nickname):
         >>> strip_name_symbol("+voiced_user")
         'voiced_user'
         
+    With the ``multi-prefix`` capability, a name may carry several symbols:
+        
+        >>> strip_name_symbol("@+opped_and_voiced_user")
+        'opped_and_voiced_user'
+        
     """
-    if nickname[0] in name_symbols:
+    while nickname and nickname[0] in name_symbols:
         nickname = nickname[1:]
     return nickname
 
@@ -64,12 +69,14 @@ def parse_line(data):
     command, and parameters. It gets returned in the form of 
     ``(prefix, command, params)``.
     This follows :rfc:`2812#section-2.3.1`, section 2.3.1 regarding message 
-    format. 
+    format. IRCv3 message tags, if the line has any, are skipped.
                 
         >>> message = ":nickname!myuser@myhost.net PRIVMSG #gerty :Hello!"
         >>> parse_line(message)
         ('nickname!myuser@myhost.net', 'PRIVMSG', ['#gerty', 'Hello!'])
     """
+    if data[0] == "@":
+        data = data.split(" ", 1)[1].lstrip(" ")
     if data[0] == ":":
         prefix, data = data[1:].split(" ", 1)
     else:
@@ -83,6 +90,41 @@ def parse_line(data):
     return prefix, params[0], params[1:]
 
 
+_tag_escapes = {":": ";", "s": " ", "\\": "\\", "r": "\r", "n": "\n"}
+
+
+def _unescape_tag(value):
+    chars = []
+    escaped = False
+    for char in value:
+        if escaped:
+            chars.append(_tag_escapes.get(char, char))
+            escaped = False
+        elif char == "\\":
+            escaped = True
+        else:
+            chars.append(char)
+    return "".join(chars)
+
+
+def parse_tags(data):
+    """ Parses the IRCv3 message tags at the start of a line, without the 
+    leading ``@``, into a dict. Tags without a value are set to ``""``.
+        
+        >>> parse_tags("batch=yXNAbvnRHTRBv;time=2011-10-19T16:40:51.620Z")
+        {'batch': 'yXNAbvnRHTRBv', 'time': '2011-10-19T16:40:51.620Z'}
+        >>> parse_tags("msgid=a\\sb;+draft/typing")
+        {'msgid': 'a b', '+draft/typing': ''}
+    """
+    tags = {}
+    for tag in data.split(";"):
+        key, _, value = tag.partition("=")
+        if "\\" in value:
+            value = _unescape_tag(value)
+        tags[key] = value
+    return tags
+
+
 def parse_prefix(prefix):
     """ Take the prefix of an IRC message and split it up into its main parts
     as defined by :rfc:`2812#section-2.3.1`, section 2.3.1 which shows it 
@@ -0,0 +1,101 @@
+""" This module plays back the captures made with
+:meth:`ircutils.connection.Connection.start_capture`. The lines go through
+the same path as lines read from a socket, from the parser to the client's
+event handlers. Every line of one read is captured with the same timestamp,
+so the lines are handed over in the same groups they were read in, and are
+dispatched in batches the same way. A capture of a production incident can be
+reproduced offline, or the whole parse and dispatch pipeline can be
+benchmarked without a network::
+
+    from ircutils import bot, replay
+
+    my_bot = MyBot("mybot")
+    lines, seconds = replay.replay(my_bot, "incident.capture")
+    print("%d lines/sec" % (lines / seconds))
+
+"""
+import itertools
+import operator
+import time
+
+from . import connection
+from . import timers
+
+
+def read_capture(capture):
+    """ Yields the ``(timestamp, line)`` pairs of a capture file, where
+    ``line`` is the raw line as ``bytes`` without its ``\\r\\n``. ``capture``
+    is a file name or a file opened in binary mode.
+    """
+    if isinstance(capture, str):
+        with open(capture, "rb") as capture_file:
+            for item in read_capture(capture_file):
+                yield item
+        return
+    for record in capture:
+        stamp, _, line = record.rstrip(b"\n").partition(b" ")
+        yield float(stamp), line
+
+
+class ReplayConnection(connection.Connection):
+    """ A connection without a socket. Whatever the client sends is kept in
+    ``sent`` if ``keep_output`` is set, and dropped otherwise.
+    """
+
+    def __init__(self, keep_output=False):
+        connection.Connection.__init__(self)
+        self.keep_output = keep_output
+        self.sent = []
+
+    def push(self, data):
+        if self.keep_output:
+            self.sent.append(data)
+
+    def push_urgent(self, data):
+        self.push(data)
+
+    def feed(self, line):
+        """ Hands one raw line to the connection, as if it had just been
+        read. """
+        self._handle_raw_lines([line])
+    
+    def feed_lines(self, lines):
+        """ Hands a list of raw lines to the connection, as if they had 
+        been read all at once. """
+        self._handle_raw_lines(lines)
+
+
+def replay(client, capture, speed=None, keep_output=False):
+    """ Plays ``capture`` back into ``client``, which is given a
+    :class:`ReplayConnection` in place of its connection. With ``speed``
+    left as ``None`` the lines are fed as fast as possible; otherwise the
+    original timing is kept, sped up by ``speed`` times, while the timers
+    keep running. Returns the number of lines and the seconds it took.
+    """
+    conn = ReplayConnection(keep_output)
+    client._bind_connection(conn)
+    reads = itertools.groupby(read_capture(capture), operator.itemgetter(0))
+    started = time.perf_counter()
+    count = 0
+    feed_lines = conn.feed_lines
+    if speed is None:
+        for stamp, read in reads:
+            lines = [line for stamp, line in read]
+            feed_lines(lines)
+            count += len(lines)
+        return count, time.perf_counter() - started
+
+    first_stamp = None
+    for stamp, read in reads:
+        lines = [line for stamp, line in read]
+        if first_stamp is None:
+            first_stamp = stamp
+            begin = time.monotonic()
+        wait = begin + (stamp - first_stamp) / speed - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+        # Keep the timers going, as the loop would.
+        timers.default_wheel.advance()
+        feed_lines(lines)
+        count += len(lines)
+    return count, time.perf_counter() - started
@@ -0,0 +1,242 @@
+""" This module resolves host names without blocking the loop and connects
+to them using Happy Eyeballs (:rfc:`8305`). Lookups run on a worker thread
+and are cached for a while. The resolved addresses are then tried in turn,
+alternating between IPv6 and IPv4, with a new attempt started every
+``attempt_delay`` seconds until one of them connects.
+
+"""
+import asyncore
+import collections
+import os
+import socket
+import sys
+import time
+
+from . import timers
+
+
+class Resolver(object):
+    """ Looks up host names on a worker thread and caches the results for
+    ``ttl`` seconds. ``getaddrinfo`` doesn't report the record TTLs, so one
+    fixed TTL is used for every entry.
+    """
+
+    def __init__(self, ttl=300.0):
+        self.ttl = ttl
+        self._cache = {}
+        self._waiting = {}
+
+    def resolve(self, host, port, callback):
+        """ Calls ``callback(addresses, error)`` with the ``getaddrinfo``
+        results for ``host``. Numeric addresses and cached names are answered
+        right away; otherwise the callback runs later on the loop. Concurrent
+        lookups of the same name share one query.
+        """
+        key = (host, port)
+        cached = self._cache.get(key)
+        if cached is not None:
+            expires, addresses = cached
+            if expires > time.monotonic():
+                callback(addresses, None)
+                return
+            del self._cache[key]
+        try:
+            addresses = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM,
+                                           0, socket.AI_NUMERICHOST)
+        except socket.gaierror:
+            pass
+        else:
+            callback(addresses, None)
+            return
+        if key in self._waiting:
+            self._waiting[key].append(callback)
+            return
+        self._waiting[key] = [callback]
+        timers.run_in_thread(socket.getaddrinfo,
+                             lambda result, error:
+                                 self._resolved(key, result, error),
+                             host, port, 0, socket.SOCK_STREAM)
+
+    def _resolved(self, key, addresses, error):
+        if error is None:
+            self._cache[key] = (time.monotonic() + self.ttl, addresses)
+        for callback in self._waiting.pop(key):
+            callback(addresses, error)
+
+    def clear(self):
+        """ Empties the cache. """
+        self._cache.clear()
+
+
+#: The resolver that :func:`connect` uses by default.
+default_resolver = Resolver()
+
+
+def sort_addresses(addresses, prefer_ipv6=True):
+    """ Orders ``getaddrinfo`` results by alternating between the address
+    families, starting with the preferred one, as :rfc:`8305#section-4`
+    describes.
+    """
+    first, second = socket.AF_INET6, socket.AF_INET
+    if not prefer_ipv6:
+        first, second = second, first
+    preferred = [a for a in addresses if a[0] == first]
+    others = [a for a in addresses if a[0] != first]
+    ordered = []
+    while preferred or others:
+        if preferred:
+            ordered.append(preferred.pop(0))
+        if others:
+            ordered.append(others.pop(0))
+    return ordered
+
+
+class _Attempt(asyncore.dispatcher):
+    """ A single connection attempt of a :class:`HappyEyeballs` race. """
+
+    def __init__(self, race, address, map=None):
+        asyncore.dispatcher.__init__(self, map=map)
+        self.race = race
+        self.family, socktype, proto, canonname, self.sockaddr = address
+
+    def start(self):
+        self.create_socket(self.family, socket.SOCK_STREAM)
+        self.connect(self.sockaddr)
+
+    def readable(self):
+        return False
+
+    def writable(self):
+        return self.connecting
+
+    def handle_connect(self):
+        self.race._won(self)
+
+    def handle_write(self):
+        pass
+
+    def handle_close(self):
+        error = self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        self.close()
+        self.race._failed(self, OSError(error, os.strerror(error)))
+
+    def handle_error(self):
+        error = sys.exc_info()[1]
+        self.close()
+        self.race._failed(self, error)
+
+
+class HappyEyeballs(object):
+    """ Races connection attempts to a list of addresses. The first socket
+    to connect is passed to ``callback(sock, error)``; the others are closed.
+    If every attempt fails, ``sock`` is ``None`` and ``error`` holds the last
+    error.
+    """
+
+    def __init__(self, addresses, callback, attempt_delay=0.25, map=None):
+        self.callback = callback
+        self.attempt_delay = attempt_delay
+        self.map = map
+        self._waiting = collections.deque(addresses)
+        self._running = set()
+        self._timer = None
+        self._error = None
+        self.done = False
+        self._start_next()
+
+    def _start_next(self):
+        self._timer = None
+        if self.done:
+            return
+        if not self._waiting:
+            if not self._running:
+                self._finish(None, self._error or
+                             OSError("no addresses to connect to"))
+            return
+        address = self._waiting.popleft()
+        attempt = _Attempt(self, address, self.map)
+        self._running.add(attempt)
+        if self._waiting:
+            self._timer = timers.call_later(self.attempt_delay,
+                                            self._start_next)
+        try:
+            attempt.start()
+        except OSError as error:
+            attempt.close()
+            self._failed(attempt, error)
+
+    def _failed(self, attempt, error):
+        self._running.discard(attempt)
+        if self.done:
+            return
+        if error is not None:
+            self._error = error
+        # A failure starts the next attempt right away.
+        if self._timer is not None:
+            self._timer.cancel()
+        self._start_next()
+
+    def _won(self, attempt):
+        self._running.discard(attempt)
+        sock = attempt.socket
+        attempt.del_channel()
+        attempt.socket = None
+        self._finish(sock, None)
+
+    def _finish(self, sock, error):
+        self.cancel()
+        self.callback(sock, error)
+
+    def cancel(self):
+        """ Stops the race and closes every attempt still running. """
+        self.done = True
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        for attempt in list(self._running):
+            attempt.close()
+        self._running.clear()
+
+
+def connect(host, port, callback, prefer_ipv6=True, attempt_delay=0.25,
+            resolver=None, map=None):
+    """ Resolves ``host`` and connects to it with :class:`HappyEyeballs`.
+    ``callback(sock, error)`` is called with the connected non-blocking
+    socket, or with ``None`` and the error if the lookup or every attempt
+    failed. Returns an object with a ``cancel()`` method and a ``finished``
+    flag, which is already set if ``callback`` was called before
+    :func:`connect` returned.
+    """
+    if resolver is None:
+        resolver = default_resolver
+    pending = _PendingConnect()
+
+    def finished(sock, error):
+        pending.finished = True
+        callback(sock, error)
+
+    def resolved(addresses, error):
+        if pending.cancelled:
+            return
+        if error is not None:
+            finished(None, error)
+            return
+        addresses = sort_addresses(addresses, prefer_ipv6)
+        pending.race = HappyEyeballs(addresses, finished, attempt_delay, map)
+
+    resolver.resolve(host, port, resolved)
+    return pending
+
+
+class _PendingConnect(object):
+    """ Lets a :func:`connect` be cancelled while it's still resolving. """
+
+    def __init__(self):
+        self.cancelled = False
+        self.finished = False
+        self.race = None
+
+    def cancel(self):
+        self.cancelled = True
+        if self.race is not None:
+            self.race.cancel()
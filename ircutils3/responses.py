@@ -218,6 +218,7 @@ numeric_responses = {
     "407": "ERR_TOOMANYTARGETS",
     "408": "ERR_NOCOLORSONCHAN",
     "409": "ERR_NOORIGIN",
+    "410": "ERR_INVALIDCAPCMD",
     "411": "ERR_NORECIPIENT",
     "412": "ERR_NOTEXTTOSEND",
     "413": "ERR_NOTOPLEVEL",
@@ -395,6 +396,15 @@ numeric_responses = {
     "771": "RPL_XINFO",
     "773": "RPL_XINFOSTART",
     "774": "RPL_XINFOEND",
+    "900": "RPL_LOGGEDIN",
+    "901": "RPL_LOGGEDOUT",
+    "902": "ERR_NICKLOCKED",
+    "903": "RPL_SASLSUCCESS",
+    "904": "ERR_SASLFAIL",
+    "905": "ERR_SASLTOOLONG",
+    "906": "ERR_SASLABORTED",
+    "907": "ERR_SASLALREADY",
+    "908": "RPL_SASLMECHS",
     "972": "ERR_CANNOTDOCOMMAND",
     "973": "ERR_CANNOTCHANGEUMODE",
     "974": "ERR_CANNOTCHANGECHANMODE",
@@ -410,8 +420,76 @@ numeric_responses = {
     }
 
 
-def from_digit(index):
+class Numeric(str):
+    """ The command of a numeric reply. It's a string with the reply's 
+    symbolic name, such as ``"RPL_WELCOME"``, or its three digits if it 
+    doesn't have one, so it can be compared with names as before. The 
+    number itself is kept in ``value``.
+    
+        >>> command = from_digit("001")
+        >>> command == "RPL_WELCOME", command.value, command.digits
+        (True, 1, '001')
+    """
+    
+    def __new__(cls, name, value):
+        self = str.__new__(cls, name)
+        self.value = value
+        return self
+    
+    @property
+    def digits(self):
+        """ The numeric as it's sent, such as ``"001"``. """
+        return "%03d" % self.value
     
+    def __reduce__(self):
+        return (Numeric, (str(self), self.value))
+
+
+#: Every :class:`Numeric` from 0 to 999, indexed by its value.
+by_value = [Numeric(numeric_responses.get("%03d" % value, "%03d" % value), 
+                    value) for value in range(1000)]
+
+#: Every :class:`Numeric`, by the three digits it's sent as.
+by_digits = dict((numeric.digits, numeric) for numeric in by_value)
+
+#: The value of each symbolic name. A few names are used by more than one 
+#: numeric; they map to the lowest.
+by_name = {}
+for numeric in reversed(by_value):
+    if numeric != numeric.digits:
+        by_name[str(numeric)] = numeric.value
+del numeric
+
+# The names are also module constants, as in ``responses.RPL_WELCOME == 1``.
+globals().update(by_name)
+
+#: The values of the ``RPL_`` and the ``ERR_`` numerics. These come from
+#: ``by_value`` rather than ``by_name``, so that a name that's used more 
+#: than once counts for every one of its numerics.
+reply_values = frozenset(numeric.value for numeric in by_value
+                         if numeric.startswith("RPL_"))
+error_values = frozenset(numeric.value for numeric in by_value
+                         if numeric.startswith("ERR_"))
+
+# Every numeric with a name is either a reply or an error.
+assert all(numeric.value in reply_values or numeric.value in error_values
+           for numeric in by_value if numeric != numeric.digits)
+
+
+def from_digit(index):
+    """ Returns the :class:`Numeric` for a numeric given as its digits or 
+    as an ``int``. Anything else is returned as it is. """
     if isinstance(index, int):
-        index = "%03d" % index
-    return numeric_responses.get(index, index)
+        if 0 <= index < 1000:
+            return by_value[index]
+        return "%03d" % index
+    return by_digits.get(index, index)
+
+
+def to_digit(name):
+    """ Returns the three digits of a symbolic name, such as ``"001"`` for 
+    ``"RPL_WELCOME"``, or the name as it is if it isn't known. """
+    value = by_name.get(name)
+    if value is None:
+        return name
+    return "%03d" % value
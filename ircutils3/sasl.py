@@ -0,0 +1,164 @@
+""" This module has the SASL mechanisms that
+:class:`ircutils.client.SimpleClient` can log in with while it registers,
+before the server has even welcomed it. To use one, set it as the client's
+``sasl`` attribute before connecting::
+
+    from ircutils import client, sasl
+
+    my_client = client.SimpleClient("MyBot")
+    my_client.sasl = sasl.Scram("MyBot", "secret")
+    my_client.connect("irc.example.net", 6697, use_ssl=True)
+
+"""
+import base64
+import hashlib
+import hmac
+import os
+
+
+class SASLError(Exception):
+    """ Raised when the server's side of an exchange doesn't make sense, in
+    which case the client aborts the authentication. """
+    pass
+
+
+class Mechanism(object):
+    """ The base of the SASL mechanisms. The client sends ``name`` to start
+    the exchange, then calls :meth:`respond` with each challenge from the
+    server and sends back what it returns.
+    """
+    name = None
+
+    def start(self):
+        """ Called before each new exchange, such as after a reconnect. """
+        pass
+
+    def respond(self, challenge):
+        """ Takes the decoded challenge as ``bytes`` and returns the
+        response as ``bytes``. """
+        raise NotImplementedError("respond() must be overridden.")
+
+
+class Plain(Mechanism):
+    """ Sends the account name and password as they are. Only use it over
+    SSL. """
+    name = "PLAIN"
+
+    def __init__(self, username, password, authzid=""):
+        self.username = username
+        self.password = password
+        self.authzid = authzid
+
+    def respond(self, challenge):
+        return ("%s\0%s\0%s" % (self.authzid, self.username,
+                                self.password)).encode("UTF-8")
+
+
+class External(Mechanism):
+    """ Logs in with the client certificate given to ``connect()``. """
+    name = "EXTERNAL"
+
+    def __init__(self, authzid=""):
+        self.authzid = authzid
+
+    def respond(self, challenge):
+        return self.authzid.encode("UTF-8")
+
+
+def _scram_escape(name):
+    return name.replace("=", "=3D").replace(",", "=2C")
+
+
+def _scram_attributes(message):
+    try:
+        return dict(part.split("=", 1) for part in message.split(","))
+    except ValueError:
+        raise SASLError("Malformed SCRAM message: %r" % message)
+
+
+class Scram(Mechanism):
+    """ Salted challenge-response authentication (:rfc:`5802`). The password
+    never crosses the wire, and the server has to prove that it knows it
+    too. ``hash_name`` is any ``hashlib`` name; ``"sha256"`` gives
+    ``SCRAM-SHA-256`` and ``"sha1"`` gives ``SCRAM-SHA-1``.
+    """
+
+    def __init__(self, username, password, hash_name="sha256"):
+        self.username = username
+        self.password = password
+        self.hash_name = hash_name
+        self.name = "SCRAM-" + hash_name.upper().replace("SHA", "SHA-")
+        self.start()
+
+    def start(self):
+        self._step = 0
+        self._nonce = None
+        self._client_first = None
+        self._server_signature = None
+
+    def _hmac(self, key, message):
+        return hmac.new(key, message, self.hash_name).digest()
+
+    def respond(self, challenge):
+        self._step += 1
+        if self._step == 1:
+            self._nonce = base64.b64encode(os.urandom(18)).decode("ascii")
+            self._client_first = "n=%s,r=%s" % (_scram_escape(self.username),
+                                                self._nonce)
+            return ("n,," + self._client_first).encode("UTF-8")
+        elif self._step == 2:
+            return self._client_final(challenge.decode("UTF-8"))
+        elif self._step == 3:
+            attributes = _scram_attributes(challenge.decode("UTF-8"))
+            if "e" in attributes:
+                raise SASLError("Server rejected the login: %s" %
+                                attributes["e"])
+            signature = base64.b64decode(attributes.get("v", ""))
+            if not hmac.compare_digest(signature, self._server_signature):
+                raise SASLError("Server signature doesn't match.")
+            return b""
+        raise SASLError("Unexpected SCRAM challenge.")
+
+    def _client_final(self, server_first):
+        attributes = _scram_attributes(server_first)
+        try:
+            nonce = attributes["r"]
+            salt = base64.b64decode(attributes["s"])
+            iterations = int(attributes["i"])
+        except (KeyError, ValueError):
+            raise SASLError("Malformed SCRAM message: %r" % server_first)
+        if not nonce.startswith(self._nonce):
+            raise SASLError("Server nonce doesn't extend the client nonce.")
+
+        salted = hashlib.pbkdf2_hmac(self.hash_name,
+                                     self.password.encode("UTF-8"),
+                                     salt, iterations)
+        client_key = self._hmac(salted, b"Client Key")
+        stored_key = hashlib.new(self.hash_name, client_key).digest()
+        without_proof = "c=biws,r=" + nonce
+        auth_message = ",".join((self._client_first, server_first,
+                                 without_proof)).encode("UTF-8")
+        signature = self._hmac(stored_key, auth_message)
+        proof = bytes(a ^ b for a, b in zip(client_key, signature))
+        server_key = self._hmac(salted, b"Server Key")
+        self._server_signature = self._hmac(server_key, auth_message)
+        return ("%s,p=%s" % (without_proof,
+                             base64.b64encode(proof).decode("ascii"))
+                ).encode("UTF-8")
+
+
+def encode_response(data):
+    """ Splits a response into the parameters of the ``AUTHENTICATE``
+    commands that carry it: base64 in chunks of 400 bytes, with ``+``
+    standing for an empty chunk.
+
+        >>> encode_response(b"")
+        ['+']
+        >>> encode_response(b"\\0user\\0pass")
+        ['AHVzZXIAcGFzcw==']
+    """
+    encoded = base64.b64encode(data).decode("ascii")
+    chunks = [encoded[i:i + 400] for i in range(0, len(encoded), 400)]
+    if not chunks or len(chunks[-1]) == 400:
+        chunks.append("+")
+    return chunks
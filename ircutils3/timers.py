@@ -0,0 +1,282 @@
+""" This module provides timers for the asyncore loop that the clients run on.
+Timers are kept in a hierarchical timer wheel, so scheduling, cancelling and
+expiring a timer costs the same no matter how many are pending. It can also
+run blocking calls, such as name lookups, on worker threads and hand their 
+results back to the loop.
+
+To run the timers alongside the connections, use :func:`loop` (which is what
+``ircutils.start_all()`` does) instead of ``asyncore.loop``.
+
+"""
+import asyncore
+import collections
+import select
+import time
+
+
+class Timer(object):
+    """ A callback scheduled on a :class:`TimerWheel`. It is returned by
+    :meth:`TimerWheel.call_later` and can be cancelled until it has fired.
+    """
+    __slots__ = ("when", "callback", "args", "active", "_wheel", "_tick")
+
+    def __init__(self, wheel, when, tick, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.active = True
+        self._wheel = wheel
+        self._tick = tick
+
+    def cancel(self):
+        """ Stops the timer from firing. Does nothing if it already fired. """
+        if self.active:
+            self.active = False
+            self._wheel._count -= 1
+
+
+class TimerWheel(object):
+    """ A hierarchical timer wheel. Time is cut into ticks of ``resolution``
+    seconds. The first level has a slot for each of the next
+    ``2 ** slot_bits`` ticks, and each level above it covers
+    ``2 ** slot_bits`` times the span of the one below. Timers far in the
+    future sit in the upper levels and are moved down as their time
+    approaches.
+
+    Cancelled timers are simply flagged and dropped once their slot comes up.
+    """
+
+    def __init__(self, resolution=0.05, slot_bits=6, levels=4,
+                 clock=time.monotonic):
+        self.resolution = resolution
+        self.clock = clock
+        self._bits = slot_bits
+        self._mask = (1 << slot_bits) - 1
+        self._span = 1 << (slot_bits * levels)
+        self._wheels = [[[] for i in range(1 << slot_bits)]
+                        for level in range(levels)]
+        self._origin = clock()
+        self._current = 0
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def call_later(self, delay, callback, *args):
+        """ Calls ``callback(*args)`` after ``delay`` seconds. Returns the
+        :class:`Timer`.
+        """
+        return self.call_at(self.clock() + delay, callback, *args)
+
+    def call_at(self, when, callback, *args):
+        """ Calls ``callback(*args)`` once the clock reaches ``when``. """
+        tick = -int(-(when - self._origin) // self.resolution)
+        tick = max(tick, self._current + 1)
+        timer = Timer(self, when, tick, callback, args)
+        self._count += 1
+        self._add(timer)
+        return timer
+
+    def _add(self, timer):
+        """ Places a timer in the slot that matches how far away it is. """
+        tick = timer._tick
+        delta = tick - self._current
+        if delta >= self._span:
+            # Beyond what the wheel can hold. Park it in the farthest slot
+            # and it'll be placed again when that slot cascades.
+            tick = self._current + self._span - 1
+            delta = self._span - 1
+        level = 0
+        while delta >> (self._bits * (level + 1)):
+            level += 1
+        slot = (tick >> (self._bits * level)) & self._mask
+        self._wheels[level][slot].append(timer)
+
+    def _cascade(self, tick):
+        """ Moves the timers of the upper levels whose time has come down into
+        the lower levels. """
+        for level in range(1, len(self._wheels)):
+            index = (tick >> (self._bits * level)) & self._mask
+            slot = self._wheels[level][index]
+            self._wheels[level][index] = []
+            for timer in slot:
+                if timer.active:
+                    self._add(timer)
+            if index:
+                break
+
+    def advance(self, now=None):
+        """ Fires every timer that has expired by ``now``. """
+        if now is None:
+            now = self.clock()
+        target = int((now - self._origin) // self.resolution)
+        wheel = self._wheels[0]
+        mask = self._mask
+        while self._current < target:
+            if not self._count:
+                self._current = target
+                break
+            self._current += 1
+            tick = self._current
+            if not tick & mask:
+                self._cascade(tick)
+            slot = wheel[tick & mask]
+            if slot:
+                wheel[tick & mask] = []
+                for timer in slot:
+                    if timer.active:
+                        timer.active = False
+                        self._count -= 1
+                        timer.callback(*timer.args)
+
+    def time_until_next(self):
+        """ Returns roughly how long until the next timer fires, or ``None``
+        if no timers are pending. The result is never later than the actual
+        expiry, so it can be used as a poll timeout.
+        """
+        if not self._count:
+            return None
+        wheel = self._wheels[0]
+        mask = self._mask
+        tick = self._current + 1
+        while tick & mask:
+            for timer in wheel[tick & mask]:
+                if timer.active:
+                    return self._wait_until(tick)
+            tick += 1
+        # Nothing on the first level. Wake up when the next level cascades.
+        return self._wait_until(tick)
+
+    def _wait_until(self, tick):
+        wait = self._origin + tick * self.resolution - self.clock()
+        return max(wait, 0.0)
+
+
+#: The wheel used by :func:`call_later` and :func:`loop`.
+default_wheel = TimerWheel()
+
+
+def call_later(delay, callback, *args):
+    """ Schedules ``callback(*args)`` on the default wheel. """
+    return default_wheel.call_later(delay, callback, *args)
+
+
+#: How often the loop checks for finished thread calls while any are running.
+thread_poll_interval = 0.01
+
+_executor = None
+_finished_calls = collections.deque()
+_running_calls = 0
+
+
+def run_in_thread(func, callback, *args):
+    """ Calls ``func(*args)`` on a worker thread. Once it returns, the loop
+    calls ``callback(result, error)`` where ``error`` is the exception it 
+    raised, if any.
+    """
+    global _executor, _running_calls
+    if _executor is None:
+        # Imported here, as most programs never need it.
+        import concurrent.futures
+        _executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=4, thread_name_prefix="ircutils")
+    _running_calls += 1
+    future = _executor.submit(func, *args)
+    # deque.append is thread-safe, so the worker can hand it straight over.
+    future.add_done_callback(
+        lambda future: _finished_calls.append((callback, future)))
+
+
+def _run_finished_calls():
+    global _running_calls
+    while _finished_calls:
+        callback, future = _finished_calls.popleft()
+        _running_calls -= 1
+        error = future.exception()
+        if error is not None:
+            callback(None, error)
+        else:
+            callback(future.result(), None)
+
+
+_loop_hooks = []
+
+
+def add_loop_hook(hook):
+    """ Calls ``hook(busy)`` after every pass of :func:`loop`, where ``busy``
+    is how many seconds the pass spent working: handling the sockets, the
+    timers and the thread calls, but not waiting for anything to happen.
+    """
+    _loop_hooks.append(hook)
+
+
+def remove_loop_hook(hook):
+    """ Removes a hook added with :func:`add_loop_hook`. """
+    _loop_hooks.remove(hook)
+
+
+def _poll(timeout, map):
+    """ The same as ``asyncore.poll()``, but it returns how long it waited
+    for the sockets to be ready. """
+    readable = []
+    writable = []
+    exceptional = []
+    for fd, obj in list(map.items()):
+        is_readable = obj.readable()
+        is_writable = obj.writable()
+        if is_readable:
+            readable.append(fd)
+        if is_writable and not obj.accepting:
+            writable.append(fd)
+        if is_readable or is_writable:
+            exceptional.append(fd)
+    started = time.perf_counter()
+    if not (readable or writable or exceptional):
+        time.sleep(timeout)
+        return time.perf_counter() - started
+    readable, writable, exceptional = select.select(readable, writable,
+                                                    exceptional, timeout)
+    waited = time.perf_counter() - started
+    for fds, handle in ((readable, asyncore.read), (writable, asyncore.write),
+                        (exceptional, asyncore._exception)):
+        for fd in fds:
+            obj = map.get(fd)
+            if obj is not None:
+                handle(obj)
+    return waited
+
+
+def loop(map=None, timeout=30.0, wheel=None):
+    """ Runs the asyncore loop together with the timers. It keeps running as
+    long as there are open connections, pending timers, or thread calls.
+    """
+    if map is None:
+        map = asyncore.socket_map
+    if wheel is None:
+        wheel = default_wheel
+    while map or wheel or _running_calls:
+        wait = wheel.time_until_next()
+        if wait is None or wait > timeout:
+            wait = timeout
+        if _running_calls:
+            wait = min(wait, thread_poll_interval)
+        if _loop_hooks:
+            # The slower path that measures how busy the pass was.
+            started = time.perf_counter()
+            if map:
+                waited = _poll(wait, map)
+            else:
+                time.sleep(wait)
+                waited = time.perf_counter() - started
+            _run_finished_calls()
+            wheel.advance()
+            busy = time.perf_counter() - started - waited
+            for hook in list(_loop_hooks):
+                hook(busy)
+            continue
+        if map:
+            asyncore.poll(wait, map)
+        else:
+            time.sleep(wait)
+        _run_finished_calls()
+        wheel.advance()
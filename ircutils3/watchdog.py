@@ -0,0 +1,195 @@
+""" This module watches the loop that the clients share, and sheds load when
+it falls behind. A :class:`Watchdog` measures how late the timers fire
+(the loop lag), how much work the longest pass of the loop did, and how much
+of the time the loop was busy. When the lag or the work goes over
+``high_water`` seconds, or the loop is busy more than ``busy_high`` of the
+time, it counts as overloaded. It stays that way until the lag and the work
+are back under ``low_water`` and it's busy less than ``busy_low`` of the
+time. While it's overloaded:
+
+  * Handlers added with a priority of ``shed_priority`` or more are skipped,
+    so that only the important ones run.
+  * Reading is paused on connections that receive more than ``flood_rate``
+    lines a second, for up to ``max_pause`` seconds at a time.
+  * Every attached client gets a ``CONN_BACKPRESSURE`` event when the state
+    changes, with ``overloaded``, ``lag`` and ``work`` attributes.
+
+PING requests are answered ahead of anything else waiting to be sent, and a
+paused connection is always let to read for ``max_pause`` seconds before it
+may be paused again, so a burst can't hold up the replies long enough for
+the server to time the client out::
+
+    from ircutils import bot, watchdog
+
+    class MyBot(bot.SimpleBot):
+
+        def __init__(self, nick):
+            bot.SimpleBot.__init__(self, nick)
+            # Only wanted when there's time for it.
+            self["message"].add_handler(self.update_stats, priority=10)
+
+        def on_backpressure(self, event):
+            print("Overloaded" if event.overloaded else "Caught up")
+
+    my_bot = MyBot("MyBot")
+    dog = watchdog.Watchdog()
+    dog.attach(my_bot)
+    dog.start()
+
+The work of each pass is only measured when the clients run on
+:func:`ircutils.timers.loop`, as ``start()`` and ``ircutils.start_all()`` do.
+
+The check is a timer that keeps coming back, and the loop runs for as long
+as there are timers, so a started watchdog keeps ``start_all()`` from 
+returning even after every connection has closed. Call 
+:meth:`Watchdog.stop` once the clients are done, for instance from 
+``on_disconnect``.
+
+"""
+import weakref
+
+from . import events
+from . import timers
+
+
+class Watchdog(object):
+    """ Checks on the loop every ``interval`` seconds. The timers of
+    ``wheel`` are used, which is :data:`ircutils.timers.default_wheel`
+    unless another is given.
+    """
+
+    def __init__(self, interval=0.25, high_water=0.25, low_water=0.05,
+                 busy_high=0.9, busy_low=0.6, shed_priority=10,
+                 flood_rate=200, max_pause=5.0, wheel=None):
+        self.interval = interval
+        self.high_water = high_water
+        self.low_water = low_water
+        self.busy_high = busy_high
+        self.busy_low = busy_low
+        self.shed_priority = shed_priority
+        self.flood_rate = flood_rate
+        self.max_pause = max_pause
+        self.wheel = wheel or timers.default_wheel
+        #: How late, in seconds, the last check ran.
+        self.lag = 0.0
+        #: The seconds of work the longest pass of the loop did since the check
+        #: before.
+        self.work = 0.0
+        #: The share of the time between the last two checks that the loop
+        #: was busy, from 0 to 1.
+        self.utilization = 0.0
+        #: The number of passes the loop made between the last two checks.
+        self.passes = 0
+        #: Whether the loop is overloaded.
+        self.overloaded = False
+        self._clients = weakref.WeakSet()
+        self._timer = None
+        self._last_check = None
+        self._busy = 0.0
+        self._passes = 0
+        self._longest = 0.0
+        self._read_counts = weakref.WeakKeyDictionary()
+        self._paused = weakref.WeakKeyDictionary()
+        self._resumed = weakref.WeakKeyDictionary()
+
+    def attach(self, client):
+        """ Starts shedding load from ``client`` when the loop is
+        overloaded. """
+        self._clients.add(client)
+        if self.overloaded:
+            client.events.set_shed_priority(self.shed_priority)
+
+    def detach(self, client):
+        """ Stops shedding load from ``client``. """
+        self._clients.discard(client)
+        client.events.set_shed_priority(None)
+        conn = getattr(client, "conn", None)
+        if conn is not None and self._paused.pop(conn, None) is not None:
+            conn.resume_reading()
+
+    def start(self):
+        """ Starts checking on the loop. """
+        if self._timer is None:
+            timers.add_loop_hook(self._loop_pass)
+            self._last_check = self.wheel.clock()
+            self._schedule()
+
+    def stop(self):
+        """ Stops checking, and stops shedding load if it was. Until this is
+        called, the watchdog's timer keeps :func:`ircutils.timers.loop` 
+        running. """
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+            timers.remove_loop_hook(self._loop_pass)
+        if self.overloaded:
+            self._set_overloaded(False)
+
+    def _loop_pass(self, busy):
+        self._busy += busy
+        self._passes += 1
+        if busy > self._longest:
+            self._longest = busy
+
+    def _schedule(self):
+        self._timer = self.wheel.call_later(self.interval, self._check)
+
+    def _check(self):
+        now = self.wheel.clock()
+        # A timer may fire up to one tick after its time on its own.
+        self.lag = max(0.0, now - self._timer.when - self.wheel.resolution)
+        elapsed = max(now - self._last_check, 1e-9)
+        self.work = self._longest
+        self.passes = self._passes
+        self.utilization = min(1.0, self._busy / elapsed)
+        self._busy = self._longest = 0.0
+        self._passes = 0
+        self._last_check = now
+
+        load = max(self.lag, self.work)
+        if not self.overloaded:
+            if load > self.high_water or self.utilization > self.busy_high:
+                self._set_overloaded(True)
+        elif load < self.low_water and self.utilization < self.busy_low:
+            self._set_overloaded(False)
+        self._check_floods(now, elapsed)
+        self._schedule()
+
+    def _set_overloaded(self, overloaded):
+        self.overloaded = overloaded
+        shed_priority = self.shed_priority if overloaded else None
+        for client in list(self._clients):
+            client.events.set_shed_priority(shed_priority)
+        if not overloaded:
+            for conn in list(self._paused.keys()):
+                conn.resume_reading()
+                self._resumed[conn] = self._last_check
+            self._paused.clear()
+        for client in list(self._clients):
+            event = events.ConnectionEvent("CONN_BACKPRESSURE")
+            event.overloaded = overloaded
+            event.lag = self.lag
+            event.work = self.work
+            client.events.dispatch(client, event)
+
+    def _check_floods(self, now, elapsed):
+        """ Pauses the connections that flood while the loop is overloaded,
+        and lets them read again once they've been paused too long. """
+        for client in list(self._clients):
+            conn = getattr(client, "conn", None)
+            if conn is None:
+                continue
+            received = conn.lines_received
+            rate = (received - self._read_counts.get(conn, received)) / elapsed
+            self._read_counts[conn] = received
+            paused_at = self._paused.get(conn)
+            resumed_at = self._resumed.get(conn)
+            if paused_at is not None:
+                if now - paused_at >= self.max_pause:
+                    del self._paused[conn]
+                    self._resumed[conn] = now
+                    conn.resume_reading()
+            elif self.overloaded and rate > self.flood_rate and \
+                 (resumed_at is None or now - resumed_at >= self.max_pause):
+                self._paused[conn] = now
+                conn.pause_reading()
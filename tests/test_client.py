@@ -0,0 +1,81 @@
+import unittest
+from unittest import mock
+
+from ircutils3 import client, events, responses
+
+
+def longest(low, high):
+    return high
+
+
+class ReconnectPolicyTest(unittest.TestCase):
+
+    @mock.patch("random.uniform", longest)
+    def test_delays_grow_up_to_the_maximum(self):
+        policy = client.ReconnectPolicy(base_delay=2.0, max_delay=60.0,
+                                        factor=2.0)
+        delays = [policy.next_delay() for attempt in range(10)]
+        self.assertEqual(delays, [2, 4, 8, 16, 32, 60, 60, 60, 60, 60])
+        self.assertEqual(policy.attempts, 10)
+
+    def test_delays_are_jittered(self):
+        policy = client.ReconnectPolicy(base_delay=10.0)
+        delays = [policy.next_delay() for attempt in range(20)]
+        self.assertTrue(all(0 <= delay <= 300 for delay in delays))
+        self.assertGreater(len(set(delays)), 1)
+
+    @mock.patch("random.uniform", longest)
+    def test_many_attempts_dont_overflow(self):
+        policy = client.ReconnectPolicy()
+        for attempt in range(5000):
+            delay = policy.next_delay()
+        self.assertEqual(delay, policy.max_delay)
+
+    @mock.patch("random.uniform", longest)
+    def test_reset(self):
+        policy = client.ReconnectPolicy(base_delay=1.0)
+        for attempt in range(20):
+            policy.next_delay()
+        policy.reset()
+        self.assertEqual(policy.attempts, 0)
+        self.assertEqual(policy.next_delay(), 1.0)
+
+    def test_max_attempts(self):
+        policy = client.ReconnectPolicy(max_attempts=2)
+        self.assertTrue(policy.should_retry())
+        policy.next_delay()
+        policy.next_delay()
+        self.assertFalse(policy.should_retry())
+        self.assertTrue(client.ReconnectPolicy().should_retry())
+
+    def test_servers_rotate(self):
+        policy = client.ReconnectPolicy(servers=["a.example",
+                                                 ("b.example", 6697)])
+        self.assertEqual(policy.next_server("orig", 6667), ("a.example", None))
+        self.assertEqual(policy.next_server("orig", 6667), ("b.example", 6697))
+        self.assertEqual(policy.next_server("orig", 6667), ("a.example", None))
+        self.assertEqual(client.ReconnectPolicy().next_server("orig", 6667),
+                         ("orig", 6667))
+
+
+class WelcomeResetTest(unittest.TestCase):
+
+    def welcome(self, auto_handle):
+        test_client = client.SimpleClient("tester", auto_handle=auto_handle)
+        test_client.reconnect_policy = client.ReconnectPolicy()
+        for attempt in range(5):
+            test_client.reconnect_policy.next_delay()
+        test_client.events.dispatch(test_client, events.StandardEvent(
+            "irc.example", responses.from_digit("001"),
+            ["tester", "Welcome"]))
+        return test_client.reconnect_policy.attempts
+
+    def test_welcome_resets_the_attempts(self):
+        self.assertEqual(self.welcome(auto_handle=True), 0)
+
+    def test_welcome_resets_the_attempts_without_auto_handle(self):
+        self.assertEqual(self.welcome(auto_handle=False), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,86 @@
+import unittest
+
+from ircutils3 import commands, events
+
+
+class RateLimitTest(unittest.TestCase):
+
+    def test_allows_count_uses(self):
+        limit = commands._RateLimit(3, 10)
+        self.assertEqual([limit.allow("a", 100.0) for use in range(4)],
+                         [True, True, True, False])
+        self.assertTrue(limit.allow("b", 100.0))
+
+    def test_refills_over_time(self):
+        limit = commands._RateLimit(2, 10)
+        limit.allow("a", 100.0)
+        limit.allow("a", 100.0)
+        self.assertFalse(limit.allow("a", 104.0))
+        self.assertTrue(limit.allow("a", 106.0))
+        self.assertFalse(limit.allow("a", 106.0))
+
+    def test_full_buckets_are_dropped(self):
+        limit = commands._RateLimit(2, 10)
+        for user in range(100):
+            limit.allow(user, 100.0)
+        limit.allow("a", 115.0)
+        limit.allow("a", 115.0)
+        self.assertEqual(list(limit._buckets), ["a"])
+        self.assertFalse(limit.allow("a", 115.0))
+
+
+class CommandRouterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.router = commands.CommandRouter()
+        self.calls = []
+        self.notices = []
+        self.router.add(commands.Command("roll", self.roll, aliases=["r"]))
+
+    def roll(self, client, event, sides: int = 6):
+        self.calls.append((event.reply_to, sides))
+
+    def send_notice(self, target, message):
+        self.notices.append((target, message))
+
+    def route(self, message, target="#x"):
+        event = events.MessageEvent("nick!u@h", "PRIVMSG", [target, message])
+        return self.router.route(self, event)
+
+    def test_lookup(self):
+        self.assertIs(self.router.lookup("ROLL"), self.router.lookup("r"))
+        self.assertIsNone(self.router.lookup("ro"))
+        self.assertIn("roll", self.router)
+        self.assertEqual(len(self.router), 1)
+        with self.assertRaises(ValueError):
+            self.router.add(commands.Command("r", self.roll))
+
+    def test_route(self):
+        self.assertTrue(self.route("!roll 20"))
+        self.assertTrue(self.route("!r", target="me"))
+        self.assertEqual(self.calls, [("#x", 20), ("nick", 6)])
+        self.assertFalse(self.route("!rolls"))
+        self.assertFalse(self.route("roll"))
+        self.assertFalse(self.route("!"))
+
+    def test_bad_arguments_get_the_usage(self):
+        self.assertTrue(self.route("!roll many"))
+        self.assertEqual(self.calls, [])
+        self.assertEqual(self.notices, [("nick", "Usage: !roll [sides]")])
+
+    def test_remove(self):
+        self.router.add(commands.Command("rank", self.roll))
+        self.router.remove("roll")
+        self.assertIsNone(self.router.lookup("r"))
+        self.assertFalse(self.route("!roll"))
+        self.assertTrue(self.route("!rank"))
+
+    def test_rate_limits(self):
+        self.router.add(commands.Command("ping", self.roll, rate=(1, 60)))
+        self.assertTrue(self.route("!ping"))
+        self.assertTrue(self.route("!ping"))
+        self.assertEqual(len(self.calls), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
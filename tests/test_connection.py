@@ -0,0 +1,196 @@
+import unittest
+
+from ircutils3 import client, connection, protocol, replay
+
+
+class FakeReads(object):
+    """ Stands in for the socket: every call hands over the next chunk. """
+
+    def __init__(self):
+        self.chunks = []
+
+    def __call__(self, buffer):
+        data = self.chunks.pop(0)
+        buffer[:len(data)] = data
+        return len(data)
+
+
+class ConnectionTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = connection.Connection()
+        self.conn.execute = self.execute
+        self.conn.handle_batch = self.handle_batch
+        self.conn.handle_server_batch = self.handle_server_batch
+        self.reads = FakeReads()
+        self.conn._recv_into = self.reads
+        self.executed = []
+        self.lines = []
+        self.batches = []
+
+    def tearDown(self):
+        self.conn.close()
+
+    def execute(self, command, *params, **kwargs):
+        self.executed.append((command,) + params)
+
+    def handle_batch(self, lines):
+        self.lines.extend(lines)
+
+    def handle_server_batch(self, batch_type, params, lines):
+        self.batches.append((batch_type, params, lines))
+
+    def feed(self, *chunks):
+        for chunk in chunks:
+            self.reads.chunks.append(chunk)
+            self.conn.handle_read()
+
+    def commands(self):
+        return [command for prefix, command, params in self.lines]
+
+
+class ReadTest(ConnectionTestCase):
+
+    def test_splits_every_complete_line(self):
+        self.feed(b":a!b@c PRIVMSG #x :one\r\n:a!b@c PRIVMSG #x :two\r\n")
+        self.assertEqual([params for prefix, command, params in self.lines],
+                         [["#x", "one"], ["#x", "two"]])
+
+    def test_keeps_partial_lines_between_reads(self):
+        self.feed(b":a!b@c PRIVMSG #x :o", b"ne\r", b"\n:a!b@c NOTICE #x ")
+        self.assertEqual(self.commands(), ["PRIVMSG"])
+        self.feed(b":two\r\n")
+        self.assertEqual(self.commands(), ["PRIVMSG", "NOTICE"])
+
+    def test_skips_empty_lines(self):
+        self.feed(b"\r\n\r\nPING :x\r\n")
+        self.assertEqual(self.executed, [("PONG", "x")])
+
+    def test_numerics_become_names(self):
+        self.feed(b":irc.example 001 me :Welcome\r\n")
+        self.assertEqual(self.commands(), ["RPL_WELCOME"])
+        self.assertEqual(self.lines[0][1].value, 1)
+
+    def test_drops_lines_that_are_too_long(self):
+        self.conn.max_line_length = 100
+        self.feed(b"PING :a\r\n" + b"x" * 80, b"x" * 80, b"x" * 80)
+        self.assertLessEqual(len(self.conn._partial_line), 1)
+        self.feed(b"still the long line\r\nPING :b\r\n")
+        self.assertEqual(self.executed, [("PONG", "a"), ("PONG", "b")])
+
+    def test_line_end_split_across_a_dropped_line(self):
+        self.conn.max_line_length = 10
+        self.feed(b"x" * 20 + b"\r", b"\nPING :a\r\n")
+        self.assertEqual(self.executed, [("PONG", "a")])
+
+    def test_close_forgets_the_partial_line(self):
+        self.feed(b"PING :a")
+        self.conn.close()
+        self.assertEqual(len(self.conn._partial_line), 0)
+
+
+class BatchTest(ConnectionTestCase):
+
+    def test_collects_a_batch(self):
+        self.feed(b"BATCH +s1 netsplit hub.example leaf.example\r\n"
+                  b"@batch=s1 :a!b@c QUIT :hub.example leaf.example\r\n"
+                  b":x!y@z PRIVMSG #x :during\r\n"
+                  b"@batch=s1 :d!e@f QUIT :hub.example leaf.example\r\n")
+        self.assertEqual(self.commands(), ["PRIVMSG"])
+        self.assertEqual(self.batches, [])
+        self.feed(b"BATCH -s1\r\n")
+        [(batch_type, params, lines)] = self.batches
+        self.assertEqual(batch_type, "netsplit")
+        self.assertEqual(params, ["hub.example", "leaf.example"])
+        self.assertEqual([prefix for prefix, command, params in lines],
+                         ["a!b@c", "d!e@f"])
+
+    def test_lines_before_the_end_are_handled_first(self):
+        handled = []
+        self.conn.handle_batch = lambda lines: handled.append("lines")
+        self.conn.handle_server_batch = \
+            lambda *batch: handled.append("batch")
+        self.feed(b"BATCH +r netjoin a b\r\n:x!y@z PRIVMSG #x :hi\r\n"
+                  b"BATCH -r\r\n:x!y@z PRIVMSG #x :after\r\n")
+        self.assertEqual(handled, ["lines", "batch", "lines"])
+
+    def test_nested_batches(self):
+        self.feed(b"BATCH +outer chathistory #x\r\n"
+                  b"@batch=outer BATCH +inner netjoin a b\r\n"
+                  b"@batch=inner :a!b@c JOIN #x\r\n"
+                  b"BATCH -inner\r\n"
+                  b"@batch=outer :a!b@c PRIVMSG #x :old\r\n"
+                  b"BATCH -outer\r\n")
+        self.assertEqual([batch[0] for batch in self.batches],
+                         ["netjoin", "chathistory"])
+
+    def test_unknown_batch_tags_are_ordinary_lines(self):
+        self.feed(b"@batch=nope :a!b@c PRIVMSG #x :hi\r\nBATCH -nope\r\n")
+        self.assertEqual(self.commands(), ["PRIVMSG"])
+        self.assertEqual(self.batches, [])
+
+    def test_empty_batch_reference(self):
+        self.feed(b"BATCH :\r\nBATCH\r\nPING :a\r\n")
+        self.assertEqual(self.commands(), ["BATCH", "BATCH", "PING"])
+        self.assertEqual(self.executed, [("PONG", "a")])
+
+    def test_too_many_lines(self):
+        self.conn.max_batch_lines = 2
+        self.feed(b"BATCH +s netsplit a b\r\n" +
+                  b"@batch=s :a!b@c QUIT :a b\r\n" * 3 +
+                  b"BATCH -s\r\n")
+        self.assertEqual(self.commands(), ["QUIT"] * 3)
+        self.assertEqual(self.batches, [])
+
+    def test_too_many_open_batches(self):
+        self.conn.max_open_batches = 2
+        self.feed(b"BATCH +a netjoin x y\r\n@batch=a :a!b@c JOIN #x\r\n"
+                  b"BATCH +b netjoin x y\r\nBATCH +c netjoin x y\r\n")
+        self.assertEqual(self.commands(), ["JOIN"])
+        self.assertEqual(sorted(self.conn._open_batches), ["b", "c"])
+
+    def test_close_drops_open_batches(self):
+        self.feed(b"BATCH +a netjoin x y\r\n")
+        self.conn.close()
+        self.assertEqual(self.conn._open_batches, {})
+
+
+class ClientBatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = client.SimpleClient("tester")
+        self.conn = replay.ReplayConnection()
+        self.client._bind_connection(self.conn)
+        self.seen = []
+        for name in ("netsplit", "batch", "quit", "message"):
+            self.client.events[name].add_handler(self.handler(name))
+
+    def handler(self, name):
+        def record(client, event):
+            self.seen.append((name, event.command))
+        return record
+
+    def test_netsplit_arrives_as_one_event(self):
+        channel = self.client.channels["#x"] = protocol.Channel()
+        channel.name = "#x"
+        channel.user_list.update(["a", "d", "stays"])
+        self.conn.feed_lines([
+            b"BATCH +s1 netsplit hub.example leaf.example",
+            b"@batch=s1 :a!b@c QUIT :hub.example leaf.example",
+            b"@batch=s1 :d!e@f QUIT :hub.example leaf.example",
+            b"BATCH -s1"])
+        self.assertEqual(sorted(self.seen),
+                         [("batch", "BATCH"), ("netsplit", "BATCH")])
+        self.assertEqual(channel.user_list, set(["stays"]))
+
+    def test_other_batches_are_dispatched_as_well(self):
+        self.conn.feed_lines([
+            b"BATCH +l labeled-response",
+            b"@batch=l :a!b@c PRIVMSG #x :hi",
+            b"BATCH -l"])
+        self.assertEqual(self.seen, [("message", "PRIVMSG"),
+                                     ("batch", "BATCH")])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,165 @@
+import unittest
+
+from ircutils3 import events
+
+
+class HandlerQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.queue = events.HandlerQueue()
+
+    def handlers(self):
+        return [handler for priority, handler in self.queue]
+
+    def test_orders_by_priority_then_insertion(self):
+        self.queue.add("c", priority=2)
+        self.queue.add("a", priority=0)
+        self.queue.add("b", priority=1)
+        self.queue.add("a2", priority=0)
+        self.assertEqual(self.handlers(), ["a", "a2", "b", "c"])
+
+    def test_remove_by_token(self):
+        first = self.queue.add("x")
+        self.queue.add("x")
+        self.assertTrue(self.queue.remove(first))
+        self.assertFalse(self.queue.remove(first))
+        self.assertEqual(len(self.queue), 1)
+
+    def test_remove_handler_removes_every_entry(self):
+        self.queue.add("x")
+        self.queue.add("y")
+        self.queue.add("x", priority=5)
+        self.queue.remove_handler("x")
+        self.assertEqual(self.handlers(), ["y"])
+        self.assertNotIn("x", self.queue)
+
+    def test_changes_in_place_until_handed_out(self):
+        self.queue.add("a")
+        entries = self.queue.entries
+        self.queue.add("b")
+        self.assertIs(self.queue.entries, entries)
+
+    def test_snapshot_doesnt_change(self):
+        self.queue.add("a")
+        token = self.queue.add("b")
+        snapshot = self.queue.snapshot()
+        self.queue.add("c")
+        self.queue.remove(token)
+        self.assertEqual([entry[2] for entry in snapshot], ["a", "b"])
+        self.assertEqual(self.handlers(), ["a", "c"])
+
+    def test_copies_are_separate(self):
+        self.queue.add("a")
+        copy = self.queue.copy()
+        copy.add("b")
+        self.queue.add("c")
+        self.assertEqual(self.handlers(), ["a", "c"])
+        self.assertEqual([handler for priority, handler in copy], ["a", "b"])
+
+
+class ActivationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.listener = events.create_listener()
+        self.event = events.StandardEvent("a!b@c", "PRIVMSG", ["#x", "hi"])
+        self.calls = []
+
+    def test_handlers_may_change_the_queue_while_activated(self):
+        def first(client, event):
+            self.calls.append("first")
+            self.listener.add_handler(second)
+
+        def second(client, event):
+            self.calls.append("second")
+        self.listener.add_handler(first, once=True)
+        self.listener.notify(None, self.event)
+        self.assertEqual(self.calls, ["first"])
+        self.listener.notify(None, self.event)
+        self.assertEqual(self.calls, ["first", "second"])
+
+
+def message(text, source="nick!user@host.example", target="#chan",
+            command="PRIVMSG"):
+    return events.StandardEvent(source, command, [target, text])
+
+
+class PatternListenerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.listener = events.PatternListener()
+        self.hits = []
+
+    def add(self, name, **conditions):
+        self.listener.add_pattern(lambda client, event: self.hits.append(name),
+                                  **conditions)
+
+    def notify(self, event):
+        del self.hits[:]
+        self.listener.notify(None, event)
+        return sorted(self.hits)
+
+    def test_command_and_target(self):
+        self.add("msg", command="PRIVMSG")
+        self.add("chan", command="PRIVMSG", target="#Chan")
+        self.add("other", command="PRIVMSG", target="#other")
+        self.add("notice", command="NOTICE")
+        self.assertEqual(self.notify(message("hi")), ["chan", "msg"])
+        self.assertEqual(self.notify(message("hi", command="NOTICE")),
+                         ["notice"])
+
+    def test_source_masks(self):
+        self.add("nick", source="Nick")
+        self.add("host", source="*!*@*.example")
+        self.add("elsewhere", source="*!*@*.elsewhere")
+        self.assertEqual(self.notify(message("hi")), ["host", "nick"])
+
+    def test_target_masks(self):
+        self.add("help", target="#help-*")
+        self.assertEqual(self.notify(message("hi", target="#help-python")),
+                         ["help"])
+        self.assertEqual(self.notify(message("hi")), [])
+
+    def test_merged_patterns_match_separately(self):
+        self.add("greet", command="PRIVMSG", message=r"^(hi|hello)\b")
+        self.add("bye", command="PRIVMSG", message=r"\bbye$")
+        self.add("deploy", command="PRIVMSG", message=r"^!deploy")
+        self.assertEqual(self.notify(message("hello there")), ["greet"])
+        self.assertEqual(self.notify(message("hi, bye")), ["bye", "greet"])
+        self.assertEqual(self.notify(message("nothing")), [])
+
+    def test_numbered_back_references(self):
+        self.add("aa", command="PRIVMSG", message=r"(a)\1")
+        self.add("bb", command="PRIVMSG", message=r"(b)\1")
+        self.add("word", command="PRIVMSG", message=r"(?P<w>x)y")
+        self.assertEqual(self.notify(message("bb")), ["bb"])
+        self.assertEqual(self.notify(message("aa")), ["aa"])
+        self.assertEqual(self.notify(message("xy")), ["word"])
+
+    def test_escaped_backslash_is_not_a_reference(self):
+        self.add("one", command="PRIVMSG", message=r"\\1")
+        self.add("two", command="PRIVMSG", message=r"2")
+        self.assertEqual(self.notify(message("\\1")), ["one"])
+
+    def test_priority_order(self):
+        self.listener.add_pattern(
+            lambda client, event: self.hits.append("late"), priority=5)
+        self.listener.add_pattern(
+            lambda client, event: self.hits.append("early"),
+            command="PRIVMSG", message="hi", priority=-5)
+        self.listener.notify(None, message("hi"))
+        self.assertEqual(self.hits, ["early", "late"])
+
+    def test_handlers_added_later_are_indexed(self):
+        self.add("first", command="PRIVMSG")
+        self.assertEqual(self.notify(message("hi")), ["first"])
+        self.add("second", command="PRIVMSG", message="hi")
+        self.assertEqual(self.notify(message("hi")), ["first", "second"])
+
+    def test_once(self):
+        self.add("once", command="PRIVMSG", once=True)
+        self.assertEqual(self.notify(message("hi")), ["once"])
+        self.assertEqual(self.notify(message("hi")), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
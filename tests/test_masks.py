@@ -0,0 +1,96 @@
+import unittest
+
+from ircutils3 import events, masks
+
+
+class MaskTest(unittest.TestCase):
+
+    def test_casefold(self):
+        self.assertEqual(masks.casefold("Nick[Away]\\~"), "nick{away}|^")
+        self.assertEqual(masks.casefold("Nick[Away]", "ascii"), "nick[away]")
+
+    def test_normalize_mask(self):
+        self.assertEqual(masks.normalize_mask("nick"), "nick!*@*")
+        self.assertEqual(masks.normalize_mask("*@host"), "*!*@host")
+        self.assertEqual(masks.normalize_mask("nick!user"), "nick!user@*")
+        self.assertEqual(masks.normalize_mask("a!b@c"), "a!b@c")
+
+    def test_compile_mask(self):
+        regex = masks.compile_mask("a?c*")
+        self.assertTrue(regex.match("abc"))
+        self.assertTrue(regex.match("abcdef"))
+        self.assertFalse(regex.match("ac"))
+        self.assertFalse(masks.compile_mask("a.c").match("abc"))
+
+
+class MaskSetTest(unittest.TestCase):
+
+    def setUp(self):
+        self.masks = masks.MaskSet(["*!*@*.spam.example", "troll",
+                                    "*!~bot@*", "exact!user@host"])
+
+    def test_match(self):
+        self.assertTrue(self.masks.match("troll!~t@home.example"))
+        self.assertTrue(self.masks.match("x!y@a.spam.example"))
+        self.assertTrue(self.masks.match("x!~bot@anywhere"))
+        self.assertTrue(self.masks.match("exact!user@host"))
+        self.assertFalse(self.masks.match("friend!~f@home.example"))
+        self.assertFalse(self.masks.match("x!y@spam.example"))
+        self.assertFalse(self.masks.match("exact!user@host2"))
+
+    def test_casemapping(self):
+        self.assertTrue(self.masks.match("TROLL!x@y"))
+        self.assertTrue(self.masks.match("EXACT!USER@HOST"))
+        self.assertIn("Troll", self.masks)
+        rfc = masks.MaskSet(["nick[a]"])
+        self.assertTrue(rfc.match("NICK{A}!u@h"))
+        ascii = masks.MaskSet(["nick[a]"], casemapping="ascii")
+        self.assertFalse(ascii.match("nick{a}!u@h"))
+
+    def test_shared_beginnings(self):
+        shared = masks.MaskSet(["*!*@a.example", "*!*@ab.example",
+                                "*!*@a.example.net", "*!*@*"])
+        shared.discard("*!*@*")
+        self.assertTrue(shared.match("n!u@a.example"))
+        self.assertTrue(shared.match("n!u@ab.example"))
+        self.assertTrue(shared.match("n!u@a.example.net"))
+        self.assertFalse(shared.match("n!u@a.example.org"))
+        self.assertFalse(shared.match("n!u@b.example"))
+
+    def test_matches_whole_prefix_only(self):
+        only = masks.MaskSet(["*!*@host"])
+        self.assertFalse(only.match("n!u@host.example"))
+
+    def test_add_and_discard(self):
+        self.masks.discard("troll")
+        self.assertFalse(self.masks.match("troll!~t@home.example"))
+        self.masks.discard("*!*@*.spam.example")
+        self.assertFalse(self.masks.match("x!y@a.spam.example"))
+        self.masks.add("*!*@*.spam.example")
+        self.assertTrue(self.masks.match("x!y@a.spam.example"))
+        self.assertEqual(len(self.masks), 3)
+        self.masks.clear()
+        self.assertEqual(len(self.masks), 0)
+        self.assertFalse(self.masks.match("x!y@a.spam.example"))
+
+    def test_special_characters_are_literal(self):
+        literal = masks.MaskSet(["n.ck!*@*", "a+b!*@*"])
+        self.assertTrue(literal.match("n.ck!u@h"))
+        self.assertFalse(literal.match("nick!u@h"))
+        self.assertTrue(literal.match("a+b!u@h"))
+
+    def test_match_user(self):
+        self.assertTrue(self.masks.match_user("x", "y", "a.spam.example"))
+        self.assertFalse(self.masks.match_user("x", None, None))
+
+    def test_allows(self):
+        spam = events.StandardEvent("x!y@a.spam.example", "PRIVMSG",
+                                    ["#c", "hi"])
+        friend = events.StandardEvent("friend!f@home", "PRIVMSG",
+                                      ["#c", "hi"])
+        self.assertFalse(self.masks.allows(None, spam))
+        self.assertTrue(self.masks.allows(None, friend))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,81 @@
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from ircutils3 import messagelog
+
+
+def record(stamp, channel, text, source="nick"):
+    return messagelog.LogRecord(stamp, channel, source, "PRIVMSG", text)
+
+
+class MessageLogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def open(self, **kwargs):
+        log = messagelog.MessageLog(self.directory, **kwargs)
+        self.addCleanup(self.close, log)
+        return log
+
+    def close(self, log):
+        try:
+            log.close()
+        except OSError:
+            pass
+
+    def test_query(self):
+        log = self.open()
+        for stamp in range(10):
+            log.append(record(100.0 + stamp, "#a" if stamp % 2 else "#b",
+                              str(stamp)))
+        self.assertTrue(log.flush())
+        self.assertEqual([r.text for r in log.query()],
+                         [str(stamp) for stamp in range(10)])
+        self.assertEqual([r.text for r in log.query(channel="#A")],
+                         ["1", "3", "5", "7", "9"])
+        self.assertEqual([r.text for r in log.query(start=103, end=105.5)],
+                         ["3", "4", "5"])
+
+    def test_compressed_segments(self):
+        log = self.open(compress=True, segment_size=1)
+        for stamp in range(3):
+            log.append(record(100.0 + stamp, "#a", str(stamp)))
+            log.flush()
+        self.assertEqual(len(log._segments), 3)
+        self.assertEqual([r.text for r in log.query(start=101)], ["1", "2"])
+
+    def test_fields_with_separators(self):
+        log = self.open()
+        texts = ["tab\there", "two\nlines", "back\\slash", "\\t not a tab",
+                 "end\\"]
+        for stamp, text in enumerate(texts):
+            log.append(record(100.0 + stamp, "#a", text, source="a\tb"))
+        log.flush()
+        self.assertEqual([r.text for r in log.query()], texts)
+        self.assertEqual(set(r.source for r in log.query()), set(["a\tb"]))
+
+    def test_records_survive_reopening(self):
+        log = self.open()
+        log.append(record(100.0, "#a", "kept"))
+        log.close()
+        self.assertEqual([r.text for r in self.open().query()], ["kept"])
+
+    def test_writer_errors_are_raised(self):
+        log = self.open()
+        with mock.patch.object(log, "_write_block",
+                               side_effect=OSError("disk full")):
+            log.append(record(100.0, "#a", "lost"))
+            with self.assertRaises(OSError):
+                log.flush(timeout=5)
+        with self.assertRaises(OSError):
+            log.append(record(101.0, "#a", "lost"))
+        with self.assertRaises(OSError):
+            log.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
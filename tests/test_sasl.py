@@ -0,0 +1,119 @@
+import base64
+import unittest
+from unittest import mock
+
+from ircutils3 import sasl
+
+
+def exchange(mechanism, client_nonce, server_first, server_final):
+    """ Runs a SCRAM exchange with the nonce fixed to ``client_nonce`` and
+    returns the client's messages. """
+    with mock.patch("os.urandom",
+                    lambda size: base64.b64decode(client_nonce)):
+        client_first = mechanism.respond(b"")
+    client_final = mechanism.respond(server_first.encode("UTF-8"))
+    last = mechanism.respond(server_final.encode("UTF-8"))
+    return client_first.decode(), client_final.decode(), last
+
+
+class ScramTest(unittest.TestCase):
+
+    def test_sha1_exchange(self):
+        # RFC 5802, section 5.
+        messages = exchange(
+            sasl.Scram("user", "pencil", "sha1"),
+            "fyko+d2lbbFgONRv9qkxdawL",
+            "r=fyko+d2lbbFgONRv9qkxdawL3rfcNHYJY1ZVvWVs7j,"
+            "s=QSXCR+Q6sek8bf92,i=4096",
+            "v=rmF9pqV8S7suAoZWja4dJRkFsKQ=")
+        self.assertEqual(messages, (
+            "n,,n=user,r=fyko+d2lbbFgONRv9qkxdawL",
+            "c=biws,r=fyko+d2lbbFgONRv9qkxdawL3rfcNHYJY1ZVvWVs7j,"
+            "p=v0X8v3Bz2T0CJGbJQyF0X+HI4Ts=",
+            b""))
+
+    def test_sha256_exchange(self):
+        # RFC 7677, section 3.
+        messages = exchange(
+            sasl.Scram("user", "pencil"),
+            "rOprNGfwEbeRWgbNEkqO",
+            "r=rOprNGfwEbeRWgbNEkqO%hvYDpWUa2RaTCAfuxFIlj)hNlF$k0,"
+            "s=W22ZaJ0SNY7soEsUEjb6gQ==,i=4096",
+            "v=6rriTRBi23WpRR/wtup+mMhUZUn/dB5nLTJRsjl95G4=")
+        self.assertEqual(messages, (
+            "n,,n=user,r=rOprNGfwEbeRWgbNEkqO",
+            "c=biws,r=rOprNGfwEbeRWgbNEkqO%hvYDpWUa2RaTCAfuxFIlj)hNlF$k0,"
+            "p=dHzbZapWIk4jUhN+Ute9ytag9zjfMHgsqmmiz7AndVQ=",
+            b""))
+
+    def test_names(self):
+        self.assertEqual(sasl.Scram("u", "p").name, "SCRAM-SHA-256")
+        self.assertEqual(sasl.Scram("u", "p", "sha1").name, "SCRAM-SHA-1")
+
+    def test_escapes_the_user_name(self):
+        first = sasl.Scram("a=b,c", "p").respond(b"").decode()
+        self.assertTrue(first.startswith("n,,n=a=3Db=2Cc,r="))
+
+    def test_rejects_a_wrong_server_signature(self):
+        mechanism = sasl.Scram("user", "pencil")
+        with self.assertRaises(sasl.SASLError):
+            exchange(mechanism, "rOprNGfwEbeRWgbNEkqO",
+                     "r=rOprNGfwEbeRWgbNEkqO%hvYDpWUa2RaTCAfuxFIlj)hNlF$k0,"
+                     "s=W22ZaJ0SNY7soEsUEjb6gQ==,i=4096",
+                     "v=AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA=")
+
+    def test_rejects_a_nonce_the_client_didnt_start(self):
+        mechanism = sasl.Scram("user", "pencil")
+        mechanism.respond(b"")
+        with self.assertRaises(sasl.SASLError):
+            mechanism.respond(b"r=somethingelse,s=W22ZaJ0SNY7soEsUEjb6gQ==,"
+                              b"i=4096")
+
+    def test_server_errors(self):
+        mechanism = sasl.Scram("user", "pencil")
+        with self.assertRaises(sasl.SASLError):
+            exchange(mechanism, "rOprNGfwEbeRWgbNEkqO",
+                     "r=rOprNGfwEbeRWgbNEkqO%hvYDpWUa2RaTCAfuxFIlj)hNlF$k0,"
+                     "s=W22ZaJ0SNY7soEsUEjb6gQ==,i=4096",
+                     "e=invalid-proof")
+
+    def test_malformed_messages(self):
+        mechanism = sasl.Scram("user", "pencil")
+        mechanism.respond(b"")
+        with self.assertRaises(sasl.SASLError):
+            mechanism.respond(b"garbage")
+
+    def test_start_begins_again(self):
+        mechanism = sasl.Scram("user", "pencil")
+        mechanism.respond(b"")
+        mechanism.start()
+        self.assertTrue(mechanism.respond(b"").startswith(b"n,,n=user,r="))
+
+
+class PlainTest(unittest.TestCase):
+
+    def test_response(self):
+        self.assertEqual(sasl.Plain("user", "pass").respond(b""),
+                         b"\0user\0pass")
+        self.assertEqual(sasl.Plain("user", "pass", "admin").respond(b""),
+                         b"admin\0user\0pass")
+
+
+class EncodeResponseTest(unittest.TestCase):
+
+    def test_short(self):
+        self.assertEqual(sasl.encode_response(b""), ["+"])
+        self.assertEqual(sasl.encode_response(b"\0user\0pass"),
+                         ["AHVzZXIAcGFzcw=="])
+
+    def test_chunks(self):
+        # 300 bytes are exactly 400 in base64, so a "+" has to follow.
+        chunks = sasl.encode_response(b"x" * 300)
+        self.assertEqual(len(chunks[0]), 400)
+        self.assertEqual(chunks[1:], ["+"])
+        chunks = sasl.encode_response(b"x" * 301)
+        self.assertEqual([len(chunk) for chunk in chunks], [400, 4])
+
+
+if __name__ == "__main__":
+    unittest.main()
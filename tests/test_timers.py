@@ -0,0 +1,106 @@
+import unittest
+
+from ircutils3 import timers
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TimerWheelTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.wheel = timers.TimerWheel(resolution=0.05, clock=self.clock)
+        self.fired = []
+
+    def advance(self, seconds):
+        self.clock.now += seconds
+        self.wheel.advance()
+
+    def test_fires_once_the_time_has_come(self):
+        self.wheel.call_later(1.0, self.fired.append, "a")
+        self.advance(0.9)
+        self.assertEqual(self.fired, [])
+        self.advance(0.2)
+        self.assertEqual(self.fired, ["a"])
+        self.advance(10)
+        self.assertEqual(self.fired, ["a"])
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_fires_in_order(self):
+        for delay in (3.0, 0.5, 2.0, 1.0):
+            self.wheel.call_later(delay, self.fired.append, delay)
+        self.advance(5)
+        self.assertEqual(self.fired, [0.5, 1.0, 2.0, 3.0])
+
+    def test_cancelled_timers_dont_fire(self):
+        timer = self.wheel.call_later(1.0, self.fired.append, "a")
+        self.wheel.call_later(1.0, self.fired.append, "b")
+        timer.cancel()
+        timer.cancel()
+        self.assertEqual(len(self.wheel), 1)
+        self.advance(2)
+        self.assertEqual(self.fired, ["b"])
+
+    def test_timers_in_upper_levels_cascade_down(self):
+        # 64 ticks of 0.05s fit on the first level; these are beyond it.
+        self.wheel.call_later(10.0, self.fired.append, "10s")
+        self.wheel.call_later(600.0, self.fired.append, "10m")
+        self.advance(9.9)
+        self.assertEqual(self.fired, [])
+        for step in range(10):
+            self.advance(0.05)
+        self.assertEqual(self.fired, ["10s"])
+        for step in range(600):
+            self.advance(1.0)
+        self.assertEqual(self.fired, ["10s", "10m"])
+
+    def test_timers_beyond_the_wheel_still_fire(self):
+        # Two levels of 16 ticks of 0.05s only reach 12.8 seconds ahead.
+        wheel = timers.TimerWheel(resolution=0.05, slot_bits=4, levels=2,
+                                  clock=self.clock)
+        wheel.call_later(100.0, self.fired.append, "late")
+        for step in range(99):
+            self.clock.now += 1.0
+            wheel.advance()
+        self.clock.now += 0.9
+        wheel.advance()
+        self.assertEqual(self.fired, [])
+        self.clock.now += 0.2
+        wheel.advance()
+        self.assertEqual(self.fired, ["late"])
+
+    def test_never_fires_early(self):
+        timer = self.wheel.call_later(0.07, self.fired.append, "a")
+        self.advance(0.06)
+        self.assertEqual(self.fired, [])
+        self.advance(0.06)
+        self.assertEqual(self.fired, ["a"])
+        self.assertTrue(self.clock.now >= timer.when)
+
+    def test_callbacks_may_schedule_more_timers(self):
+        def again(count):
+            self.fired.append(count)
+            if count < 3:
+                self.wheel.call_later(0.5, again, count + 1)
+        self.wheel.call_later(0.5, again, 1)
+        for step in range(20):
+            self.advance(0.1)
+        self.assertEqual(self.fired, [1, 2, 3])
+
+    def test_time_until_next(self):
+        self.assertIsNone(self.wheel.time_until_next())
+        self.wheel.call_later(1.0, self.fired.append, "a")
+        wait = self.wheel.time_until_next()
+        self.assertLessEqual(wait, 1.0)
+        self.assertGreater(wait, 0.0)
+
+
+if __name__ == "__main__":
+    unittest.main()